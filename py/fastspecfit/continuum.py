@@ -13,62 +13,7 @@ import numpy as np
 import astropy.units as u
 from astropy.table import Table, Column
 
-from fastspecfit.util import C_LIGHT, TabulatedDESI, Lyman_series
-
-#import numba
-#@numba.jit(nopython=True)
-def nnls(A, b, maxiter=None, eps=1e-7, v=False):
-    # https://en.wikipedia.org/wiki/Non-negative_least_squares#Algorithms
-    # not sure what eps should be set to
-    m, n = A.shape
-    if b.shape[0] != m:
-        raise ValueError()#f"Shape mismatch: {A.shape} {b.shape}. Expected: (m, n) (m) ")
-    if maxiter is None:
-        # this is what scipy does when maxiter is not specified
-        maxiter = 3 * n
-    # init
-    P = np.zeros(n).astype(bool)
-    R = np.ones(n).astype(bool)
-    x = np.zeros(n)
-    s = np.zeros(n)
-    # compute these once ahead of time
-    ATA = A.T.dot(A)
-    ATb = A.T.dot(b)
-    # main loop
-    w = ATb - ATA.dot(x)
-    j = np.argmax(R * w)
-    c = 0 # iteration count
-    # while R != {} and max(w[R]) > eps
-    while np.any(R) and w[j] > eps:
-        #if v: print(f"{c=}", f"{P=}\n {R=}\n {w=}\n {j=}")
-        # add j to P, remove j from R
-        P[j], R[j] = True, False
-        s[P] = np.linalg.inv(ATA[P][:, P]).dot(ATb[P])
-        s[R] = 0
-        d = 0 # inner loop iteration count, for debugging
-        #if v: print(f"{c=}", f"{P=}\n {R=}\n {s=}")
-        # while P != {} and min(s[P]) < eps
-        # make sure P is not empty before checking min s[P]
-        while np.any(P) and np.min(s[P]) < eps:
-            i = P & (s < eps)
-            #if v: print(f" {d=}", f"  {P=}\n  {i=}\n  {s=}\n  {x=}")
-            a = np.min(x[i] / (x[i] - s[i]))
-            x = x + a * (s - x)
-            j = P & (x < eps)
-            R[j], P[j] = True, False
-            s[P] = np.linalg.inv(ATA[P][:, P]).dot(ATb[P])
-            s[R] = 0
-            d += 1
-        x[:] = s
-        # w = A.T.dot(b - A.dot(x))
-        w = ATb - ATA.dot(x)
-        j = np.argmax(R * w)
-        #if v: print(f"{c=}", f"{P=}\n {R=}\n {w=}\n {j=}")
-        c += 1
-        if c >= maxiter:
-            break
-    res = np.linalg.norm(A.dot(x) - b)
-    return x, res
+from fastspecfit.util import C_LIGHT, TabulatedDESI, Lyman_series, StageTimer
 
 class ContinuumTools(TabulatedDESI):
     """Tools for dealing with stellar continua.
@@ -93,11 +38,25 @@ class ContinuumTools(TabulatedDESI):
     """
     def __init__(self, templates=None, templateversion='1.0.0', imf='chabrier',
                  mintemplatewave=None, maxtemplatewave=40e4, mapdir=None,
-                 fastphot=False, nophoto=False, verbose=False):
+                 fastphot=False, nophoto=False, template_cache=None, phot_lut=False,
+                 verbose=False):
+        """Tools for dealing with stellar continua.
 
+        Parameters
+        ----------
+        template_cache : :class:`str`, optional
+            Directory in which to cache the (trimmed and nominal-vdisp
+            convolved) templates as memory-mapped binary files, keyed on the
+            templates file checksums and the wavelength trimming; the cache is
+            built on first use. If `None`, read the templates from scratch.
+        phot_lut : :class:`bool`, optional
+            Build (or read from `template_cache`) a lookup table of the
+            photometry of the nominal-vdisp templates on a fine redshift grid
+            (see `init_phot_lut`), which is used to fit the photometry.
+
+        """
         super(ContinuumTools, self).__init__()
 
-        import fitsio
         from speclite import filters
         from desiutil.dust import SFDMap
         from desiutil.log import get_logger, DEBUG
@@ -110,6 +69,14 @@ class ContinuumTools(TabulatedDESI):
         else:
             self.log = get_logger()
 
+        # per-object stage timings (see fastspecfit.fastspecfit.fastspec_one)
+        self.timer = StageTimer()
+        self._t2d_operators = {}
+        self._filter_weights = {}
+        self._dn4000_integrals = {}
+        self._kcorr_weights = None
+        self._agekeep = None
+
         #from astropy.cosmology import FlatLambdaCDM
         #cosmo = FlatLambdaCDM(H0=100, Om0=0.3)
         #ztest = 0.1
@@ -144,34 +111,39 @@ class ContinuumTools(TabulatedDESI):
             self.log.critical(errmsg)
             raise IOError(errmsg)
 
-        self.log.info('Reading {}'.format(self.templates))
-        wave, wavehdr = fitsio.read(self.templates, ext='WAVE', header=True) # [npix]
-        templateflux = fitsio.read(self.templates, ext='FLUX')  # [npix,nsed]
-        templatelineflux = fitsio.read(self.templates, ext='LINEFLUX')  # [npix,nsed]
-        templateinfo, templatehdr = fitsio.read(self.templates, ext='METADATA', header=True)
-        templateinfo = Table(templateinfo)
-        self.imf = templatehdr['IMF']
+        self.vdisp_nominal = 125.0
 
-        # Trim the wavelengths and select the number/ages of the templates.
-        # https://www.sdss.org/dr14/spectro/galaxy_mpajhu
-        if mintemplatewave is None:
-            mintemplatewave = np.min(wave)
-        wavekeep = np.where((wave >= mintemplatewave) * (wave <= maxtemplatewave))[0]
+        # Read the templates, optionally via the cache.
+        self.template_cache = template_cache
+        self.template_cachekey = None
+        if template_cache is not None:
+            from fastspecfit.io import template_cache_key, read_template_cache, write_template_cache
+            cachekey = template_cache_key(self.templates, mintemplatewave, maxtemplatewave, self.vdisp_nominal)
+            cache = read_template_cache(template_cache, cachekey)
+            if cache is None:
+                # Always cache the velocity dispersion grid so the same cache
+                # serves both fastspec and fastphot.
+                cache = self._read_templates(mintemplatewave, maxtemplatewave, vdisp=True)
+                write_template_cache(template_cache, cachekey, {key: val for key, val in cache.items() if key != 'meta'}, cache['meta'])
+            self.template_cachekey = cachekey
+        else:
+            cache = self._read_templates(mintemplatewave, maxtemplatewave, vdisp=not fastphot)
 
-        self.templatewave = wave[wavekeep]
-        self.templateflux = templateflux[wavekeep, :]
-        self.templateflux_nolines = templateflux[wavekeep, :] - templatelineflux[wavekeep, :]
-        self.templateinfo = templateinfo
-        self.nsed = len(templateinfo)
-        self.npix = len(wavekeep)
+        self.templatewave = cache['templatewave']
+        self.templateflux = cache['templateflux']
+        self.templateflux_nolines = cache['templateflux_nolines']
+        self.templateflux_nomvdisp = cache['templateflux_nomvdisp']
+        self.templateflux_nolines_nomvdisp = cache['templateflux_nolines_nomvdisp']
+        self.templateinfo = Table(np.array(cache['templateinfo']))
+        self.imf = cache['meta']['IMF']
+        self.nsed = len(self.templateinfo)
+        self.npix = len(self.templatewave)
 
-        self.continuum_pixkms = wavehdr['PIXSZBLU'] # pixel size [km/s]
-        self.pixkms_wavesplit = wavehdr['PIXSZSPT'] # wavelength where the pixel size changes [A]
-        self.vdisp_nominal = 125.0
+        self.continuum_pixkms = cache['meta']['PIXSZBLU'] # pixel size [km/s]
+        self.pixkms_wavesplit = cache['meta']['PIXSZSPT'] # wavelength where the pixel size changes [A]
 
         if not fastphot:
-            vdispwave = fitsio.read(self.templates, ext='VDISPWAVE')
-            vdispflux, vdisphdr = fitsio.read(self.templates, ext='VDISPFLUX', header=True) # [nvdisppix,nvdispsed,nvdisp]
+            vdispwave, vdispflux, vdisphdr = cache['vdispwave'], cache['vdispflux'], cache['meta']
             self.vdispflux = vdispflux
             self.vdispwave = vdispwave
             dims = vdispflux.shape
@@ -191,16 +163,6 @@ class ContinuumTools(TabulatedDESI):
             self.vdisp_nominal_indx = np.where(vdisp == self.vdisp_nominal)[0]
             self.nvdisp = nvdisp
 
-        # Cache a copy of the line-free templates at the nominal velocity
-        # dispersion (needed for fastphot as well).
-        I = np.where(self.templatewave < self.pixkms_wavesplit)[0]
-        templateflux_nolines_nomvdisp = self.templateflux_nolines.copy()
-        templateflux_nomvdisp = self.templateflux.copy()
-        templateflux_nolines_nomvdisp[I, :] = self.convolve_vdisp(templateflux_nolines_nomvdisp[I, :], self.vdisp_nominal)
-        templateflux_nomvdisp[I, :] = self.convolve_vdisp(templateflux_nomvdisp[I, :], self.vdisp_nominal)
-        self.templateflux_nomvdisp = templateflux_nomvdisp
-        self.templateflux_nolines_nomvdisp = templateflux_nolines_nomvdisp
-
         # emission line stuff
         self.linetable = read_emlines()
 
@@ -250,6 +212,11 @@ class ContinuumTools(TabulatedDESI):
 
         self.min_uncertainty = np.array([0.02, 0.02, 0.02, 0.05, 0.05, 0.05, 0.05]) # mag
 
+        # optional lookup table of the template photometry versus redshift
+        self.phot_lut = None
+        if phot_lut:
+            self.init_phot_lut()
+
     def get_dn4000(self, wave, flam, flam_ivar=None, redshift=None, rest=True):
         """Compute DN(4000) and, optionally, the inverse variance.
 
@@ -299,41 +266,12 @@ class ContinuumTools(TabulatedDESI):
         else:
             fnu_ivar = np.ones_like(flam) # uniform weights
 
-        def _integrate(wave, flux, ivar, w1, w2):
-            from scipy import integrate, interpolate
-            # trim for speed
-            I = (wave > (w1-wpad)) * (wave < (w2+wpad))
-            J = np.logical_and(I, ivar > 0)
-            # Require no more than 20% of pixels are masked.
-            if np.sum(J) / np.sum(I) < 0.8:
-                self.log.warning('More than 20% of pixels in Dn(4000) definition are masked.')
-                return 0.0
-            wave = wave[J]
-            flux = flux[J]
-            ivar = ivar[J]
-            # should never have to extrapolate
-            f = interpolate.interp1d(wave, flux, assume_sorted=False, bounds_error=True)
-            f1 = f(w1)
-            f2 = f(w2)
-            i = interpolate.interp1d(wave, ivar, assume_sorted=False, bounds_error=True)
-            i1 = i(w1)
-            i2 = i(w2)
-            # insert the boundary wavelengths then integrate
-            I = np.where((wave > w1) * (wave < w2))[0]
-            wave = np.insert(wave[I], [0, len(I)], [w1, w2])
-            flux = np.insert(flux[I], [0, len(I)], [f1, f2])
-            ivar = np.insert(ivar[I], [0, len(I)], [i1, i2])
-            weight = integrate.simps(x=wave, y=ivar)
-            index = integrate.simps(x=wave, y=flux*ivar) / weight
-            index_var = 1 / weight
-            return index, index_var
-
         blufactor = 3950.0 - 3850.0
         redfactor = 4100.0 - 4000.0
         try:
             # yes, blue wavelength go with red integral bounds
-            numer, numer_var = _integrate(restwave, fnu, fnu_ivar, 4000, 4100)
-            denom, denom_var = _integrate(restwave, fnu, fnu_ivar, 3850, 3950)
+            numer, numer_var = self._integrate_dn4000(restwave, fnu, fnu_ivar, 4000, 4100, wpad=wpad)
+            denom, denom_var = self._integrate_dn4000(restwave, fnu, fnu_ivar, 3850, 3950, wpad=wpad)
         except:
             self.log.warning('Integration failed when computing DN(4000).')
             return dn4000, dn4000_ivar
@@ -348,6 +286,81 @@ class ContinuumTools(TabulatedDESI):
     
         return dn4000, dn4000_ivar
 
+    def _integrate_dn4000(self, wave, flux, ivar, w1, w2, wpad=2.0):
+        """Integrate the flux density between `w1` and `w2` (see `get_dn4000`)."""
+        from scipy import integrate, interpolate
+        # trim for speed
+        I = (wave > (w1-wpad)) * (wave < (w2+wpad))
+        J = np.logical_and(I, ivar > 0)
+        # Require no more than 20% of pixels are masked.
+        if np.sum(J) / np.sum(I) < 0.8:
+            self.log.warning('More than 20% of pixels in Dn(4000) definition are masked.')
+            return 0.0
+        wave = wave[J]
+        flux = flux[J]
+        ivar = ivar[J]
+        # should never have to extrapolate
+        f = interpolate.interp1d(wave, flux, assume_sorted=False, bounds_error=True)
+        f1 = f(w1)
+        f2 = f(w2)
+        i = interpolate.interp1d(wave, ivar, assume_sorted=False, bounds_error=True)
+        i1 = i(w1)
+        i2 = i(w2)
+        # insert the boundary wavelengths then integrate
+        I = np.where((wave > w1) * (wave < w2))[0]
+        wave = np.insert(wave[I], [0, len(I)], [w1, w2])
+        flux = np.insert(flux[I], [0, len(I)], [f1, f2])
+        ivar = np.insert(ivar[I], [0, len(I)], [i1, i2])
+        weight = integrate.simps(x=wave, y=ivar)
+        index = integrate.simps(x=wave, y=flux*ivar) / weight
+        index_var = 1 / weight
+        return index, index_var
+
+    def get_dn4000_batch(self, templateflux, coeff):
+        """Compute the (rest-frame) model Dn(4000) for a batch of coefficients.
+
+        With uniform weights, the integrals in `get_dn4000` are linear in the
+        flux, so they are computed once per template and then combined with
+        the coefficients of each object.
+
+        Parameters
+        ----------
+        templateflux : :class:`numpy.ndarray` [npix, nsed]
+            Rest-frame templates (on `self.templatewave`).
+        coeff : :class:`numpy.ndarray` [nobj, nsed]
+            Coefficients.
+
+        Returns
+        -------
+        :class:`numpy.ndarray` [nobj]
+            Dn(4000) (zero where it is ill-defined).
+
+        """
+        key = (id(templateflux), templateflux.shape)
+        if key not in self._dn4000_integrals:
+            flam2fnu = self.templatewave**2 / (C_LIGHT * 1e5) # [erg/s/cm2/A-->erg/s/cm2/Hz, rest]
+            ones = np.ones_like(self.templatewave)
+            integrals = np.zeros((2, templateflux.shape[1]))
+            try:
+                # yes, blue wavelength go with red integral bounds
+                for jj in np.arange(templateflux.shape[1]):
+                    fnu = templateflux[:, jj] * flam2fnu
+                    integrals[0, jj] = self._integrate_dn4000(self.templatewave, fnu, ones, 4000, 4100)[0]
+                    integrals[1, jj] = self._integrate_dn4000(self.templatewave, fnu, ones, 3850, 3950)[0]
+            except:
+                self.log.warning('Integration failed when computing DN(4000).')
+                integrals[:] = 0.0
+            self._dn4000_integrals[key] = integrals
+        numer, denom = coeff.dot(self._dn4000_integrals[key].T).T
+
+        blufactor = 3950.0 - 3850.0
+        redfactor = 4100.0 - 4000.0
+        dn4000 = np.zeros(len(coeff))
+        good = (numer != 0.0) * (denom != 0.0)
+        dn4000[good] = (blufactor / redfactor) * numer[good] / denom[good]
+
+        return dn4000
+
     def parse_photometry(self, bands, maggies, lambda_eff, ivarmaggies=None,
                          nanomaggies=True, nsigma=2.0, min_uncertainty=None,
                          debug=False):
@@ -471,6 +484,59 @@ class ContinuumTools(TabulatedDESI):
 
         return phot
 
+    def _read_templates(self, mintemplatewave=None, maxtemplatewave=40e4, vdisp=True):
+        """Read and trim the templates and build the copies convolved to the
+        nominal velocity dispersion.
+
+        Returns
+        -------
+        :class:`dict`
+            Dictionary of arrays (see :func:`fastspecfit.io.write_template_cache`)
+            plus a `meta` dictionary of the header values which are needed.
+
+        """
+        import fitsio
+
+        self.log.info('Reading {}'.format(self.templates))
+        wave, wavehdr = fitsio.read(self.templates, ext='WAVE', header=True) # [npix]
+        templateflux = fitsio.read(self.templates, ext='FLUX')  # [npix,nsed]
+        templatelineflux = fitsio.read(self.templates, ext='LINEFLUX')  # [npix,nsed]
+        templateinfo, templatehdr = fitsio.read(self.templates, ext='METADATA', header=True)
+
+        # Trim the wavelengths and select the number/ages of the templates.
+        # https://www.sdss.org/dr14/spectro/galaxy_mpajhu
+        if mintemplatewave is None:
+            mintemplatewave = np.min(wave)
+        wavekeep = np.where((wave >= mintemplatewave) * (wave <= maxtemplatewave))[0]
+
+        cache = {}
+        cache['meta'] = {'IMF': templatehdr['IMF'], 'PIXSZBLU': wavehdr['PIXSZBLU'],
+                         'PIXSZSPT': wavehdr['PIXSZSPT']}
+        cache['templatewave'] = wave[wavekeep]
+        cache['templateflux'] = templateflux[wavekeep, :]
+        cache['templateflux_nolines'] = templateflux[wavekeep, :] - templatelineflux[wavekeep, :]
+        cache['templateinfo'] = templateinfo
+
+        if vdisp:
+            cache['vdispwave'] = fitsio.read(self.templates, ext='VDISPWAVE')
+            vdispflux, vdisphdr = fitsio.read(self.templates, ext='VDISPFLUX', header=True) # [nvdisppix,nvdispsed,nvdisp]
+            cache['vdispflux'] = vdispflux
+            for key in ['VDISPMIN', 'VDISPMAX', 'VDISPRES']:
+                cache['meta'][key] = vdisphdr[key]
+
+        # Cache a copy of the line-free templates at the nominal velocity
+        # dispersion (needed for fastphot as well).
+        self.continuum_pixkms = wavehdr['PIXSZBLU'] # needed by convolve_vdisp
+        I = np.where(cache['templatewave'] < wavehdr['PIXSZSPT'])[0]
+        templateflux_nolines_nomvdisp = cache['templateflux_nolines'].copy()
+        templateflux_nomvdisp = cache['templateflux'].copy()
+        templateflux_nolines_nomvdisp[I, :] = self.convolve_vdisp(templateflux_nolines_nomvdisp[I, :], self.vdisp_nominal)
+        templateflux_nomvdisp[I, :] = self.convolve_vdisp(templateflux_nomvdisp[I, :], self.vdisp_nominal)
+        cache['templateflux_nomvdisp'] = templateflux_nomvdisp
+        cache['templateflux_nolines_nomvdisp'] = templateflux_nolines_nomvdisp
+
+        return cache
+
     def convolve_vdisp(self, templateflux, vdisp):
         """Convolve by the velocity dispersion.
 
@@ -1123,14 +1189,15 @@ class ContinuumTools(TabulatedDESI):
         1 -> everything is transmitted (medium is transparent)
         0 -> nothing is transmitted (medium is opaque)
         Args:
-            zObj (float): Redshift of object
+            zObj (float or array of float): Redshift of object, or an [nobj, 1]
+                array of redshifts (with an [nobj, npix] `lObs`)
             lObs (array of float): wavelength grid
         Returns:
             array of float: transmitted flux fraction
 
         """
         lRF = lObs/(1.+zObj)
-        T = np.ones(lObs.size)
+        T = np.ones(lObs.shape)
         for l in list(Lyman_series.keys()):
             w      = lRF<Lyman_series[l]['line']
             zpix   = lObs[w]/Lyman_series[l]['line']-1.
@@ -1144,8 +1211,9 @@ class ContinuumTools(TabulatedDESI):
 
         Parameters
         ----------
-        templateflux : :class:`numpy.ndarray` [npix]
-            Input (model) spectrum.
+        templateflux : :class:`numpy.ndarray` [npix] or [npix, nmodel]
+            Input (model) spectrum or a block of spectra, all of which are
+            resampled and smoothed at once.
         templatewave : :class:`numpy.ndarray` [npix]
             Wavelength array corresponding to `templateflux`.
         specwave : :class:`numpy.ndarray` [noutpix], optional, defaults to None
@@ -1155,7 +1223,7 @@ class ContinuumTools(TabulatedDESI):
 
         Returns
         -------
-        :class:`numpy.ndarray` [noutpix]
+        :class:`numpy.ndarray` [noutpix] or [noutpix, nmodel]
             Smoothed and resampled flux at the new resolution and wavelength sampling.
 
         Notes
@@ -1179,6 +1247,321 @@ class ContinuumTools(TabulatedDESI):
 
         return smoothflux
     
+    def redshift_templatewave(self, templatewave, redshift):
+        """Redshift the rest-frame template wavelength array and compute the
+        (per-pixel) factor which converts rest-frame template fluxes to
+        observed-frame fluxes.
+
+        The models are normalized to 10 pc, so the factor includes the
+        luminosity distance and the nominal stellar mass normalization, as well
+        as the attenuation due to the Lyman series.
+
+        Parameters
+        ----------
+        templatewave : :class:`numpy.ndarray` [npix]
+            Rest-frame template wavelength array.
+        redshift : :class:`float`
+            Redshift.
+
+        Returns
+        -------
+        ztemplatewave : :class:`numpy.ndarray` [npix]
+            Observed-frame wavelength array.
+        T : :class:`numpy.ndarray` [npix]
+            Multiplicative factor to apply to the rest-frame templates.
+
+        """
+        if redshift:
+            ztemplatewave = templatewave * (1.0 + redshift)
+            dfactor = (10.0 / (1e6 * self.luminosity_distance(redshift)))**2
+            #dfactor = (10.0 / self.cosmo.luminosity_distance(redshift).to(u.pc).value)**2
+            #dfactor = (10.0 / np.interp(redshift, self.redshift_ref, self.dlum_ref))**2
+            T = self.transmission_Lyman(redshift, ztemplatewave)
+            T *= self.fluxnorm * self.massnorm * dfactor / (1.0 + redshift)
+        else:
+            errmsg = 'Input redshift not defined or equal to zero!'
+            self.log.warning(errmsg)
+            ztemplatewave = templatewave.copy() # ???
+            T = np.full(len(templatewave), self.fluxnorm * self.massnorm)
+
+        return ztemplatewave, T
+
+    def templates2data_operator(self, templatewave, redshift, specwave, specres,
+                                specmask=None):
+        """Build (or retrieve from the cache) the sparse linear operators which
+        map rest-frame templates to the observed spectrum of a given object.
+
+        For each camera, the operator redshifts the templates (including the
+        luminosity distance and Lyman-series factors), rebins them onto the
+        observed wavelength array, applies the resolution matrix, and linearly
+        interpolates over the (dilated) masked pixels. All the templates
+        projected onto the same object can then be handled with a single
+        sparse matrix multiplication.
+
+        Parameters
+        ----------
+        templatewave : :class:`numpy.ndarray` [npix]
+            Rest-frame template wavelength array.
+        redshift : :class:`float`
+            Redshift.
+        specwave : :class:`list`
+            Per-camera observed-frame wavelength arrays.
+        specres : :class:`list`
+            Per-camera :class:`desispec.resolution.Resolution` matrices.
+        specmask : :class:`list`, optional, defaults to None
+            Per-camera pixel masks.
+
+        Returns
+        -------
+        :class:`dict`
+            Dictionary with the per-camera [nwave, npix]
+            :class:`scipy.sparse.csr_matrix` operators (key `cameras`) and the
+            same operators stacked over cameras (key `stacked`).
+
+        Notes
+        -----
+        The operators are cached on the identity of the input per-camera
+        arrays (which are kept alive by the cache) and the redshift, so they
+        are built only once per object and template wavelength grid.
+
+        """
+        from scipy.sparse import csr_matrix, diags, vstack
+        from scipy.ndimage import binary_dilation
+        from fastspecfit.util import trapz_rebin_weights
+
+        if specmask is None:
+            specmask = [None] * len(specwave)
+
+        key = (redshift, len(templatewave), templatewave[0], templatewave[-1],
+               tuple(id(x) for x in specwave), tuple(id(x) for x in specres),
+               tuple(id(x) for x in specmask))
+        if key in self._t2d_operators:
+            return self._t2d_operators[key]
+
+        npix = len(templatewave)
+        ztemplatewave, T = self.redshift_templatewave(templatewave, redshift)
+
+        operators = []
+        for icam in np.arange(len(specwave)):
+            # rebin onto the observed wavelengths (see smooth_and_resample)
+            trim = np.where((ztemplatewave > (specwave[icam].min()-10.0)) *
+                            (ztemplatewave < (specwave[icam].max()+10.0)))[0]
+            W = trapz_rebin_weights(ztemplatewave[trim], specwave[icam])
+            W = csr_matrix((W.data, W.indices + trim[0], W.indptr), shape=(W.shape[0], npix))
+
+            op = csr_matrix(specres[icam].dot(W))
+
+            # interpolate over pixels where the resolution matrix is masked
+            if specmask[icam] is not None and np.any(specmask[icam] != 0):
+                I = binary_dilation(specmask[icam] != 0, iterations=2)
+                maskwave = specwave[icam][I]
+                J = np.clip(np.searchsorted(ztemplatewave, maskwave, side='right'), 1, npix-1)
+                frac = (maskwave - ztemplatewave[J-1]) / (ztemplatewave[J] - ztemplatewave[J-1])
+                rows = np.repeat(np.where(I)[0], 2)
+                cols = np.vstack((J-1, J)).T.flatten()
+                vals = np.vstack((1.0 - frac, frac)).T.flatten()
+                interp = csr_matrix((vals, (rows, cols)), shape=op.shape)
+                op = diags((~I).astype('f8')).dot(op) + interp
+
+            op = csr_matrix(op.dot(diags(T)))
+            op.eliminate_zeros()
+            operators.append(op)
+
+        # Only ever keep the operators for a handful of template grids (i.e.,
+        # for the current object) around.
+        if len(self._t2d_operators) >= 8:
+            self._t2d_operators.clear()
+        self._t2d_operators[key] = {
+            'cameras': operators, 'stacked': csr_matrix(vstack(operators)),
+            'refs': (specwave, specres, specmask)}
+
+        return self._t2d_operators[key]
+
+    def broaden_templates(self, templateflux, templatewave, vdisp):
+        """Broaden the templates by the velocity dispersion, but only out to ~1
+        micron (where the pixel size of the templates changes).
+
+        Parameters
+        ----------
+        templateflux : :class:`numpy.ndarray` [npix, nmodel]
+            Rest-frame templates, which are not modified.
+        templatewave : :class:`numpy.ndarray` [npix]
+            Rest-frame wavelength array corresponding to `templateflux`.
+        vdisp : :class:`float`
+            Velocity dispersion [km/s].
+
+        Returns
+        -------
+        :class:`numpy.ndarray` [npix, nmodel]
+            Broadened templates.
+
+        """
+        nblue = np.searchsorted(templatewave, self.pixkms_wavesplit) # templatewave < pixkms_wavesplit
+        return np.concatenate((self.convolve_vdisp(templateflux[:nblue, :], vdisp),
+                               templateflux[nblue:, :]), axis=0)
+
+    def filter_weights(self, filters, wave, pad=False):
+        """Cached synthetic-photometry weights of a set of bandpasses on a given
+        wavelength grid; see :func:`fastspecfit.util.filter_weights`.
+
+        Parameters
+        ----------
+        filters : :class:`speclite.filters.FilterSequence`
+            Bandpasses.
+        wave : :class:`numpy.ndarray` [npix]
+            Wavelength array [Angstrom].
+        pad : :class:`bool`
+            Pad the spectra (with their edge values) to cover all the
+            bandpasses.
+
+        Returns
+        -------
+        :class:`numpy.ndarray` [nfilter, npix]
+            Weights W such that the maggies of an [npix, nmodel] array of
+            spectra are W.dot(flux).
+
+        """
+        import hashlib
+        from fastspecfit.util import filter_weights
+
+        wave = np.ascontiguousarray(wave, dtype=np.float64)
+        key = (tuple(filters.names), pad, len(wave), hashlib.sha1(wave).hexdigest())
+        if key not in self._filter_weights:
+            if len(self._filter_weights) >= 32:
+                self._filter_weights.clear()
+            self._filter_weights[key] = filter_weights(filters, wave, pad=pad)
+
+        return self._filter_weights[key]
+
+    def init_phot_lut(self, zmin=0.0, zmax=7.0, dz=0.002):
+        """Initialize the lookup table of template photometry versus redshift.
+
+        For both the south (DECam+WISE) and north (BASS/MzLS+WISE) filter sets,
+        tabulate the maggies of the nominal-vdisp templates on a regular
+        redshift grid, including the Lyman-series attenuation and the (1+z)
+        factor but not the luminosity distance, which is applied (exactly) in
+        `phot_lut_maggies`. The table is read from (or written to) the
+        template cache, if any; otherwise it is built in memory.
+
+        Parameters
+        ----------
+        zmin, zmax, dz : :class:`float`
+            Redshift grid of the lookup table. The grid stops short of `zmax`
+            if the redshifted templates no longer cover all the filters.
+
+        """
+        import hashlib
+        from fastspecfit.util import filter_weights
+
+        filtersets = {'south': self.decamwise, 'north': self.bassmzlswise}
+
+        # The redshifted templates must cover the blue end of every filter.
+        wavemin = np.min([filt.wavelength[0] for filters in filtersets.values() for filt in filters])
+        zmax = min(zmax, wavemin / self.templatewave[0] - 1.0)
+        zgrid = np.arange(zmin, zmax + 0.5 * dz, dz)
+        zgrid = zgrid[self.templatewave[0] * (1.0 + zgrid) < wavemin]
+
+        lutkey = None
+        if self.template_cachekey is not None:
+            from fastspecfit.io import read_template_cache, write_template_cache
+            sha = hashlib.sha1()
+            sha.update(repr((self.template_cachekey, 'phot_lut', zmin, zmax, dz)).encode())
+            for name in sorted(filtersets.keys()):
+                sha.update(repr(filtersets[name].names).encode())
+            lutkey = sha.hexdigest()
+            lut = read_template_cache(self.template_cache, lutkey)
+            if lut is not None:
+                self.phot_lut = lut
+                return
+
+        t0 = time.time()
+        lut = {'zgrid': zgrid}
+        for name in filtersets.keys():
+            lut[name] = np.zeros((len(zgrid), len(filtersets[name]), self.nsed))
+        for iz, redshift in enumerate(zgrid):
+            ztemplatewave = self.templatewave * (1.0 + redshift)
+            T = self.transmission_Lyman(redshift, ztemplatewave) / (1.0 + redshift)
+            for name, filters in filtersets.items():
+                W = filter_weights(filters, ztemplatewave)
+                lut[name][iz, :, :] = (W * T[np.newaxis, :]).dot(self.templateflux_nomvdisp)
+        self.log.info('Building the photometry lookup table with {} redshifts took {:.2f} seconds.'.format(
+            len(zgrid), time.time()-t0))
+
+        if lutkey is not None:
+            write_template_cache(self.template_cache, lutkey, lut, {'ZMIN': zmin, 'ZMAX': zmax, 'DZ': dz})
+        self.phot_lut = lut
+
+    def phot_lut_maggies(self, redshift, south=True):
+        """Interpolate the template photometry lookup table (see `init_phot_lut`).
+
+        Parameters
+        ----------
+        redshift : :class:`float` or :class:`numpy.ndarray` [nobj]
+            Redshift(s), which must be within the redshift grid of the table.
+        south : :class:`bool`
+            Use the DECaLS (True) or BASS/MzLS (False) filters.
+
+        Returns
+        -------
+        :class:`numpy.ndarray` [nband, nsed] or [nobj, nband, nsed]
+            Template maggies, equivalent to those synthesized by
+            `templates2data` at this redshift (or these redshifts).
+
+        """
+        zgrid = self.phot_lut['zgrid']
+        zz = np.atleast_1d(redshift)
+        bad = (zz <= 0.0) | (zz < zgrid[0]) | (zz > zgrid[-1])
+        if np.any(bad):
+            errmsg = 'Redshift {:.4f} is outside the photometry lookup table.'.format(zz[bad][0])
+            self.log.critical(errmsg)
+            raise ValueError(errmsg)
+
+        if south:
+            lut = self.phot_lut['south']
+        else:
+            lut = self.phot_lut['north']
+
+        iz = np.clip(np.searchsorted(zgrid, zz), 1, len(zgrid)-1)
+        frac = ((zz - zgrid[iz-1]) / (zgrid[iz] - zgrid[iz-1]))[:, np.newaxis, np.newaxis]
+        maggies = (1.0 - frac) * lut[iz-1, :, :] + frac * lut[iz, :, :]
+
+        dfactor = (10.0 / (1e6 * self.luminosity_distance(zz)))**2
+        maggies *= dfactor[:, np.newaxis, np.newaxis]
+
+        if np.ndim(redshift) == 0:
+            maggies = maggies[0, :, :]
+
+        return maggies
+
+    def synthesize_photometry(self, ztemplateflux, ztemplatewave, south=True, debug=False):
+        """Synthesize photometry from a set of observed-frame templates.
+
+        Parameters
+        ----------
+        ztemplateflux : :class:`numpy.ndarray` [npix, nmodel]
+            Redshifted (and normalized) templates; see `templates2data`.
+        ztemplatewave : :class:`numpy.ndarray` [npix]
+            Observed-frame wavelength array corresponding to `ztemplateflux`.
+        south : :class:`bool`
+            Use the DECaLS (True) or BASS/MzLS (False) filters.
+
+        Returns
+        -------
+        :class:`astropy.table.Table`
+            Synthesized photometry; see `parse_photometry`.
+
+        """
+        if south:
+            filters = self.decamwise
+        else:
+            filters = self.bassmzlswise
+        effwave = filters.effective_wavelengths.value
+
+        maggies = self.filter_weights(filters, ztemplatewave).dot(ztemplateflux) # [nfilter,nmodel]
+        maggies /= self.fluxnorm * self.massnorm
+
+        return self.parse_photometry(self.bands, maggies, effwave, nanomaggies=False, debug=debug)
+
     def templates2data(self, _templateflux, _templatewave, redshift=0.0, vdisp=None,
                        cameras=['b', 'r', 'z'], specwave=None, specres=None, 
                        specmask=None, coeff=None, south=True, synthphot=True, 
@@ -1216,12 +1599,15 @@ class ContinuumTools(TabulatedDESI):
         is organized (bug or feature?).
 
         """
-        from scipy.ndimage import binary_dilation
+
+        tall = time.time()
 
         # Are we dealing with a 2D grid [npix,nage] or a 3D grid
-        # [npix,nage,nAV] or [npix,nage,nvdisp]?
-        templateflux = _templateflux.copy() # why?!?
-        templatewave = _templatewave.copy() # why?!?
+        # [npix,nage,nAV] or [npix,nage,nvdisp]? Note that the input templates
+        # are never modified in place (and may be read-only), so they do not
+        # need to be copied.
+        templateflux = _templateflux
+        templatewave = _templatewave
         ndim = templateflux.ndim
         if ndim == 2:
             npix, nsed = templateflux.shape
@@ -1235,32 +1621,18 @@ class ContinuumTools(TabulatedDESI):
             self.log.critical(errmsg)
             raise ValueError(errmsg)
         
-        #t0 = time.time()
-        ##templateflux = templateflux.copy().reshape(npix, nmodel)
-        #self.log.info('Copying the data took {:.2f} seconds.'.format(time.time()-t0))
-
         # broaden for velocity dispersion but only out to ~1 micron
         if vdisp is not None:
-            #templateflux = self.convolve_vdisp(templateflux, vdisp)
-            I = np.where(templatewave < self.pixkms_wavesplit)[0]
-            templateflux[I, :] = self.convolve_vdisp(templateflux[I, :], vdisp)
+            templateflux = self.broaden_templates(templateflux, templatewave, vdisp)
 
         # Apply the redshift factor. The models are normalized to 10 pc, so
         # apply the luminosity distance factor here. Also normalize to a nominal
-        # stellar mass.
-        if redshift:
-            ztemplatewave = templatewave * (1.0 + redshift)
-            dfactor = (10.0 / (1e6 * self.luminosity_distance(redshift)))**2
-            #dfactor = (10.0 / self.cosmo.luminosity_distance(redshift).to(u.pc).value)**2
-            #dfactor = (10.0 / np.interp(redshift, self.redshift_ref, self.dlum_ref))**2
-            T = self.transmission_Lyman(redshift, ztemplatewave)
-            T *= self.fluxnorm * self.massnorm * dfactor / (1.0 + redshift)
+        # stellar mass. When projecting onto the data, these factors are folded
+        # into the (cached) per-object operator, so we only need the redshifted
+        # templates themselves for the photometry and the no-resolution case.
+        if synthphot or specwave is None:
+            ztemplatewave, T = self.redshift_templatewave(templatewave, redshift)
             ztemplateflux = templateflux * T[:, np.newaxis]
-        else:
-            errmsg = 'Input redshift not defined or equal to zero!'
-            self.log.warning(errmsg)
-            ztemplatewave = templatewave.copy() # ???
-            ztemplateflux = self.fluxnorm * self.massnorm * templateflux
 
         # Optionally synthesize photometry.
         templatephot = None
@@ -1273,64 +1645,39 @@ class ContinuumTools(TabulatedDESI):
 
             if ((specwave is None and specres is None and coeff is None) or
                (specwave is not None and specres is not None)):
-                #t0 = time.time()
-                maggies = filters.get_ab_maggies(ztemplateflux, ztemplatewave, axis=0) # speclite.filters wants an [nmodel,npix] array
-                maggies = np.vstack(maggies.as_array().tolist()).T
-                maggies /= self.fluxnorm * self.massnorm
-                templatephot = self.parse_photometry(self.bands, maggies, effwave, nanomaggies=False, debug=debug)
-                #self.log.info('Synthesizing photometry took {:.2f} seconds.'.format(time.time()-t0))
+                templatephot = self.synthesize_photometry(ztemplateflux, ztemplatewave,
+                                                          south=south, debug=debug)
 
         # Are we returning per-camera spectra or a single model? Handle that here.
         if specwave is None and specres is None:
-            datatemplateflux = []
-            for imodel in np.arange(nmodel):
-                datatemplateflux.append(self.smooth_and_resample(ztemplateflux[:, imodel], ztemplatewave))
-            datatemplateflux = np.vstack(datatemplateflux).T
+            datatemplateflux = self.smooth_and_resample(ztemplateflux, ztemplatewave)
 
             # optionally compute the best-fitting model
             if coeff is not None:
                 datatemplateflux = datatemplateflux.dot(coeff)
                 if synthphot:
-                    maggies = filters.get_ab_maggies(datatemplateflux, ztemplatewave, axis=0)
-                    maggies = np.array(maggies.as_array().tolist()[0])
+                    maggies = self.filter_weights(filters, ztemplatewave).dot(datatemplateflux)
                     maggies /= self.fluxnorm * self.massnorm
                     templatephot = self.parse_photometry(self.bands, maggies, effwave, nanomaggies=False)
         else:
-            # loop over cameras
-            datatemplateflux = []
-            nwavepix = len(np.hstack(specwave))
-            for icamera in np.arange(len(cameras)): # iterate on cameras
-                _datatemplateflux = []
-                for imodel in np.arange(nmodel):
-                    #if icamera == 2:
-                    #    b1 = self.smooth_and_resample(ztemplateflux[:, imodel], ztemplatewave, specwave=specwave[icamera])#, specres=specres[icamera])
-                    #    b2 = self.smooth_and_resample(ztemplateflux[:, imodel], ztemplatewave, specwave=specwave[icamera], specres=specres[icamera])
-                    #    import matplotlib.pyplot as plt
-                    #
-                    #    I = np.where((specwave[icamera] > 9000) * (specwave[icamera] < 9300))[0]
-                    #    plt.clf()
-                    #    plt.plot(specwave[icamera], b2, color='blue')
-                    #    plt.plot(specwave[icamera], b1, color='red')
-                    #    plt.savefig('junk.png')
-                    #    pdb.set_trace()
-                    resampflux = self.smooth_and_resample(ztemplateflux[:, imodel], ztemplatewave, 
-                                                          specwave=specwave[icamera],
-                                                          specres=specres[icamera])
-                    # interpolate over pixels where the resolution matrix is masked
-                    if specmask is not None and np.any(specmask[icamera] != 0):
-                        I = binary_dilation(specmask[icamera] != 0, iterations=2)
-                        resampflux[I] = np.interp(specwave[icamera][I], ztemplatewave, ztemplateflux[:, imodel])
-                    _datatemplateflux.append(resampflux)
-                _datatemplateflux = np.vstack(_datatemplateflux).T
-                if coeff is not None:
-                    _datatemplateflux = _datatemplateflux.dot(coeff)
-                datatemplateflux.append(_datatemplateflux)
+            # redshift, resample, smooth, and interpolate over masked pixels
+            # with a single sparse matrix multiplication per camera
+            operators = self.templates2data_operator(templatewave, redshift, specwave,
+                                                     specres, specmask)
+            # optionally compute the best-fitting model (before projecting)
+            if coeff is not None:
+                templateflux = templateflux.dot(coeff)
 
             # Optionally stack and reshape (used in fitting).
             if stack_cameras:
-                datatemplateflux = np.concatenate(datatemplateflux, axis=0)  # [npix,nsed*nprop] or [npix,nsed]
+                datatemplateflux = operators['stacked'].dot(templateflux) # [npix,nsed*nprop] or [npix,nsed]
                 if ndim == 3:
+                    nwavepix = datatemplateflux.shape[0]
                     datatemplateflux = datatemplateflux.reshape(nwavepix, nsed, nprop) # [npix,nsed,nprop]
+            else:
+                datatemplateflux = [op.dot(templateflux) for op in operators['cameras']]
+
+        self.timer.add('TEMPLATES2DATA', time.time()-tall)
                 
         return datatemplateflux, templatephot # vector or 3-element list of [npix,nmodel] spectra
 
@@ -1357,6 +1704,19 @@ class ContinuumTools(TabulatedDESI):
         
         return meanvalue
 
+    def _agekeep_bins(self):
+        """Cache the (sorted) unique template ages and, for each number of
+        them younger than a given age, the indices and mask of the templates.
+
+        """
+        if self._agekeep is None:
+            age = np.asarray(self.templateinfo['age'])
+            agebins = np.unique(age)
+            keepmask = np.vstack([np.zeros(len(age), bool)] + [age <= agebin for agebin in agebins])
+            keep = [np.where(mask)[0] for mask in keepmask]
+            self._agekeep = (agebins, keep, keepmask)
+        return self._agekeep
+
     def younger_than_universe(self, redshift, agepad=0.5):
         """Return the indices of the templates younger than the age of the universe
         (plus an agepadding amount) at the given redshift.
@@ -1364,126 +1724,162 @@ class ContinuumTools(TabulatedDESI):
         agepad in Gyr
 
         """
-        return np.where(self.templateinfo['age'] <= 1e9 * (agepad + self.universe_age(redshift)))[0]
+        agebins, keep, _ = self._agekeep_bins()
+        return keep[np.searchsorted(agebins, 1e9 * (agepad + self.universe_age(redshift)), side='right')]
         #return np.where(self.templateinfo['age'] <= (agepad*1e9 + self.cosmo.age(redshift).to(u.year).value))[0]
 
-    def kcorr_and_absmag(self, data, continuum, coeff, snrmin=2.0):
-        """Computer K-corrections, absolute magnitudes, and a simple stellar mass.
+    def younger_than_universe_mask(self, redshift, agepad=0.5):
+        """Vectorized version of `younger_than_universe`.
 
-        """
-        from scipy.stats import sigmaclip
-        from scipy.ndimage import median_filter
-        
-        redshift = data['zredrock']
-        
-        if data['photsys'] == 'S':
-            filters_in = self.decamwise
-        else:
-            filters_in = self.bassmzlswise
-        lambda_in = filters_in.effective_wavelengths.value
+        Parameters
+        ----------
+        redshift : :class:`numpy.ndarray` [nobj]
+            Redshifts.
+        agepad : :class:`float`
+            Age padding [Gyr].
 
-        # redshifted wavelength array and distance modulus
-        ztemplatewave = self.templatewave * (1 + redshift)
-        dmod = self.distance_modulus(redshift)
-        #dmod = self.cosmo.distmod(redshift).value
+        Returns
+        -------
+        :class:`numpy.ndarray` [nobj, nsed]
+            Boolean mask of the templates younger than the age of the
+            universe (plus `agepad`) at each redshift.
 
-        maggies = data['phot']['nanomaggies'].data * 1e-9
-        ivarmaggies = (data['phot']['nanomaggies_ivar'].data / 1e-9**2) * self.bands_to_fit # mask W2-W4
+        """
+        agebins, _, keepmask = self._agekeep_bins()
+        return keepmask[np.searchsorted(agebins, 1e9 * (agepad + self.universe_age(redshift)), side='right'), :]
 
-        # input bandpasses, observed frame; maggies and bestmaggies should be
-        # very close.
-        bestmaggies = filters_in.get_ab_maggies(continuum / self.fluxnorm, ztemplatewave)
-        bestmaggies = np.array(bestmaggies.as_array().tolist()[0])
+    def kcorr_weights(self):
+        """Cached, redshift-independent ingredients of `kcorr_and_absmag`.
 
-        # need to handle filters with band_shift!=0 separately from those with band_shift==0
-        def _kcorr_and_absmag(filters_out, band_shift):
-            nout = len(filters_out)
+        The rest-frame (band-shifted) synthetic-photometry weights of the
+        absolute-magnitude bandpasses and the pixel windows around the
+        continuum wavelengths only depend on `self.templatewave`, so they are
+        computed once (and only for the pixels which matter).
 
-            # note the factor of 1+band_shift
-            lambda_out = filters_out.effective_wavelengths.value / (1 + band_shift)
+        Returns
+        -------
+        :class:`dict`
+            With keys `absmag`, a list (one per band_shift) of dictionaries
+            with the mask `I` of the corresponding `self.absmag_bands`, the
+            `band_shift`, the band-shifted effective wavelengths `lambda_out`,
+            the pixels `pix` of `self.templatewave` within the bandpasses, and
+            the weights `W` [nout, len(pix)]; and `cflux`, a dictionary of
+            (cwave, J, rows) tuples, where J are the pixels within 500 A of
+            cwave and rows the indices in J within 20 A of cwave.
 
-            # Multiply by (1+z) to convert the best-fitting model to the "rest
-            # frame" and then divide by 1+band_shift to shift it and the
-            # wavelength vector to the band-shifted redshift. Also need one more
-            # factor of 1+band_shift in order maintain the AB mag normalization.
-            synth_outmaggies_rest = filters_out.get_ab_maggies(continuum * (1 + redshift) / (1 + band_shift) /
-                                                               self.fluxnorm, self.templatewave * (1 + band_shift))
-            synth_outmaggies_rest = np.array(synth_outmaggies_rest.as_array().tolist()[0]) / (1 + band_shift)
-    
-            # output bandpasses, observed frame
-            synth_outmaggies_obs = filters_out.get_ab_maggies(continuum / self.fluxnorm, ztemplatewave)
-            synth_outmaggies_obs = np.array(synth_outmaggies_obs.as_array().tolist()[0])
-    
-            absmag = np.zeros(nout, dtype='f4')
-            ivarabsmag = np.zeros(nout, dtype='f4')
-            kcorr = np.zeros(nout, dtype='f4')
-            for jj in np.arange(nout):
-                lambdadist = np.abs(lambda_in / (1 + redshift) - lambda_out[jj])
-                # K-correct from the nearest "good" bandpass (to minimizes the K-correction)
-                #oband = np.argmin(lambdadist)
-                #oband = np.argmin(lambdadist + (ivarmaggies == 0)*1e10)
-                oband = np.argmin(lambdadist + (maggies*np.sqrt(ivarmaggies) < snrmin)*1e10)
-                kcorr[jj] = + 2.5 * np.log10(synth_outmaggies_rest[jj] / bestmaggies[oband])
-
-                # m_R = M_Q + DM(z) + K_QR(z) or
-                # M_Q = m_R - DM(z) - K_QR(z)
-                if maggies[oband] * np.sqrt(ivarmaggies[oband]) > snrmin:
-                #if (maggies[oband] > 0) and (ivarmaggies[oband]) > 0:
-                    absmag[jj] = -2.5 * np.log10(maggies[oband]) - dmod - kcorr[jj]
-                    ivarabsmag[jj] = maggies[oband]**2 * ivarmaggies[oband] * (0.4 * np.log(10.))**2
-                else:
-                    # if we use synthesized photometry then ivarabsmag is zero
-                    # (which should never happen?)
-                    absmag[jj] = -2.5 * np.log10(synth_outmaggies_rest[jj]) - dmod
+        """
+        from fastspecfit.util import filter_weights
+
+        if self._kcorr_weights is None:
+            absmag = []
+            for bands, filters_out, band_shift in zip((self.absmag_bands_01, self.absmag_bands_00),
+                                                      (self.absmag_filters_01, self.absmag_filters_00),
+                                                      (0.1, 0.0)):
+                W = filter_weights(filters_out, self.templatewave * (1 + band_shift))
+                pix = np.where(np.any(W != 0, axis=0))[0]
+                absmag.append({'I': np.isin(self.absmag_bands, bands), 'band_shift': band_shift,
+                               # note the factor of 1+band_shift
+                               'lambda_out': filters_out.effective_wavelengths.value / (1 + band_shift),
+                               'pix': pix, 'W': np.ascontiguousarray(W[:, pix])})
+
+            cflux = {}
+            cwaves = [1500.0, 2800.0, 5100.0, 3728.483, 4862.683, 5008.239, 6564.613]
+            labels = ['LOGLNU_1500', 'LOGLNU_2800', 'LOGL_5100', 'FOII_3727_CONT', 'FHBETA_CONT',
+                      'FOIII_5007_CONT', 'FHALPHA_CONT']
+            for cwave, label in zip(cwaves, labels):
+                J = np.where((self.templatewave > cwave-500) * (self.templatewave < cwave+500))[0]
+                rows = np.where((self.templatewave[J] > cwave-20) * (self.templatewave[J] < cwave+20))[0]
+                cflux[label] = (cwave, J, rows)
+
+            self._kcorr_weights = {'absmag': absmag, 'cflux': cflux}
+
+        return self._kcorr_weights
+
+    def _kcorr_and_absmag(self, redshift, maggies, ivarmaggies, lambda_in, bestmaggies,
+                          model, snrmin=2.0):
+        """Array engine behind `kcorr_and_absmag` and `kcorr_and_absmag_batch`.
 
-                #check = absmag[jj], -2.5*np.log10(synth_outmaggies_rest[jj]) - dmod
-                #self.log.debug(check)
+        Parameters
+        ----------
+        redshift : :class:`numpy.ndarray` [nobj]
+            Redshifts (all greater than zero).
+        maggies, ivarmaggies, lambda_in, bestmaggies : :class:`numpy.ndarray` [nobj, nband]
+            Observed photometry and inverse variance (with the unfit bands
+            masked), effective wavelengths of the input bandpasses, and
+            photometry synthesized from the best-fitting model.
+        model : callable
+            Function which, given indices `pix` into `self.templatewave`,
+            returns the [len(pix), nobj] best-fitting (observed-frame) models
+            on those pixels [10**-17 erg/s/cm2/A].
+        snrmin : :class:`float`
+            Minimum S/N of the bandpass to K-correct from.
 
-            return kcorr, absmag, ivarabsmag
+        Returns
+        -------
+        kcorr, absmag, ivarabsmag : :class:`numpy.ndarray` [nobj, nabsmag]
+            K-corrections, absolute magnitudes, and inverse variances in
+            `self.absmag_bands`.
+        lums, cfluxes : :class:`dict`
+            Continuum luminosities (linear, not logarithmic) and fluxes, each
+            an [nobj] array.
 
-        kcorr_01, absmag_01, ivarabsmag_01 = _kcorr_and_absmag(self.absmag_filters_01, band_shift=0.1)
-        kcorr_00, absmag_00, ivarabsmag_00 = _kcorr_and_absmag(self.absmag_filters_00, band_shift=0.0)
+        """
+        from fastspecfit.util import median_filter_rows, sigmaclip_median
 
-        nout = len(self.absmag_bands)
-        kcorr = np.zeros(nout, dtype='f4')
-        absmag = np.zeros(nout, dtype='f4')
-        ivarabsmag = np.zeros(nout, dtype='f4')
+        weights = self.kcorr_weights()
 
-        I00 = np.isin(self.absmag_bands, self.absmag_bands_00)
-        I01 = np.isin(self.absmag_bands, self.absmag_bands_01)
+        nobj = len(redshift)
+        rows = np.arange(nobj)[:, np.newaxis]
+        dmod = self.distance_modulus(redshift)
+        dlum = self.luminosity_distance(redshift)
+        snr = maggies * np.sqrt(ivarmaggies)
 
-        kcorr[I00] = kcorr_00
-        absmag[I00] = absmag_00
-        ivarabsmag[I00] = ivarabsmag_00
+        nout = len(self.absmag_bands)
+        kcorr = np.zeros((nobj, nout), dtype='f4')
+        absmag = np.zeros((nobj, nout), dtype='f4')
+        ivarabsmag = np.zeros((nobj, nout), dtype='f4')
 
-        kcorr[I01] = kcorr_01
-        absmag[I01] = absmag_01
-        ivarabsmag[I01] = ivarabsmag_01
+        # need to handle filters with band_shift!=0 separately from those with band_shift==0
+        for shifted in weights['absmag']:
+            I, band_shift, lambda_out = shifted['I'], shifted['band_shift'], shifted['lambda_out']
 
-        nage = len(coeff)
-        
-        # From Taylor+11, eq 8
-        #mstar = self.templateinfo['mstar'][:nage].dot(coeff) * self.massnorm
-        #https://researchportal.port.ac.uk/ws/files/328938/MNRAS_2011_Taylor_1587_620.pdf
-        #mstar = 1.15 + 0.7*(absmag[1]-absmag[3]) - 0.4*absmag[3]
+            # Multiply by (1+z) to convert the best-fitting model to the "rest
+            # frame" and then divide by 1+band_shift to shift it and the
+            # wavelength vector to the band-shifted redshift. Also need one more
+            # factor of 1+band_shift in order maintain the AB mag normalization.
+            synth_outmaggies_rest = (shifted['W'].dot(model(shifted['pix'])).T * (1 + redshift[:, np.newaxis]) /
+                                     (1 + band_shift)**2 / self.fluxnorm)
+
+            # K-correct from the nearest "good" bandpass (to minimize the K-correction)
+            lambdadist = np.abs(lambda_in[:, :, np.newaxis] / (1 + redshift[:, np.newaxis, np.newaxis]) -
+                                lambda_out[np.newaxis, np.newaxis, :]) # [nobj,nband,nout]
+            oband = np.argmin(lambdadist + (snr < snrmin)[:, :, np.newaxis]*1e10, axis=1) # [nobj,nout]
+
+            # m_R = M_Q + DM(z) + K_QR(z) or
+            # M_Q = m_R - DM(z) - K_QR(z)
+            # if we use synthesized photometry then ivarabsmag is zero
+            with np.errstate(divide='ignore', invalid='ignore'):
+                kcorr[:, I] = + 2.5 * np.log10(synth_outmaggies_rest / bestmaggies[rows, oband])
+                detected = snr[rows, oband] > snrmin
+                absmag[:, I] = np.where(detected, -2.5 * np.log10(maggies[rows, oband]) - dmod[:, np.newaxis] - kcorr[:, I],
+                                        -2.5 * np.log10(synth_outmaggies_rest) - dmod[:, np.newaxis])
+            ivarabsmag[:, I] = np.where(detected, maggies[rows, oband]**2 * ivarmaggies[rows, oband] *
+                                        (0.4 * np.log(10.))**2, 0.0)
 
         # compute the model continuum flux at 1500 and 2800 A (to facilitate UV
         # luminosity-based SFRs) and at the positions of strong nebular emission
         # lines [OII], Hbeta, [OIII], and Halpha
-        #dfactor = (1 + redshift) * 4.0 * np.pi * self.cosmo.luminosity_distance(redshift).to(u.cm).value**2 / self.fluxnorm
-        dfactor = (1 + redshift) * 4.0 * np.pi * (3.08567758e24 * self.luminosity_distance(redshift))**2 / self.fluxnorm
-                
+        cfluxes = {}
+        for label, (cwave, J, I) in weights['cflux'].items():
+            smooth = median_filter_rows(model(J), I, size=200)
+            cfluxes[label] = sigmaclip_median(smooth, low=1.5, high=3) # [flux in 10**-17 erg/s/cm2/A]
+
+        dfactor = (1 + redshift) * 4.0 * np.pi * (3.08567758e24 * dlum)**2 / self.fluxnorm
+
         lums = {}
-        cwaves = [1500.0, 2800.0, 5100.0]
-        labels = ['LOGLNU_1500', 'LOGLNU_2800', 'LOGL_5100']
-        norms = [1e28, 1e28, 1e10]
-        for cwave, norm, label in zip(cwaves, norms, labels):
-            J = (self.templatewave > cwave-500) * (self.templatewave < cwave+500)
-            I = (self.templatewave[J] > cwave-20) * (self.templatewave[J] < cwave+20)
-            smooth = median_filter(continuum[J], 200)
-            clipflux, _, _ = sigmaclip(smooth[I], low=1.5, high=3)
-            cflux = np.median(clipflux) # [flux in 10**-17 erg/s/cm2/A]
-            cflux *= dfactor # [monochromatic luminosity in erg/s/A]
+        for label, norm in zip(['LOGLNU_1500', 'LOGLNU_2800', 'LOGL_5100'], [1e28, 1e28, 1e10]):
+            cwave = weights['cflux'][label][0]
+            cflux = cfluxes.pop(label) * dfactor # [monochromatic luminosity in erg/s/A]
             if label == 'LOGL_5100':
                 cflux *= cwave / 3.846e33 / norm # [luminosity in 10**10 L_sun]
             else:
@@ -1491,30 +1887,115 @@ class ContinuumTools(TabulatedDESI):
                 # luminosity can be converted into a SFR using, e.g., Kennicutt+98,
                 # SFR=1.4e-28 * L_UV
                 cflux *= cwave**2 / (C_LIGHT * 1e13) / norm # [monochromatic luminosity in 10**(-28) erg/s/Hz]
-            if cflux > 0:
-                lums[label] = np.log10(cflux) # * u.erg/(u.second*u.Hz)
+            lums[label] = cflux
 
-        cfluxes = {}
-        cwaves = [3728.483, 4862.683, 5008.239, 6564.613]
-        labels = ['FOII_3727_CONT', 'FHBETA_CONT', 'FOIII_5007_CONT', 'FHALPHA_CONT']
-        for cwave, label in zip(cwaves, labels):
-            J = (self.templatewave > cwave-500) * (self.templatewave < cwave+500)
-            I = (self.templatewave[J] > cwave-20) * (self.templatewave[J] < cwave+20)
-            smooth = median_filter(continuum[J], 200)
-            clipflux, _, _ = sigmaclip(smooth[I], low=1.5, high=3)
-            cflux = np.median(clipflux) # [flux in 10**-17 erg/s/cm2/A]
-            cfluxes[label] = cflux # * u.erg/(u.second*u.cm**2*u.Angstrom)
-            
-            #import matplotlib.pyplot as plt
-            #print(cwave, cflux)
-            #plt.clf()
-            #plt.plot(self.templatewave[J], continuum[J])
-            #plt.plot(self.templatewave[J], smooth, color='k')
-            #plt.axhline(y=cflux, color='red')
-            #plt.axvline(x=cwave, color='red')
-            #plt.xlim(cwave - 50, cwave + 50)
-            #plt.savefig('junk.png')
-            ##plt.savefig('desi-users/ioannis/tmp/junk.png')
-            #pdb.set_trace()
-
-        return kcorr, absmag, ivarabsmag, bestmaggies, lums, cfluxes
+        return kcorr, absmag, ivarabsmag, lums, cfluxes
+
+    def kcorr_and_absmag(self, data, continuum, coeff, snrmin=2.0):
+        """Computer K-corrections, absolute magnitudes, and a simple stellar mass.
+
+        """
+        redshift = data['zredrock']
+        
+        if data['photsys'] == 'S':
+            filters_in = self.decamwise
+        else:
+            filters_in = self.bassmzlswise
+        lambda_in = filters_in.effective_wavelengths.value
+
+        maggies = data['phot']['nanomaggies'].data * 1e-9
+        ivarmaggies = (data['phot']['nanomaggies_ivar'].data / 1e-9**2) * self.bands_to_fit # mask W2-W4
+
+        # input bandpasses, observed frame; maggies and bestmaggies should be
+        # very close.
+        bestmaggies = self.filter_weights(filters_in, self.templatewave * (1 + redshift)).dot(continuum / self.fluxnorm)
+
+        # From Taylor+11, eq 8
+        #mstar = self.templateinfo['mstar'][:nage].dot(coeff) * self.massnorm
+        #https://researchportal.port.ac.uk/ws/files/328938/MNRAS_2011_Taylor_1587_620.pdf
+        #mstar = 1.15 + 0.7*(absmag[1]-absmag[3]) - 0.4*absmag[3]
+
+        kcorr, absmag, ivarabsmag, _lums, cfluxes = self._kcorr_and_absmag(
+            np.atleast_1d(redshift), maggies[np.newaxis, :], ivarmaggies[np.newaxis, :],
+            lambda_in[np.newaxis, :], bestmaggies[np.newaxis, :],
+            lambda pix: continuum[pix, np.newaxis], snrmin=snrmin)
+
+        lums = {}
+        for label, cflux in _lums.items():
+            if cflux[0] > 0:
+                lums[label] = np.log10(cflux[0]) # * u.erg/(u.second*u.Hz)
+        cfluxes = {label: cflux[0] for label, cflux in cfluxes.items()} # * u.erg/(u.second*u.cm**2*u.Angstrom)
+
+        return kcorr[0, :], absmag[0, :], ivarabsmag[0, :], bestmaggies, lums, cfluxes
+
+    def kcorr_and_absmag_batch(self, redshift, nanomaggies, ivarnanomaggies, south,
+                               coeff, bestmaggies, templateflux=None, snrmin=2.0):
+        """Compute K-corrections, absolute magnitudes, and continuum luminosities
+        and fluxes for a batch of objects.
+
+        Array version of `kcorr_and_absmag` for models which are linear
+        combinations of the (rest-frame) templates, as in `fastphot`.
+
+        Parameters
+        ----------
+        redshift : :class:`numpy.ndarray` [nobj]
+            Redshifts (all greater than zero).
+        nanomaggies, ivarnanomaggies : :class:`numpy.ndarray` [nobj, nband]
+            Observed photometry and inverse variance in `self.bands`.
+        south : :class:`numpy.ndarray` [nobj]
+            Boolean mask of the objects with DECaLS (rather than BASS/MzLS)
+            photometry.
+        coeff : :class:`numpy.ndarray` [nobj, nsed]
+            Coefficients of the best-fitting model.
+        bestmaggies : :class:`numpy.ndarray` [nobj, nband]
+            Photometry (in maggies) synthesized from the best-fitting model.
+        templateflux : :class:`numpy.ndarray` [npix, nsed], optional
+            Templates corresponding to `coeff`. Defaults to
+            `self.templateflux_nomvdisp`.
+
+        Returns
+        -------
+        kcorr, absmag, ivarabsmag : :class:`numpy.ndarray` [nobj, nabsmag]
+            K-corrections, absolute magnitudes, and inverse variances in
+            `self.absmag_bands`.
+        lums, cfluxes : :class:`dict`
+            Luminosities and continuum fluxes, each an [nobj] array, with
+            the same keys as the dictionaries returned by `kcorr_and_absmag`
+            (undefined luminosities are zero).
+
+        """
+        if templateflux is None:
+            templateflux = self.templateflux_nomvdisp
+
+        lambda_in = np.where(south[:, np.newaxis], self.decamwise.effective_wavelengths.value,
+                             self.bassmzlswise.effective_wavelengths.value)
+
+        maggies = nanomaggies.astype('f4') * 1e-9
+        ivarmaggies = (ivarnanomaggies.astype('f4') / 1e-9**2) * self.bands_to_fit # mask W2-W4
+
+        # Factor which converts the rest-frame templates to the observed frame
+        # (see `redshift_templatewave`) and the Lyman-series attenuation on
+        # the blue side of Lyman-alpha (the only pixels which need it).
+        dlum = self.luminosity_distance(redshift)
+        scale = self.fluxnorm * self.massnorm * (10.0 / (1e6 * dlum))**2 / (1.0 + redshift)
+        lyaline = np.max([Lyman_series[line]['line'] for line in Lyman_series.keys()])
+        lya = self.templatewave < lyaline
+
+        def _observed_model(pix):
+            # [npix, nobj] best-fitting models on a subset of templatewave pixels
+            model = templateflux[pix, :].dot(coeff.T) * scale[np.newaxis, :]
+            if np.any(lya[pix]):
+                restwave = self.templatewave[pix]
+                model *= self.transmission_Lyman(redshift[:, np.newaxis], restwave[np.newaxis, :] *
+                                                 (1.0 + redshift[:, np.newaxis])).T
+            return model
+
+        kcorr, absmag, ivarabsmag, lums, cfluxes = self._kcorr_and_absmag(
+            redshift, maggies, ivarmaggies, lambda_in, bestmaggies, _observed_model, snrmin=snrmin)
+
+        for label, cflux in lums.items():
+            lums[label] = np.zeros(len(redshift))
+            good = cflux > 0
+            lums[label][good] = np.log10(cflux[good])
+
+        return kcorr, absmag, ivarabsmag, lums, cfluxes
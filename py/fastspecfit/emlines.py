@@ -7,12 +7,14 @@ Methods and tools for fitting emission lines.
 """
 import pdb # for debugging
 
-import os, time
+import os, time, math
 import numpy as np
 import numba
 
 from astropy.table import Table, Column
 
+from fastspecfit.util import C_LIGHT, centers2edges
+
 def read_emlines():
     """Read the set of emission lines of interest.
 
@@ -24,57 +26,182 @@ def read_emlines():
     
     return linetable    
 
-#@numba.jit(nopython=True)
+@numba.jit(nopython=True)
+def _build_emline_model(log10wave, redshift, lineamps, linevshifts, linesigmas,
+                        linewaves, edges, results):
+    '''
+    Numba kernel of build_emline_model for one camera.
+
+    Each line is evaluated on `log10wave` only within +/-8-sigma of its
+    center and its (piecewise-linear) profile is integrated directly into the
+    overlapping bins defined by `edges`, which is equivalent to trapezoidally
+    rebinning (see util._trapz_rebin) the sum of the lines on the full
+    `log10wave` grid. `results` is a pre-allocated array of length
+    len(edges)-1 which accumulates the integrals (not yet divided by the
+    bin widths).
+    '''
+    nwave = len(log10wave)
+    nbin = len(edges) - 1
+    ln10 = np.log(10)
+
+    # range of log10wave (conservatively) covered by this camera
+    jmin = max(np.searchsorted(log10wave, np.log10(edges[0])) - 2, 0)
+    jmax = min(np.searchsorted(log10wave, np.log10(edges[nbin])) + 2, nwave - 1)
+
+    for iline in range(len(lineamps)):
+        lineamp = lineamps[iline]
+
+        # line-width [log-10 Angstrom] and redshifted wavelength [log-10 Angstrom]
+        log10sigma = linesigmas[iline] / C_LIGHT / ln10
+        if log10sigma <= 0:
+            continue
+        linezwave = np.log10(linewaves[iline] * (1.0 + redshift + linevshifts[iline] / C_LIGHT))
+        gnorm = 0.5 / log10sigma**2
+
+        # pixels within +/-N-sigma, j0 <= j < j1
+        j0 = np.searchsorted(log10wave, linezwave - 8 * log10sigma, side='right')
+        j1 = np.searchsorted(log10wave, linezwave + 8 * log10sigma, side='left')
+        if j1 <= j0:
+            continue
+
+        # The interpolated profile is non-zero from jlo to jhi; integrate it
+        # one segment at a time, splitting each segment at the bin edges.
+        jlo = max(j0 - 1, jmin)
+        jhi = min(j1, jmax)
+        if jhi <= jlo:
+            continue
+
+        xa = np.exp(ln10 * log10wave[jlo])
+        if jlo < j0:
+            ya = 0.0
+        else:
+            ya = lineamp * np.exp(-gnorm * (log10wave[jlo]-linezwave)**2)
+
+        # bin containing xa (-1 if below the first edge, nbin if above the last)
+        i = np.searchsorted(edges, xa, side='right') - 1
+
+        for j in range(jlo, jhi):
+            xb = np.exp(ln10 * log10wave[j+1])
+            if j+1 < j1:
+                yb = lineamp * np.exp(-gnorm * (log10wave[j+1]-linezwave)**2)
+            else:
+                yb = 0.0
+
+            xlo, ylo = xa, ya
+            while i < nbin:
+                xedge = edges[i+1]
+                if xedge < xb:
+                    xhi = xedge
+                    yhi = ya + (xedge - xa) * (yb - ya) / (xb - xa)
+                else:
+                    xhi, yhi = xb, yb
+                if i >= 0:
+                    results[i] += 0.5 * (ylo + yhi) * (xhi - xlo)
+                if xedge > xb:
+                    break
+                xlo, ylo = xhi, yhi
+                i += 1
+
+            xa, ya = xb, yb
+
+    return
+
+@numba.jit(nopython=True)
+def _build_emline_model_integrated(redshift, lineamps, linevshifts, linesigmas,
+                                   linewaves, edges, results):
+    '''
+    Like _build_emline_model, but each line (a Gaussian in log-wavelength) is
+    integrated analytically, as a difference of error functions, over the
+    pixels defined by `edges` within +/-8-sigma of its center, so no fine
+    wavelength grid is needed.
+    '''
+    nbin = len(edges) - 1
+    ln10 = np.log(10)
+
+    for iline in range(len(lineamps)):
+        log10sigma = linesigmas[iline] / C_LIGHT / ln10
+        if log10sigma <= 0:
+            continue
+        linezwave = linewaves[iline] * (1.0 + redshift + linevshifts[iline] / C_LIGHT)
+        log10zwave = np.log10(linezwave)
+
+        # pixels overlapping +/-N-sigma, k0 <= k < k1
+        k0 = max(np.searchsorted(edges, 10**(log10zwave - 8 * log10sigma), side='right') - 1, 0)
+        k1 = min(np.searchsorted(edges, 10**(log10zwave + 8 * log10sigma), side='left'), nbin)
+        if k1 <= k0:
+            continue
+
+        # With u=log10(wave), amp*exp(-0.5*(u-log10zwave)**2/log10sigma**2)*d(wave) =
+        # norm*exp(-0.5*(u-ucenter)**2/log10sigma**2)*du, whose integral is an erf.
+        ucenter = log10zwave + ln10 * log10sigma**2
+        norm = (lineamps[iline] * ln10 * linezwave * np.exp(0.5 * (ln10 * log10sigma)**2) *
+                np.sqrt(np.pi / 2) * log10sigma)
+        scale = 1.0 / (np.sqrt(2.0) * log10sigma)
+
+        erflo = math.erf((np.log10(edges[k0]) - ucenter) * scale)
+        for k in range(k0, k1):
+            erfhi = math.erf((np.log10(edges[k+1]) - ucenter) * scale)
+            results[k] += norm * (erfhi - erflo)
+            erflo = erfhi
+
+    return
+
 def build_emline_model(log10wave, redshift, lineamps, linevshifts, linesigmas, 
-                       linewaves, emlinewave, resolution_matrix, camerapix=None):
+                       linewaves, emlinewave, resolution_matrix, camerapix=None,
+                       profile='sampled'):
     """Given parameters, build the model emission-line spectrum.
 
-    ToDo: can this be optimized using numba?
+    With profile='sampled', the lines are sampled on the fine `log10wave`
+    grid, but only within +/-8-sigma of each line, and integrated
+    (trapezoidally) into the pixels of each camera (see
+    :func:`_build_emline_model`). With profile='integrated', the lines are
+    integrated analytically over the pixels (see
+    :func:`_build_emline_model_integrated`) and `log10wave` is not used.
 
     """
-    from fastspecfit.util import trapz_rebin, C_LIGHT
+    if profile not in ['sampled', 'integrated']:
+        raise ValueError('Unrecognized profile {}; must be sampled or integrated.'.format(profile))
 
-    log10model = np.zeros_like(log10wave) # [erg/s/cm2/A, observed frame]
+    if camerapix is None:
+        specwaves = emlinewave
+    else:
+        specwaves = [emlinewave[campix[0]:campix[1]] for campix in camerapix]
 
     # Cut to lines with non-zero amplitudes.
     #I = linesigmas > 0
     I = lineamps > 0
-    if np.count_nonzero(I) > 0:
-        linevshifts = linevshifts[I]
-        linesigmas = linesigmas[I]
-        lineamps = lineamps[I]
-        linewaves = linewaves[I]
+    lineamps = np.ascontiguousarray(lineamps[I], dtype=np.float64)
+    linevshifts = np.ascontiguousarray(linevshifts[I], dtype=np.float64)
+    linesigmas = np.ascontiguousarray(linesigmas[I], dtype=np.float64)
+    linewaves = np.ascontiguousarray(linewaves[I], dtype=np.float64)
 
-        # line-width [log-10 Angstrom] and redshifted wavelength [log-10 Angstrom]
-        log10sigmas = linesigmas / C_LIGHT / np.log(10) 
-        linezwaves = np.log10(linewaves * (1.0 + redshift + linevshifts / C_LIGHT))
+    # Split into cameras and resample.
+    emlinemodel = []
+    for specwave in specwaves:
+        edges = centers2edges(specwave)
+        if profile == 'sampled' and (edges[0] < 10**log10wave[0] or 10**log10wave[-1] < edges[-1]):
+            raise ValueError('edges must be within input x range')
 
-        for lineamp, linezwave, log10sigma in zip(lineamps, linezwaves, log10sigmas):
-            J = np.abs(log10wave - linezwave) < (8 * log10sigma) # cut to pixels within +/-N-sigma
-            if np.count_nonzero(J) > 0:
-                #print(lineamp, 10**linezwave, 10**log10wave[J].min(), 10**log10wave[J].max())
-                log10model[J] = log10model[J] + lineamp * np.exp(-0.5 * (log10wave[J]-linezwave)**2 / log10sigma**2)
+        _emlinemodel = np.zeros(len(specwave))
+        if len(lineamps) > 0:
+            if profile == 'integrated':
+                _build_emline_model_integrated(redshift, lineamps, linevshifts, linesigmas,
+                                               linewaves, edges, _emlinemodel)
+            else:
+                _build_emline_model(log10wave, redshift, lineamps, linevshifts, linesigmas,
+                                    linewaves, edges, _emlinemodel)
+            _emlinemodel /= np.diff(edges)
+        emlinemodel.append(_emlinemodel)
 
-    # Optionally split into cameras, resample, and convolve with the resolution
-    # matrix.
-    emlinemodel = []
     if camerapix is None:
-        for icam, specwave in enumerate(emlinewave):
-            _emlinemodel = trapz_rebin(10**log10wave, log10model, specwave)
-            _emlinemomdel = resolution_matrix[icam].dot(_emlinemodel)
-            emlinemodel.append(_emlinemodel)
         return emlinemodel
     else:
-        for icam, campix in enumerate(camerapix):
-            _emlinemodel = trapz_rebin(10**log10wave, log10model, emlinewave[campix[0]:campix[1]])
-            _emlinemomdel = resolution_matrix[icam].dot(_emlinemodel)
-            emlinemodel.append(_emlinemodel)
         return np.hstack(emlinemodel)
 
 def _objective_function(free_parameters, emlinewave, emlineflux, weights, redshift, 
                         log10wave, resolution_matrix, camerapix, parameters, Ifree, 
                         Itied, tiedtoparam, tiedfactor, doubletindx, doubletpair, 
-                        linewaves):
+                        linewaves, profile='sampled'):
     """The parameters array should only contain free (not tied or fixed) parameters."""
 
     # Parameters have to be allowed to exceed their bounds in the optimization
@@ -103,7 +230,7 @@ def _objective_function(free_parameters, emlinewave, emlineflux, weights, redshi
     # Build the emission-line model.
     emlinemodel = build_emline_model(log10wave, redshift, lineamps, linevshifts, 
                                      linesigmas, linewaves, emlinewave, 
-                                     resolution_matrix, camerapix)
+                                     resolution_matrix, camerapix, profile=profile)
 
     if weights is None:
         residuals = emlinemodel - emlineflux
@@ -111,3 +238,400 @@ def _objective_function(free_parameters, emlinewave, emlineflux, weights, redshi
         residuals = weights * (emlinemodel - emlineflux)
 
     return residuals
+
+def emline_jac_sparsity(redshift, emlinewave, camerapix, parameters, Ifree, Itied,
+                        tiedtoparam, tiedfactor, bounds, doubletindx, doubletpair,
+                        linewaves):
+    """Sparsity structure of the Jacobian of :func:`_objective_function`.
+
+    Each line only affects the pixels within +/-8-sigma of its center, so a
+    free parameter only affects the pixels of the lines which depend on it,
+    either directly, through the tied parameters, or through a doublet
+    ratio. The line windows are computed at the extremes of the parameter
+    bounds (which the trust-region optimizer never leaves), so the pattern
+    holds throughout the fit.
+
+    Parameters
+    ----------
+    redshift : :class:`float`
+        Object redshift.
+    emlinewave : :class:`numpy.ndarray` [npix]
+        Observed-frame wavelength of the (stacked) cameras.
+    camerapix : :class:`numpy.ndarray` [ncamera, 2]
+        First and last pixel of each camera in `emlinewave`.
+    parameters, Ifree, Itied, tiedtoparam, tiedfactor, bounds, doubletindx, doubletpair, linewaves
+        Parameters of the linemodel (see
+        :meth:`fastspecfit.fastspecfit.FastFit._linemodel_to_parameters`).
+
+    Returns
+    -------
+    :class:`scipy.sparse.csr_matrix` [npix, nfree]
+        Equal to one for the non-zero elements of the Jacobian and zero
+        otherwise; suitable for the `jac_sparsity` argument of
+        :func:`scipy.optimize.least_squares`.
+
+    """
+    import scipy.sparse as sp
+    from fastspecfit.util import C_LIGHT, centers2edges
+
+    nline = len(linewaves)
+    nfree = len(Ifree)
+
+    # Which free parameters each parameter depends on, and the range of
+    # values it can take.
+    depends = np.zeros((len(parameters), nfree), bool)
+    depends[Ifree, np.arange(nfree)] = True
+    lower, upper = parameters.copy(), parameters.copy()
+    lower[Ifree], upper[Ifree] = bounds[:, 0], bounds[:, 1]
+    for I, indx, factor in zip(Itied, tiedtoparam, tiedfactor):
+        depends[I, :] = depends[indx, :]
+        lower[I], upper[I] = np.sort([lower[indx] * factor, upper[indx] * factor])
+
+    # each line depends on its amplitude, vshift, and sigma, and on the
+    # amplitude of its partner if it is a doublet
+    linedepends = np.logical_or.reduce(np.split(depends, 3))
+    linedepends[doubletindx, :] |= depends[doubletpair, :]
+
+    vshiftmin, vshiftmax = lower[nline:2*nline], upper[nline:2*nline]
+    sigmamax = np.maximum(np.abs(lower[2*nline:]), np.abs(upper[2*nline:]))
+
+    dlog10wave = 8 * sigmamax / C_LIGHT / np.log(10) # +/-N-sigma
+    wavemin = 10**(np.log10(linewaves * (1.0 + redshift + vshiftmin / C_LIGHT)) - dlog10wave)
+    wavemax = 10**(np.log10(linewaves * (1.0 + redshift + vshiftmax / C_LIGHT)) + dlog10wave)
+
+    rows, cols = [], []
+    for campix in camerapix:
+        # pixels whose edges overlap each line window, padded by one pixel
+        # for the interpolation in the trapezoidal rebinning
+        edges = centers2edges(emlinewave[campix[0]:campix[1]])
+        npix = len(edges) - 1
+        pixmin = np.clip(np.searchsorted(edges, wavemin, side='right') - 2, 0, npix)
+        pixmax = np.clip(np.searchsorted(edges, wavemax, side='left') + 1, 0, npix)
+        for iline in np.where(np.any(linedepends, axis=1) * (pixmax > pixmin))[0]:
+            pix = campix[0] + np.arange(pixmin[iline], pixmax[iline])
+            free = np.where(linedepends[iline, :])[0]
+            rows.append(np.repeat(pix, len(free)))
+            cols.append(np.tile(free, len(pix)))
+
+    rows = np.hstack(rows + [np.zeros(0, int)])
+    cols = np.hstack(cols + [np.zeros(0, int)])
+    sparsity = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(emlinewave), nfree))
+    sparsity.data[:] = 1.0 # duplicates (overlapping lines) are summed
+
+    return sparsity
+
+class EMLineJacobian(object):
+    """Analytic Jacobian of :func:`_objective_function`.
+
+    The emission-line model is a sum of Gaussians in log-wavelength, either
+    sampled on the fine `log10wave` grid and rebinned (linearly) onto the
+    pixels of each camera or integrated analytically over those pixels (see
+    :func:`build_emline_model`), so its derivatives with respect to the line
+    amplitudes, velocity shifts, and line-widths---and, by the chain rule,
+    with respect to the free parameters of the tied and doublet-ratio
+    parametrization---can be computed exactly rather than by finite
+    differences.
+
+    Instances take the same arguments as :func:`_objective_function` and can
+    be passed to :func:`scipy.optimize.least_squares` via `jac`.
+
+    Parameters
+    ----------
+    log10wave : :class:`numpy.ndarray`
+        Fine log10-wavelength grid on which the model is built.
+    emlinewave : :class:`numpy.ndarray`
+        Observed-frame wavelength of the (stacked) cameras.
+    camerapix : :class:`numpy.ndarray` [ncamera, 2]
+        First and last pixel of each camera in `emlinewave`.
+    profile : :class:`str`
+        Line-profile model, 'sampled' or 'integrated'.
+
+    """
+    def __init__(self, log10wave, emlinewave, camerapix, profile='sampled'):
+        import scipy.sparse as sp
+        from fastspecfit.util import trapz_rebin_weights
+
+        self.profile = profile
+        self.npix = len(emlinewave)
+        if profile == 'integrated':
+            # pixel edges and first pixel of each camera
+            self.edges = [centers2edges(emlinewave[campix[0]:campix[1]]) for campix in camerapix]
+            self.pixoffset = [campix[0] for campix in camerapix]
+        else:
+            # [npix, nlog10wave] trapezoidal-rebinning operator of all the cameras
+            self.rebin = sp.vstack([trapz_rebin_weights(10**log10wave, emlinewave[campix[0]:campix[1]])
+                                    for campix in camerapix]).tocsr()
+
+    def __call__(self, free_parameters, emlinewave, emlineflux, weights, redshift,
+                 log10wave, resolution_matrix, camerapix, parameters, Ifree,
+                 Itied, tiedtoparam, tiedfactor, doubletindx, doubletpair,
+                 linewaves, profile='sampled'):
+        """Return the [npix, nfree] Jacobian of the residuals."""
+        import scipy.sparse as sp
+
+        nline = len(linewaves)
+        nfree = len(free_parameters)
+
+        # Derivatives of all the parameters with respect to the free ones,
+        # including the tied parameters.
+        parameters = parameters.copy()
+        parameters[Ifree] = free_parameters
+        dparameters = np.zeros((len(parameters), nfree))
+        dparameters[Ifree, np.arange(nfree)] = 1.0
+        for I, indx, factor in zip(Itied, tiedtoparam, tiedfactor):
+            parameters[I] = parameters[indx] * factor
+            dparameters[I, :] = dparameters[indx, :] * factor
+
+        lineamps, linevshifts, linesigmas = np.array_split(parameters, 3) # 3 parameters per line
+
+        # doublets: amp = ratio * amp(pair)
+        dparameters[doubletindx, :] = (lineamps[doubletpair, np.newaxis] * dparameters[doubletindx, :] +
+                                       lineamps[doubletindx, np.newaxis] * dparameters[doubletpair, :])
+        lineamps[doubletindx] *= lineamps[doubletpair]
+
+        # Lines which contribute to the model, plus zero-amplitude lines whose
+        # amplitude can still change (the one-sided derivative).
+        log10sigmas = linesigmas / C_LIGHT / np.log(10)
+        linezwaves = np.log10(linewaves * (1.0 + redshift + linevshifts / C_LIGHT))
+        I = np.where(((lineamps > 0) | ((lineamps == 0) * np.any(dparameters[:nline, :] != 0, axis=1))) *
+                     (log10sigmas > 0))[0]
+
+        # d(linezwave)/d(vshift) and d(log10sigma)/d(sigma)
+        dzwave = 1.0 / (np.log(10) * C_LIGHT * (1.0 + redshift + linevshifts / C_LIGHT))
+        dsigma = 1.0 / (np.log(10) * C_LIGHT)
+
+        if self.profile == 'integrated':
+            dmodel = self._dmodel_integrated(I, lineamps, linezwaves, log10sigmas, dzwave, dsigma, nline)
+        else:
+            dmodel = self._dmodel_sampled(I, lineamps, linezwaves, log10sigmas, dzwave, dsigma, nline, log10wave)
+
+        jac = dmodel.dot(dparameters)
+        if weights is not None:
+            jac *= weights[:, np.newaxis]
+
+        return jac
+
+    def _dmodel_sampled(self, I, lineamps, linezwaves, log10sigmas, dzwave, dsigma, nline, log10wave):
+        """Derivatives of the sampled-and-rebinned model with respect to the
+        (doublet-corrected) amplitude, vshift, and sigma of each line.
+
+        """
+        import scipy.sparse as sp
+
+        # pixels within +/-8-sigma of each line (as in build_emline_model)
+        lo = np.searchsorted(log10wave, linezwaves[I] - 8 * log10sigmas[I], side='right')
+        hi = np.searchsorted(log10wave, linezwaves[I] + 8 * log10sigmas[I], side='left')
+        npix = np.maximum(hi - lo, 0)
+        iline = np.repeat(I, npix)
+        pix = np.arange(np.sum(npix)) - np.repeat(np.cumsum(npix) - npix - lo, npix)
+
+        dlog10wave = log10wave[pix] - linezwaves[iline]
+        sigma2 = log10sigmas[iline]**2
+        gauss = np.exp(-0.5 * dlog10wave**2 / sigma2)
+        dgauss = lineamps[iline] * gauss / sigma2
+
+        values = np.hstack((gauss, dgauss * dlog10wave * dzwave[iline],
+                            dgauss * dlog10wave**2 / log10sigmas[iline] * dsigma))
+        columns = np.hstack((iline, nline + iline, 2 * nline + iline))
+        dlog10model = sp.csc_matrix((values, (np.tile(pix, 3), columns)), shape=(len(log10wave), 3 * nline))
+
+        return self.rebin.dot(dlog10model)
+
+    def _dmodel_integrated(self, I, lineamps, linezwaves, log10sigmas, dzwave, dsigma, nline):
+        """Derivatives of the pixel-integrated model (see
+        :func:`_build_emline_model_integrated`) with respect to the
+        (doublet-corrected) amplitude, vshift, and sigma of each line.
+
+        """
+        import scipy.sparse as sp
+        from scipy.special import erf
+
+        ln10 = np.log(10)
+
+        rows, cols, values = [], [], []
+        for edges, pixoffset in zip(self.edges, self.pixoffset):
+            # pixels overlapping +/-8-sigma of each line
+            nbin = len(edges) - 1
+            lo = np.maximum(np.searchsorted(edges, 10**(linezwaves[I] - 8 * log10sigmas[I]), side='right') - 1, 0)
+            hi = np.minimum(np.searchsorted(edges, 10**(linezwaves[I] + 8 * log10sigmas[I]), side='left'), nbin)
+            npix = np.maximum(hi - lo, 0)
+            iline = np.repeat(I, npix)
+            pix = np.arange(np.sum(npix)) - np.repeat(np.cumsum(npix) - npix - lo, npix)
+
+            # In terms of u=log10(wave), the line is integrated over
+            # norm*exp(-0.5*(u-ucenter)**2/sigma**2), so with t=u-ucenter,
+            #   int exp(-t**2/2sigma**2) = phi = sigma*sqrt(pi/2)*erf(t/sqrt(2)sigma)
+            #   int t**2 exp(-t**2/2sigma**2) = sigma**2 * (phi - t*exp(-t**2/2sigma**2))
+            sigma = log10sigmas[iline]
+            shift = ln10 * sigma**2 # ucenter - log10(linezwave)
+            norm = ln10 * 10**linezwaves[iline] * np.exp(0.5 * ln10 * shift) / np.diff(edges)[pix]
+            tt = np.log10(np.vstack((edges[pix], edges[pix+1]))) - (linezwaves[iline] + shift)
+            gauss = np.exp(-0.5 * tt**2 / sigma**2)
+            phi = sigma * np.sqrt(np.pi / 2) * erf(tt / (np.sqrt(2.0) * sigma))
+
+            # derivatives of the integral of exp(-0.5*(u-linezwave)**2/sigma**2)
+            # times 10**u (and the amplitude) with respect to linezwave and sigma
+            dphi = phi[1] - phi[0]
+            dzw = (gauss[0] - gauss[1]) + ln10 * dphi
+            dsig = np.diff((-tt * gauss + phi - 2 * shift * gauss) / sigma + shift**2 * phi / sigma**3, axis=0)[0]
+
+            rows.append(np.tile(pixoffset + pix, 3))
+            cols.append(np.hstack((iline, nline + iline, 2 * nline + iline)))
+            values.append(np.hstack((norm * dphi, norm * lineamps[iline] * dzw * dzwave[iline],
+                                     norm * lineamps[iline] * dsig * dsigma)))
+
+        return sp.csr_matrix((np.hstack(values), (np.hstack(rows), np.hstack(cols))),
+                             shape=(self.npix, 3 * nline))
+
+class EMLineVarPro(object):
+    """Variable-projection form of the emission-line fit.
+
+    For fixed velocity shifts, line-widths, and doublet ratios the model is
+    linear in the (free) line amplitudes, including those which are tied to
+    them and the doublet lines whose amplitude is a ratio times the amplitude
+    of their partner. Only the former, kinematic parameters are therefore
+    optimized nonlinearly: at each evaluation the amplitudes are solved for
+    with a bounded linear least-squares fit and the residuals (and the
+    Jacobian) are those of the reduced problem.
+
+    The lower bound of the amplitudes is raised to zero, because lines with
+    non-positive amplitudes do not contribute to the model (see
+    :func:`build_emline_model`), which is what keeps it linear.
+
+    Parameters
+    ----------
+    bounds : :class:`numpy.ndarray` [nfree, 2]
+        Bounds on the free parameters.
+    emlinewave, emlineflux, weights, redshift, log10wave, resolution_matrix, camerapix, parameters, Ifree, Itied, tiedtoparam, tiedfactor, doubletindx, doubletpair, linewaves, profile
+        Arguments of :func:`_objective_function`.
+    jacobian : :class:`EMLineJacobian`, optional
+        Analytic Jacobian of the full problem, from which the (Kaufman)
+        Jacobian of the reduced problem is computed; if `None`, `jac` must be
+        estimated by finite differences.
+
+    Attributes
+    ----------
+    x0 : :class:`numpy.ndarray`
+        Initial values of the nonlinear parameters.
+    bounds : :class:`tuple`
+        Bounds on the nonlinear parameters, in the format expected by
+        :func:`scipy.optimize.least_squares`.
+
+    """
+    def __init__(self, bounds, emlinewave, emlineflux, weights, redshift,
+                 log10wave, resolution_matrix, camerapix, parameters, Ifree,
+                 Itied, tiedtoparam, tiedfactor, doubletindx, doubletpair,
+                 linewaves, profile='sampled', jacobian=None):
+
+        self.farg = (emlinewave, emlineflux, weights, redshift, log10wave,
+                     resolution_matrix, camerapix, parameters, Ifree, Itied,
+                     tiedtoparam, tiedfactor, doubletindx, doubletpair,
+                     linewaves, profile)
+        self.jacobian = jacobian
+
+        nline = len(linewaves)
+        if weights is None:
+            weights = np.ones_like(emlineflux)
+        self.weights = weights
+        self.wflux = weights * emlineflux
+
+        # free amplitudes (linear) and everything else (nonlinear)
+        self.linear = (Ifree < nline) * np.logical_not(np.isin(Ifree, doubletindx))
+        self.nonlinear = np.logical_not(self.linear)
+        self.Ilinear = Ifree[self.linear]
+        self.Inonlinear = Ifree[self.nonlinear]
+
+        self.amp_bounds = (np.maximum(bounds[self.linear, 0], 0.0), bounds[self.linear, 1])
+        self.amp_init = np.clip(parameters[self.Ilinear], *self.amp_bounds)
+
+        self.x0 = parameters[self.Inonlinear].copy()
+        self.bounds = tuple(zip(*bounds[self.nonlinear, :]))
+
+        self._x = None
+
+    def _solve(self, x):
+        """Solve for the amplitudes given the nonlinear parameters `x` and
+        cache the results.
+
+        """
+        from scipy.optimize import lsq_linear
+
+        if self._x is not None and np.array_equal(x, self._x):
+            return
+
+        (emlinewave, emlineflux, weights, redshift, log10wave, resolution_matrix,
+         camerapix, parameters, Ifree, Itied, tiedtoparam, tiedfactor, doubletindx,
+         doubletpair, linewaves, profile) = self.farg
+
+        nline = len(linewaves)
+        nlinear = len(self.Ilinear)
+
+        # Line amplitudes per unit (free) amplitude, [nline, nlinear].
+        allparams = np.repeat(parameters[:, np.newaxis], nlinear, axis=1)
+        allparams[self.Inonlinear, :] = x[:, np.newaxis]
+        allparams[self.Ilinear, :] = np.eye(nlinear)
+        for I, indx, factor in zip(Itied, tiedtoparam, tiedfactor):
+            allparams[I, :] = allparams[indx, :] * factor
+        lineamps = allparams[:nline, :]
+        lineamps[doubletindx, :] *= lineamps[doubletpair, :]
+        linevshifts = allparams[nline:2*nline, 0]
+        linesigmas = allparams[2*nline:, 0]
+
+        # unit-amplitude profile of each line which depends on the amplitudes
+        lines = np.where(np.any(lineamps != 0, axis=1))[0]
+        profiles = np.zeros((len(emlineflux), len(lines)))
+        for iprofile, iline in enumerate(lines):
+            profiles[:, iprofile] = build_emline_model(
+                log10wave, redshift, np.ones(1), linevshifts[iline:iline+1],
+                linesigmas[iline:iline+1], linewaves[iline:iline+1], emlinewave,
+                resolution_matrix, camerapix, profile=profile)
+        wbasis = weights[:, np.newaxis] * profiles.dot(lineamps[lines, :])
+
+        # Amplitudes which do not affect the model keep their initial values.
+        amps = self.amp_init.copy()
+        I = np.where(np.any(wbasis != 0, axis=0))[0]
+        if len(I) > 0:
+            fit = lsq_linear(wbasis[:, I], self.wflux, bounds=(self.amp_bounds[0][I], self.amp_bounds[1][I]),
+                             method='bvls')
+            amps[I] = fit.x
+
+        self._x = x.copy()
+        self._amps = amps
+        self._wbasis = wbasis
+        self._residuals = wbasis.dot(amps) - self.wflux
+
+    def free_parameters(self, x):
+        """Return all the free parameters (in the order of `Ifree`) given the
+        nonlinear parameters `x`.
+
+        """
+        self._solve(x)
+        free_parameters = np.zeros(len(self.linear))
+        free_parameters[self.linear] = self._amps
+        free_parameters[self.nonlinear] = x
+        return free_parameters
+
+    def objective(self, x):
+        """Residuals of the reduced problem."""
+        self._solve(x)
+        return self._residuals
+
+    def jac(self, x):
+        """Kaufman Jacobian of the reduced problem: the Jacobian with respect to
+        the nonlinear parameters (at the best-fitting amplitudes) projected
+        onto the complement of the space spanned by the free amplitudes.
+
+        """
+        free_parameters = self.free_parameters(x)
+        jac = self.jacobian(free_parameters, *self.farg)
+        jac_nonlinear = jac[:, self.nonlinear]
+
+        # amplitudes at their bounds do not vary with the nonlinear parameters
+        lo, hi = self.amp_bounds
+        active = (self._amps > lo) * (self._amps < hi) * np.any(self._wbasis != 0, axis=0)
+        if np.any(active):
+            jac_linear = jac[:, self.linear][:, active]
+            coeff = np.linalg.lstsq(jac_linear, jac_nonlinear, rcond=None)[0]
+            jac_nonlinear = jac_nonlinear - jac_linear.dot(coeff)
+
+        return jac_nonlinear
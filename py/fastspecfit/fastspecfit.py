@@ -24,9 +24,261 @@ log = get_logger()
 #import tempfile
 #os.environ['MPLCONFIGDIR'] = tempfile.mkdtemp()
 
+# FastFit instance attached to each multiprocessing worker by _init_worker,
+# and the (optional) shared state in which the workers record the objects they
+# are fitting (see _imap_time_limit), and the optional per-worker profiler.
+_FFit = None
+_fitstate = None
+_profiler = None
+
+# Status of each object in the shared state of _imap_time_limit.
+_QUEUED, _RUNNING, _DONE, _FAILED = 0, 1, 2, 3
+
+def _init_worker(FFit, fitstate=None, proffile=None):
+    """Multiprocessing initializer which attaches a single :class:`FastFit`
+    instance to each worker process.
+
+    With the (default) fork start method the instance is inherited from the
+    parent process without any pickling and the template arrays are shared
+    copy-on-write; otherwise it is pickled once per worker rather than once per
+    task.
+
+    If `fitstate` is not `None`, each worker records the index of the object
+    it is fitting, its process ID, the start time, and when it is done in this
+    shared state, so that the parent process can enforce the per-object time
+    limit (see :func:`_imap_time_limit`).
+
+    If `proffile` is not `None`, profile the fitting in each worker and write
+    the statistics to `<proffile>.<pid>.prof` (see :func:`_fastspec_one`).
+
+    """
+    global _FFit, _fitstate, _profiler
+    _FFit = FFit
+    _fitstate = fitstate
+    if proffile is not None:
+        import cProfile
+        _profiler = (cProfile.Profile(), '{}.{}.prof'.format(proffile, os.getpid()))
+    else:
+        _profiler = None
+
 def _fastspec_one(args):
-    """Multiprocessing wrapper."""
-    return fastspec_one(*args)
+    """Multiprocessing wrapper which also returns the index of the object (the
+    first argument) so that results can be gathered out of order.
+
+    When profiling (see :func:`_init_worker`), the statistics are re-written
+    after every object, so they are not lost when the pool is terminated
+    (only the object being fitted by a killed worker is missing).
+
+    """
+    if _profiler is None:
+        return _run_fastspec_one(args)
+
+    profiler, proffile = _profiler
+    profiler.enable()
+    try:
+        return _run_fastspec_one(args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(proffile)
+
+def _run_fastspec_one(args):
+    """Fit one object for :func:`_fastspec_one`, recording its progress in the
+    shared state of :func:`_imap_time_limit` (if any).
+
+    """
+    if _fitstate is None:
+        return args[0], fastspec_one(*args)
+
+    # The parent only kills a worker while holding the lock and while the
+    # object it timed out is still running (see _imap_time_limit), so a worker
+    # can never be killed after it has finished an object (e.g., while sending
+    # the result or working on its next task).
+    iobj = args[0]
+    lock, status, pids, tstart = _fitstate
+    with lock:
+        pids[iobj], tstart[iobj], status[iobj] = os.getpid(), time.time(), _RUNNING
+    try:
+        return iobj, fastspec_one(*args)
+    finally:
+        with lock:
+            if status[iobj] == _RUNNING:
+                status[iobj] = _DONE
+
+# Extra time [seconds], on top of the per-object time limit, after which the
+# parent process kills a worker which is still fitting the same object (i.e.,
+# which the in-process watchdog in fastspec_one could not interrupt).
+_TIME_LIMIT_GRACE = 5.0
+
+def _imap_time_limit(fitargs, processes, FFit, time_limit, timeout_result,
+                     proffile=None):
+    """Like `pool.imap_unordered(_fastspec_one, fitargs)`, but kill the worker
+    process fitting any object which is still running `time_limit` (plus
+    `_TIME_LIMIT_GRACE`) seconds after it started.
+
+    The in-process watchdog of :func:`fastspec_one` (SIGALRM) is only handled
+    between Python bytecodes, so it cannot interrupt a call into compiled code
+    (e.g., the NNLS solver or scipy) which hangs; this function enforces the
+    limit from the parent process instead.
+
+    The objects are fitted in a dedicated pool, which is created here and
+    terminated once all the objects are done, so that killing a worker can
+    never affect anything else (e.g., the prefetched unpacking of the next
+    chunk). Each worker records the object it is fitting in shared memory
+    (see :func:`_fastspec_one`), and a worker is only killed if the expired
+    object is still running in it. The result of an object whose worker was
+    killed, or died for any other reason, is `timeout_result(iobj)`.
+
+    Parameters
+    ----------
+    fitargs : :class:`list`
+        Arguments of :func:`_fastspec_one`, in the order they should be
+        dispatched.
+    processes : :class:`int`
+        Number of worker processes.
+    FFit : :class:`FastFit`
+        Fitting class attached to each worker (see :func:`_init_worker`).
+    time_limit : :class:`float`
+        Per-object time limit [seconds].
+    timeout_result : callable
+        Function which returns the (default) result of an object which was
+        killed, given its index.
+    proffile : :class:`str` or `None`
+        If not `None`, profile each worker (see :func:`_init_worker`).
+
+    Returns
+    -------
+    Iterator over `(iobj, result)` tuples, in the order the objects finish.
+
+    """
+    import multiprocessing
+    from multiprocessing.connection import wait
+
+    nobj = int(max([args[0] for args in fitargs])) + 1
+    lock = multiprocessing.Lock()
+    status = multiprocessing.RawArray('i', nobj)
+    pids = multiprocessing.RawArray('l', nobj)
+    tstart = multiprocessing.RawArray('d', nobj)
+
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(FFit, (lock, status, pids, tstart), proffile))
+    try:
+        pending = {args[0]: pool.apply_async(_fastspec_one, (args,)) for args in fitargs}
+        seen, accounted = set(), set() # all workers, and those whose death is explained
+        tidle = None
+
+        while len(pending) > 0:
+            for iobj in [iobj for iobj in pending if pending[iobj].ready()]:
+                yield pending.pop(iobj).get()
+
+            failed = []
+            with lock:
+                workers = {proc.pid: proc for proc in pool._pool if proc.is_alive()}
+                seen.update(workers)
+
+                # A worker fits one object at a time, so if the same process
+                # ID shows up more than once (i.e., it was re-used after a
+                # worker died), only the most recent object is its own.
+                running = sorted([iobj for iobj in pending if status[iobj] == _RUNNING],
+                                 key=lambda iobj: tstart[iobj])
+                current = {pids[iobj]: iobj for iobj in running}
+
+                now = time.time()
+                for iobj in running:
+                    pid = pids[iobj]
+                    if pid not in workers or current[pid] != iobj:
+                        log.warning('Worker process {} died while fitting object {}.'.format(pid, iobj))
+                    elif now - tstart[iobj] > time_limit + _TIME_LIMIT_GRACE:
+                        log.warning('Object {} exceeded the time limit of {:.1f} seconds; killing worker process {}.'.format(
+                            iobj, time_limit, pid))
+                        # wait for it to die before letting go of the lock
+                        workers[pid].kill()
+                        wait([workers[pid].sentinel], timeout=10.0)
+                    else:
+                        continue
+                    status[iobj] = _FAILED
+                    accounted.add(pid)
+                    failed.append(iobj)
+
+            # the pool replaces the dead workers
+            for iobj in failed:
+                del pending[iobj]
+                yield iobj, timeout_result(iobj)
+
+            # A task taken by a worker which died (for some other reason)
+            # before recording it never completes; once such a death has been
+            # seen and nothing has been running for a while, the remaining
+            # tasks are lost.
+            if len(seen - set(workers) - accounted) == 0 or len(running) > len(failed):
+                tidle = None
+            elif tidle is None:
+                tidle = time.time()
+            elif time.time() - tidle > time_limit + _TIME_LIMIT_GRACE:
+                for iobj in [iobj for iobj in pending if not pending[iobj].ready()]:
+                    log.warning('Object {} was lost by a worker process which died.'.format(iobj))
+                    del pending[iobj]
+                    yield iobj, timeout_result(iobj)
+                tidle = None
+
+            if len(pending) > 0:
+                next(iter(pending.values())).wait(0.05)
+    finally:
+        # The tasks of any killed workers never complete, so pool.join() would
+        # wait for them forever; everything else has finished by now.
+        pool.terminate()
+        pool.join()
+
+# Stages (in seconds) and counters recorded for each object in the optional
+# TIMING table; note that some stages are nested within others (e.g., VDISP
+# includes some TEMPLATES2DATA and NNLS time).
+TIMING_STAGES = ['UNPACK', 'CONTINUUM', 'VDISP', 'TEMPLATES2DATA', 'NNLS', 'SMOOTHCONTINUUM',
+                 'EMLINES', 'OPTIMIZE_INIT', 'OPTIMIZE_BROAD', 'OPTIMIZE_FINAL',
+                 'POPULATE_EMTABLE', 'TOTAL']
+TIMING_COUNTS = ['NFEV_INIT', 'NFEV_BROAD', 'NFEV_FINAL']
+
+def init_timing(nobj=1):
+    """Initialize the (optional) table of per-object stage timings.
+
+    """
+    timing = Table()
+    timing.add_column(Column(name='TARGETID', length=nobj, dtype='i8'))
+    for stage in TIMING_STAGES:
+        timing.add_column(Column(name=stage, length=nobj, dtype='f4', unit=u.second))
+    for count in TIMING_COUNTS:
+        timing.add_column(Column(name=count, length=nobj, dtype='i4'))
+    return timing
+
+class _FitTimeout(Exception):
+    """Raised by the per-object watchdog (see :func:`fastspec_one`)."""
+
+def _watchdog(signum, frame):
+    """SIGALRM handler for the per-object watchdog."""
+    raise _FitTimeout()
+
+def _estimate_cost(data, meta, FFit, fastphot=False, broadlinefit=True):
+    """Estimate the relative cost of fitting a single object.
+
+    The estimate is deliberately crude and uses only quantities which are
+    available before fitting (the number of emission lines in range, the
+    median S/N of the spectrum, and the spectral type); it is only used to
+    dispatch the most expensive objects first.
+
+    """
+    if fastphot:
+        return 1.0
+
+    zlinewaves = FFit.linetable['restwave'].data * (1 + data['zredrock'])
+    wave = np.hstack(data['wave'])
+    nline = np.sum((zlinewaves > np.min(wave)) * (zlinewaves < np.max(wave)))
+
+    # more lines, more pixels with signal, and more optimizer iterations at high S/N
+    snr = np.max(np.hstack((data['snr'], 0.0)))
+    cost = 1.0 + nline * (1.0 + np.log10(1.0 + snr))
+
+    # broad-line QSO fits are much more expensive
+    if broadlinefit and 'SPECTYPE' in meta.dtype.names and meta['SPECTYPE'] == 'QSO':
+        cost *= 3.0
+
+    return cost
 
 def _desiqa_one(args):
     """Multiprocessing wrapper."""
@@ -37,7 +289,7 @@ def _assign_units_to_columns(fastfit, metadata, Spec, FFit, fastphot=False):
     fastcols = fastfit.colnames
     metacols = metadata.colnames
 
-    T, M = Spec.init_output(FFit=FFit, fastphot=fastphot)
+    T, M = Spec.init_output(FFit=FFit, fastphot=fastphot, metadata=metadata)
     for col in T.colnames:
         if col in fastcols:
             fastfit[col].unit = T[col].unit
@@ -45,23 +297,185 @@ def _assign_units_to_columns(fastfit, metadata, Spec, FFit, fastphot=False):
         if col in metacols:
             metadata[col].unit = M[col].unit
 
-def fastspec_one(iobj, data, out, meta, FFit, broadlinefit=True, fastphot=False,
+def fastspec_one(iobj, data, out, meta, FFit=None, broadlinefit=True, fastphot=False,
                  percamera_models=False):
-    """Multiprocessing wrapper to run :func:`fastspec` on a single object."""
+    """Multiprocessing wrapper to run :func:`fastspec` on a single object.
+
+    `out` and `meta` are single-object :class:`numpy.void` records (see
+    :func:`fastspec`); the filled-in records are returned so the caller can
+    scatter them back into its output tables, together with the model spectra
+    and a dictionary of stage timings (see :func:`init_timing`). If `FFit` is
+    `None`, use the
+    :class:`FastFit` instance attached to this worker process by
+    :func:`_init_worker`.
+
+    If `FFit.time_limit` is set, a watchdog aborts any object which takes
+    longer than this to fit and returns its default (unfitted) values with
+    the TIMEOUT bit set in FITFLAG (see :func:`_timeout_result`). The watchdog
+    relies on SIGALRM, so it is only armed in the main thread of a process
+    (which is the case for both serial fitting and multiprocessing workers),
+    and a long-running call into compiled code is only interrupted once it
+    returns; with multiprocessing, the parent process kills workers which hang
+    in compiled code (see :func:`_imap_time_limit`), but serial fits are not
+    protected against such hangs.
+
+    """
+    import signal, threading
+
+    if FFit is None:
+        FFit = _FFit
+
+    # Records which arrive through a pipe are read-only, so work on copies.
+    out, meta = np.array(out)[()], np.array(meta)[()]
     
     log.info('Working on object {} [targetid={}, z={:.6f}].'.format(
         iobj, meta['TARGETID'], meta['Z']))
 
-    continuummodel, smooth_continuum = FFit.continuum_specfit(data, out, fastphot=fastphot)
+    tall = time.time()
+    FFit.timer.reset()
+    FFit.timer.add('UNPACK', data.get('tunpack', 0.0))
+
+    watchdog = FFit.time_limit is not None and hasattr(signal, 'setitimer') and \
+        threading.current_thread() is threading.main_thread()
+    if watchdog:
+        out_default = out.copy()
+        oldhandler = signal.signal(signal.SIGALRM, _watchdog)
+        signal.setitimer(signal.ITIMER_REAL, FFit.time_limit)
+
+    try:
+        continuummodel, smooth_continuum = FFit.continuum_specfit(data, out, fastphot=fastphot)
+
+        # Fit the emission-line spectrum.
+        if fastphot:
+            emmodel = None
+        else:
+            emmodel = FFit.emline_specfit(data, out, continuummodel, smooth_continuum,
+                                          broadlinefit=broadlinefit, percamera_models=percamera_models)
+        if watchdog:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except _FitTimeout:
+        log.warning('Object {} [targetid={}] exceeded the time limit of {:.1f} seconds; returning default values.'.format(
+            iobj, meta['TARGETID'], FFit.time_limit))
+        out, emmodel = _timeout_result(data, out_default, FFit, fastphot=fastphot)
+    finally:
+        if watchdog:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, oldhandler)
+
+    FFit.timer.add('TOTAL', time.time()-tall)
+
+    return out, meta, emmodel, FFit.timer.summary()
+
+def _timeout_result(data, out, FFit, fastphot=False):
+    """Return the default (unfitted) output record, with the TIMEOUT bit set in
+    FITFLAG, and model spectra of an object which exceeded the time limit.
+
+    """
+    from fastspecfit.util import FitFlagMask
 
-    # Fit the emission-line spectrum.
+    out = out.copy()
+    out['FITFLAG'] |= FitFlagMask.TIMEOUT
     if fastphot:
         emmodel = None
     else:
-        emmodel = FFit.emline_specfit(data, out, continuummodel, smooth_continuum,
-                                      broadlinefit=broadlinefit, percamera_models=percamera_models)
+        _, emmodel = FFit._init_modelspectra(data['coadd_wave'])
+    return out, emmodel
+
+def _fit_chunk(data, out, meta, FFit, broadlinefit=True, fastphot=False,
+               percamera_models=False, pool=None, checkpoint=None, mp=1,
+               proffile=None):
+    """Fit one chunk of unpacked objects, optionally in parallel.
+
+    Parameters
+    ----------
+    data : :class:`list`
+        Data dictionaries, one per object, from
+        :func:`fastspecfit.io.DESISpectra.iter_read_and_unpack`.
+    out, meta : :class:`astropy.table.Table`
+        Output tables, row-aligned to `data`, from
+        :func:`fastspecfit.io.DESISpectra.init_output`.
+    FFit : :class:`FastFit`
+        Fitting class.
+    pool : :class:`multiprocessing.pool.Pool` or `None`
+        Pool initialized with :func:`_init_worker`; if `None`, fit serially.
+    checkpoint : :class:`fastspecfit.io.Checkpoint` or `None`
+        If not `None`, hand each object's results to the checkpoint as soon as
+        they are available.
+    mp : :class:`int`
+        If greater than one and `FFit.time_limit` is set, fit the objects in
+        a dedicated pool of `mp` processes instead of `pool`, and enforce the
+        per-object time limit from this process (see
+        :func:`_imap_time_limit`).
+    proffile : :class:`str` or `None`
+        If not `None`, profile the workers of the dedicated pool used with a
+        time limit (see :func:`_init_worker`).
+
+    Returns
+    -------
+    The filled-in `out` and `meta` tables, the stacked model spectra (or
+    `None` if `fastphot=True`), and the table of stage timings (see
+    :func:`init_timing`).
+
+    """
+    # Hand each task compact numpy records rather than astropy Rows, which
+    # pickle their whole parent Table; the fitted records are scattered back
+    # into these (preallocated) arrays below.
+    out, meta = out.as_array(), meta.as_array()
+    nobj = len(out)
+
+    timelimit = FFit.time_limit is not None and mp > 1
+    if pool is not None or timelimit:
+        # Dispatch the most expensive objects first (one at a time) so that a
+        # handful of slow fits does not leave the other workers idle at the
+        # end of the chunk; the results are put back in order below.
+        cost = np.array([_estimate_cost(data[iobj], meta[iobj], FFit, fastphot=fastphot,
+                                        broadlinefit=broadlinefit) for iobj in np.arange(nobj)])
+        order = np.argsort(-cost, kind='stable')
+
+        # FFit is attached to each worker once, rather than pickled into every task.
+        fitargs = [(iobj, data[iobj], out[iobj], meta[iobj], None, broadlinefit,
+                    fastphot, percamera_models) for iobj in order]
+        if timelimit:
+            def _timeout(iobj):
+                _out, emmodel = _timeout_result(data[iobj], out[iobj], FFit, fastphot=fastphot)
+                return _out, meta[iobj], emmodel, {}
+            results = _imap_time_limit(fitargs, mp, FFit, FFit.time_limit, _timeout,
+                                       proffile=proffile)
+        else:
+            results = pool.imap_unordered(_fastspec_one, fitargs)
+    else:
+        fitargs = [(iobj, data[iobj], out[iobj], meta[iobj], FFit, broadlinefit,
+                    fastphot, percamera_models) for iobj in np.arange(nobj)]
+        results = (_fastspec_one(_fitargs) for _fitargs in fitargs)
+
+    _out = [None] * nobj
+    for iobj, result in results:
+        if checkpoint is not None:
+            checkpoint.append(*result[:3])
+        _out[iobj] = result
+    _out = list(zip(*_out))
+    for iobj in np.arange(nobj):
+        out[iobj] = _out[0][iobj]
+        meta[iobj] = _out[1][iobj]
+
+    timing = init_timing(nobj)
+    timing['TARGETID'] = meta['TARGETID']
+    for iobj in np.arange(nobj):
+        for key, value in _out[3][iobj].items():
+            timing[key][iobj] = value
+
+    if fastphot:
+        modelspectra = None
+    else:
+        try:
+            # need to vstack to preserve the wavelength metadata 
+            modelspectra = vstack(_out[2], metadata_conflicts='error')
+        except:
+            errmsg = 'Metadata conflict when stacking model spectra.'
+            log.critical(errmsg)
+            raise ValueError(errmsg)
 
-    return out, meta, emmodel
+    return Table(out), Table(meta), modelspectra, timing
 
 def desiqa_one(FFit, data, fastfit, metadata, coadd_type, fastphot=False, 
                outdir=None, outprefix=None):
@@ -84,14 +498,29 @@ def parse(options=None):
     parser.add_argument('-o', '--outfile', type=str, required=True, help='Full path to output filename (required).')
     parser.add_argument('--mp', type=int, default=1, help='Number of multiprocessing threads per MPI rank.')
     parser.add_argument('-n', '--ntargets', type=int, help='Number of targets to process in each file.')
+    parser.add_argument('--chunksize', type=int, default=None, help='Read, unpack, and fit at most this many targets at a time (default is one input file at a time).')
+    parser.add_argument('--prefetch', type=int, default=0, help='Number of chunks (or input files) to read and unpack ahead, in a background thread, while fitting.')
+    parser.add_argument('--checkpoint', action='store_true', help='Checkpoint the results to a sidecar file as they finish.')
+    parser.add_argument('--resume', action='store_true', help='Resume from an existing checkpoint, skipping targets which have already been fitted (implies --checkpoint).')
+    parser.add_argument('--time-budget', type=float, default=None, help='Per-object time budget [seconds]; once exceeded, skip the broad-line fitting and cap the number of optimizer iterations.')
+    parser.add_argument('--time-limit', type=float, default=None, help='Hard per-object time limit [seconds]; objects which exceed it are aborted and flagged (with --mp 1, hangs in compiled code are not interrupted).')
     parser.add_argument('--firsttarget', type=int, default=0, help='Index of first object to to process in each file, zero-indexed.') 
     parser.add_argument('--targetids', type=str, default=None, help='Comma-separated list of TARGETIDs to process.')
     parser.add_argument('--solve-vdisp', action='store_true', help='Solve for the velocity dispersion (only when using fastspec).')
+    parser.add_argument('--vdisp-search', type=str, default='full', choices=['full', 'coarse'], help='Fit the full velocity dispersion grid or use a (faster) coarse-to-fine search.')
+    parser.add_argument('--emline-jac', type=str, default='analytic', choices=['analytic', '2-point', '3-point'], help='Jacobian of the emission-line fits: analytic or (sparse) finite differences.')
+    parser.add_argument('--emline-profile', type=str, default='sampled', choices=['sampled', 'integrated'], help='Sample the emission lines on a fine wavelength grid or integrate them analytically over the pixels.')
+    parser.add_argument('--emline-varpro', action='store_true', help='Fit the emission lines by variable projection, solving for the line-amplitudes linearly.')
     parser.add_argument('--no-broadlinefit', default=True, action='store_false', dest='broadlinefit',
                         help='Do not allow for broad Balmer and Helium line-fitting.')
     parser.add_argument('--nophoto', action='store_true', help='Do not include the photometry in the model fitting.')
     parser.add_argument('--percamera-models', action='store_true', help='Return the per-camera (not coadded) model spectra.')
+    parser.add_argument('--timing', action='store_true', help='Write the per-object stage timings to a TIMING extension.')
+    parser.add_argument('--profile', action='store_true', help='Profile the code and write the statistics (readable with pstats) to a .prof file next to the output file; with --mp>1, the fitting in each worker process is written to a separate .<pid>.prof file.')
     parser.add_argument('--templates', type=str, default=None, help='Optional name of the templates.')
+    parser.add_argument('--template-cache', type=str, default=None, help='Optional directory in which to cache (and from which to memory-map) the preprocessed templates.')
+    parser.add_argument('--phot-lut', action='store_true', help='Fit the photometry using a lookup table of template photometry versus redshift, stored in the template cache if any (only when using fastphot).')
+    parser.add_argument('--batch', action='store_true', help='Fit all the objects at once with the vectorized photometric fitting engine (only when using fastphot; ignores --mp, --chunksize, --prefetch, --checkpoint, and --resume).')
     parser.add_argument('--redrockfile-prefix', type=str, default='redrock-', help='Prefix of the input Redrock file name(s).')
     parser.add_argument('--specfile-prefix', type=str, default='coadd-', help='Prefix of the spectral file(s).')
     parser.add_argument('--qnfile-prefix', type=str, default='qso_qn-', help='Prefix of the QuasarNet afterburner file(s).')
@@ -108,7 +537,31 @@ def parse(options=None):
 
     return args
 
-def fastspec(fastphot=False, args=None, comm=None):
+def init_fastfit(args, fastphot=False):
+    """Initialize the :class:`FastFit` class given the (parsed) input arguments.
+
+    Parameters
+    ----------
+    args : :class:`argparse.Namespace`
+        Arguments parsed by :func:`parse`.
+    fastphot : :class:`bool`
+        Initialize the class for `fastphot` rather than `fastspec`.
+
+    """
+    t0 = time.time()
+    FFit = FastFit(templates=args.templates, mapdir=args.mapdir, 
+                   verbose=args.verbose, solve_vdisp=args.solve_vdisp, 
+                   vdisp_search=args.vdisp_search, emline_jac=args.emline_jac,
+                   emline_profile=args.emline_profile, emline_varpro=args.emline_varpro,
+                   nophoto=args.nophoto, fastphot=fastphot,
+                   time_budget=args.time_budget, time_limit=args.time_limit,
+                   template_cache=args.template_cache,
+                   phot_lut=fastphot and args.phot_lut,
+                   mintemplatewave=450.0, maxtemplatewave=40e4)
+    log.info('Initializing the FastFit class took {:.2f} sec'.format(time.time()-t0))
+    return FFit
+
+def fastspec(fastphot=False, args=None, comm=None, FFit=None):
     """Main fastspec script.
 
     This script is the engine to model one or more DESI spectra. It initializes
@@ -122,6 +575,10 @@ def fastspec(fastphot=False, args=None, comm=None):
         Required and optional arguments parsed via inputs to the command line. 
     comm : :class:`mpi4py.MPI.MPI.COMM_WORLD` or `None`
         Intracommunicator used with MPI parallelism.
+    FFit : :class:`FastFit` or `None`
+        Previously initialized fitting class (see :func:`init_fastfit`), which
+        lets a long-running process fit many files without re-reading the
+        templates each time; if `None`, initialize it here.
 
     """
     from astropy.table import Table, vstack
@@ -130,19 +587,32 @@ def fastspec(fastphot=False, args=None, comm=None):
     if isinstance(args, (list, tuple, type(None))):
         args = parse(args)
 
+    # Optionally profile everything which happens in this process and, with
+    # --mp>1, the fitting in each worker process (see _init_worker).
+    if args.profile:
+        import copy, cProfile
+        proffile = args.outfile.replace('.gz', '').replace('.fits', '')
+        profargs = copy.copy(args)
+        profargs.profile = False
+        profargs.profile_workers = proffile
+        proffile += '.prof'
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(fastspec, fastphot=fastphot, args=profargs,
+                                    comm=comm, FFit=FFit)
+        finally:
+            profiler.dump_stats(proffile)
+            log.info('Wrote profiling statistics to {}'.format(proffile))
+
     if args.targetids:
         targetids = [int(x) for x in args.targetids.split(',')]
     else:
         targetids = args.targetids
 
     # Initialize the fitting class.
-    t0 = time.time()
-    FFit = FastFit(templates=args.templates, mapdir=args.mapdir, 
-                   verbose=args.verbose, solve_vdisp=args.solve_vdisp, 
-                   nophoto=args.nophoto, fastphot=fastphot,
-                   mintemplatewave=450.0, maxtemplatewave=40e4)
+    if FFit is None:
+        FFit = init_fastfit(args, fastphot=fastphot)
     Spec = DESISpectra(dr9dir=args.dr9dir)
-    log.info('Initializing the classes took {:.2f} sec'.format(time.time()-t0))
 
     # Read the data.
     t0 = time.time()
@@ -154,48 +624,157 @@ def fastspec(fastphot=False, args=None, comm=None):
     if len(Spec.specfiles) == 0:
         return
 
-    data = Spec.read_and_unpack(FFit, fastphot=fastphot, synthphot=True, mp=args.mp)
-    log.info('Reading and unpacking {} spectra to be fitted took {:.2f} seconds.'.format(
-        Spec.ntargets, time.time()-t0))
+    log.info('Selecting the spectra to be fitted took {:.2f} seconds.'.format(time.time()-t0))
 
-    t0 = time.time()
-    out, meta = Spec.init_output(data, FFit=FFit, fastphot=fastphot)
-    log.info('Initializing the output tables took {:.2f} seconds.'.format(time.time()-t0))
+    # Optionally fit the photometry of all the objects at once.
+    if fastphot and args.batch:
+        t0 = time.time()
+        meta, nanomaggies, ivarnanomaggies = Spec.unpack_photometry(FFit)
+        log.info('Unpacking the photometry of {} objects took {:.2f} seconds.'.format(
+            len(meta), time.time()-t0))
+
+        out, meta = Spec.init_output(FFit=FFit, fastphot=True, metadata=meta)
+        fastfit = FFit.fastphot_batch(meta['Z'].data, nanomaggies, ivarnanomaggies, meta['PHOTSYS'].data)
+        for col in fastfit.colnames:
+            out[col] = fastfit[col]
+
+        _assign_units_to_columns(out, meta, Spec, FFit, fastphot=True)
+        write_fastspecfit(out, meta, outfile=args.outfile, specprod=Spec.specprod,
+                          coadd_type=Spec.coadd_type, fastphot=True)
+        return
 
-    # Fit in parallel
-    t0 = time.time()
-    fitargs = [(iobj, data[iobj], out[iobj], meta[iobj], FFit, args.broadlinefit,
-                fastphot, args.percamera_models) for iobj in np.arange(Spec.ntargets)]
+    # Optionally checkpoint the results as they finish and, when resuming,
+    # skip the targets which have already been fitted.
+    if args.checkpoint or args.resume:
+        from fastspecfit.io import Checkpoint, unique_ids
+        checkpoint = Checkpoint(args.outfile, fastphot=fastphot, resume=args.resume)
+        allids = [key for meta in Spec.meta for key in unique_ids(meta)]
+        if args.resume:
+            ndone = Spec.remove_targets(checkpoint.ids)
+            log.info('Resuming from {}: skipping {}/{} previously fitted target(s).'.format(
+                checkpoint.ckptdir, ndone, len(allids)))
+    else:
+        checkpoint = None
+
+    # Read, unpack, and fit the data in chunks of (at most) args.chunksize
+    # objects (or one input file at a time), so that peak memory is set by the
+    # chunk size rather than by the size of the input file(s). A single pool
+    # is used for both the unpacking and the fitting, except with a time
+    # limit, in which case each chunk is fitted in a dedicated pool whose
+    # workers can be killed (see _imap_time_limit).
     if args.mp > 1:
         import multiprocessing
-        with multiprocessing.Pool(args.mp) as P:
-            _out = P.map(_fastspec_one, fitargs)
+        pool = multiprocessing.Pool(args.mp, initializer=_init_worker,
+                                    initargs=(FFit, None, getattr(args, 'profile_workers', None)))
     else:
-        _out = [fastspec_one(*_fitargs) for _fitargs in fitargs]
-    _out = list(zip(*_out))
-    out = Table(np.hstack(_out[0]))
-    meta = Table(np.hstack(_out[1]))
-    if fastphot:
-        modelspectra = None
+        pool = None
+
+    outs, metas, modelspectra, timings = [], [], [], []
+    chunks = []
+    try:
+        t0 = time.time()
+        if len(Spec.specfiles) > 0:
+            chunks = Spec.iter_read_and_unpack(FFit, fastphot=fastphot, synthphot=True,
+                                               chunksize=args.chunksize, pool=pool)
+            # Optionally read and unpack the next chunk(s) while fitting the
+            # current one (the fitting stays in the main thread).
+            if args.prefetch > 0:
+                from fastspecfit.util import prefetch
+                chunks = prefetch(chunks, depth=args.prefetch)
+        for data, chunkmeta in chunks:
+            log.info('Reading and unpacking {} spectra to be fitted took {:.2f} seconds.'.format(
+                len(data), time.time()-t0))
+
+            t0 = time.time()
+            out, meta = Spec.init_output(data, FFit=FFit, fastphot=fastphot, metadata=chunkmeta)
+            out, meta, models, timing = _fit_chunk(data, out, meta, FFit, broadlinefit=args.broadlinefit,
+                                                   fastphot=fastphot, percamera_models=args.percamera_models,
+                                                   pool=pool, checkpoint=checkpoint, mp=args.mp,
+                                                   proffile=getattr(args, 'profile_workers', None))
+            log.info('Fitting {} object(s) took {:.2f} seconds.'.format(len(out), time.time()-t0))
+            del data
+
+            if checkpoint is not None:
+                checkpoint.flush()
+
+            if args.timing:
+                timings.append(timing)
+
+            if checkpoint is None:
+                outs.append(out)
+                metas.append(meta)
+                if not fastphot:
+                    modelspectra.append(models)
+            t0 = time.time()
+    finally:
+        # Stop any prefetching before shutting down the pool.
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if checkpoint is not None:
+        # Consolidate everything which has been checkpointed (including any
+        # results from previous runs) back into the input order.
+        out, meta, modelspectra = checkpoint.read()
+        srt = _sort_by_ids(unique_ids(meta), allids)
+        out, meta = out[srt], meta[srt]
+        if not fastphot:
+            modelspectra = modelspectra[srt]
     else:
-        try:
-            # need to vstack to preserve the wavelength metadata 
-            modelspectra = vstack(_out[2], metadata_conflicts='error')
-        except:
-            errmsg = 'Metadata conflict when stacking model spectra.'
-            log.critical(errmsg)
-            raise ValueError(errmsg)
-       
-    log.info('Fitting {} object(s) took {:.2f} seconds.'.format(Spec.ntargets, time.time()-t0))
+        out = vstack(outs)
+        meta = vstack(metas)
+        if fastphot:
+            modelspectra = None
+        else:
+            try:
+                # need to vstack to preserve the wavelength metadata 
+                modelspectra = vstack(modelspectra, metadata_conflicts='error')
+            except:
+                errmsg = 'Metadata conflict when stacking model spectra.'
+                log.critical(errmsg)
+                raise ValueError(errmsg)
+
+    # The timings only cover the objects fitted in this call (i.e., not any
+    # which were restored from a checkpoint).
+    if args.timing and len(timings) > 0:
+        timing = vstack(timings)
+    else:
+        timing = None
 
     # Assign units and write out.
     _assign_units_to_columns(out, meta, Spec, FFit, fastphot=fastphot)
 
     write_fastspecfit(out, meta, modelspectra=modelspectra, outfile=args.outfile,
                       specprod=Spec.specprod, coadd_type=Spec.coadd_type,
-                      fastphot=fastphot)
+                      fastphot=fastphot, timing=timing)
+
+    if checkpoint is not None:
+        checkpoint.remove()
+
+def _sort_by_ids(ids, allids):
+    """Return the indices which sort the objects with unique identifiers `ids`
+    (see :func:`fastspecfit.io.unique_ids`) into the order of `allids`,
+    dropping any which are not in `allids`. Repeated identifiers are matched
+    in turn.
+
+    """
+    from collections import defaultdict, deque
+
+    order = defaultdict(deque)
+    for indx, key in enumerate(allids):
+        order[key].append(indx)
+
+    keep, position = [], []
+    for indx, key in enumerate(ids):
+        if len(order[key]) > 0:
+            keep.append(indx)
+            position.append(order[key].popleft())
+
+    return np.array(keep, int)[np.argsort(position, kind='stable')]
 
-def fastphot(args=None, comm=None):
+def fastphot(args=None, comm=None, FFit=None):
     """Main fastphot script.
 
     This script is the engine to model the broadband photometry of one or more
@@ -209,16 +788,20 @@ def fastphot(args=None, comm=None):
         Required and optional arguments parsed via inputs to the command line. 
     comm : :class:`mpi4py.MPI.MPI.COMM_WORLD` or `None`
         Intracommunicator used with MPI parallelism.
+    FFit : :class:`FastFit` or `None`
+        Previously initialized fitting class (see :func:`fastspec`).
 
     """
-    fastspec(fastphot=True, args=args, comm=comm)
+    fastspec(fastphot=True, args=args, comm=comm, FFit=FFit)
 
 class FastFit(ContinuumTools):
     def __init__(self, templates=None, mintemplatewave=None, maxtemplatewave=40e4, 
                  minspecwave=3500.0, maxspecwave=9900.0, chi2_default=0.0, 
-                 maxiter=5000, accuracy=1e-2, solve_vdisp=True,
+                 maxiter=5000, accuracy=1e-2, solve_vdisp=True, vdisp_search='full',
                  constrain_age=True, mapdir=None, nophoto=False, fastphot=False,
-                 verbose=False):
+                 time_budget=None, time_limit=None, template_cache=None,
+                 phot_lut=False, emline_jac='analytic', emline_profile='sampled',
+                 emline_varpro=False, verbose=False):
         """Class to model a galaxy stellar continuum.
 
         Parameters
@@ -241,8 +824,44 @@ class FastFit(ContinuumTools):
             Maximum number of iterations.
         accuracy : :class:`float`, optional, defaults to 0.01.
             Fitting accuracy.
+        vdisp_search : :class:`str`, optional, defaults to 'full'.
+            How to search the velocity dispersion grid: fit every grid point
+            ('full') or use a coarse-to-fine search which only fits the grid
+            points near the minimum ('coarse').
         mapdir : :class:`str`, optional
             Full path to the Milky Way dust maps.
+        time_budget : :class:`float`, optional, defaults to None.
+            Soft per-object time budget [seconds]. Once exceeded, the
+            broad-line fitting is skipped and the number of function
+            evaluations in the remaining emission-line fits is capped at
+            `maxiter_overbudget` (see the FITFLAG output column).
+        time_limit : :class:`float`, optional, defaults to None.
+            Hard per-object time limit [seconds]. Objects which exceed it are
+            aborted by :func:`fastspec_one` and returned with default values;
+            with multiprocessing, workers which hang in compiled code are
+            killed by the parent process (see :func:`_imap_time_limit`).
+        template_cache : :class:`str`, optional
+            Directory in which to cache the templates as memory-mapped binary
+            files (see :class:`fastspecfit.continuum.ContinuumTools`).
+        phot_lut : :class:`bool`, optional, defaults to False.
+            Fit the photometry (with `fastphot`) using a lookup table of the
+            template photometry versus redshift (see
+            :meth:`fastspecfit.continuum.ContinuumTools.init_phot_lut`).
+        emline_jac : :class:`str`, optional, defaults to 'analytic'.
+            Jacobian of the emission-line fits: 'analytic' (see
+            :class:`fastspecfit.emlines.EMLineJacobian`) or sparse
+            finite differences, '2-point' or '3-point' (see
+            :func:`fastspecfit.emlines.emline_jac_sparsity`).
+        emline_profile : :class:`str`, optional, defaults to 'sampled'.
+            Emission-line profile model: Gaussians sampled on a fine
+            wavelength grid and rebinned onto the pixels ('sampled') or
+            integrated analytically over the pixels ('integrated'); see
+            :func:`fastspecfit.emlines.build_emline_model`.
+        emline_varpro : :class:`bool`, optional, defaults to False.
+            Fit the emission lines by variable projection, i.e., only optimize
+            the velocity shifts, line-widths, and doublet ratios nonlinearly
+            and solve for the line-amplitudes with a bounded linear
+            least-squares fit (see :class:`fastspecfit.emlines.EMLineVarPro`).
 
         Notes
         -----
@@ -256,12 +875,39 @@ class FastFit(ContinuumTools):
         """
         super(FastFit, self).__init__(templates=templates, mintemplatewave=mintemplatewave,
                                       maxtemplatewave=maxtemplatewave, mapdir=mapdir, fastphot=fastphot,
-                                      nophoto=nophoto, verbose=verbose)
+                                      nophoto=nophoto, template_cache=template_cache,
+                                      phot_lut=phot_lut, verbose=verbose)
 
         # continuum stuff
         self.constrain_age = constrain_age
         self.solve_vdisp = solve_vdisp
 
+        if vdisp_search not in ['full', 'coarse']:
+            errmsg = 'Unrecognized vdisp_search {}; must be full or coarse.'.format(vdisp_search)
+            self.log.critical(errmsg)
+            raise ValueError(errmsg)
+        self.vdisp_search = vdisp_search
+
+        if emline_jac not in ['analytic', '2-point', '3-point']:
+            errmsg = 'Unrecognized emline_jac {}; must be analytic, 2-point, or 3-point.'.format(emline_jac)
+            self.log.critical(errmsg)
+            raise ValueError(errmsg)
+        self.emline_jac = emline_jac
+
+        if emline_profile not in ['sampled', 'integrated']:
+            errmsg = 'Unrecognized emline_profile {}; must be sampled or integrated.'.format(emline_profile)
+            self.log.critical(errmsg)
+            raise ValueError(errmsg)
+        self.emline_profile = emline_profile
+        self.emline_varpro = emline_varpro
+
+        # per-object time budget and hard limit
+        self.time_budget = time_budget
+        self.time_limit = time_limit
+        self.maxiter_overbudget = 100
+        self._tstart = time.time()
+        self.nnls_failed = False
+
         # emission line stuff
         if not fastphot:
             self.chi2_default = chi2_default
@@ -321,6 +967,7 @@ class FastFit(ContinuumTools):
         out.add_column(Column(name='RCHI2', length=nobj, dtype='f4'))      # full-spectrum reduced chi2
         out.add_column(Column(name='RCHI2_CONT', length=nobj, dtype='f4')) # rchi2 fitting just to the continuum (spec+phot)
         out.add_column(Column(name='RCHI2_PHOT', length=nobj, dtype='f4')) # rchi2 fitting just to the photometry (=RCHI2_CONT if fastphot=True)
+        out.add_column(Column(name='FITFLAG', length=nobj, dtype='i4'))    # bitmask (see fastspecfit.util.FitFlagMask)
 
         if not fastphot:
             for cam in ['B', 'R', 'Z']:
@@ -435,9 +1082,145 @@ class FastFit(ContinuumTools):
 
         return out
 
+    def _minfit_chi2grid(self, xparam, chi2grid):
+        """Find the minimum of a chi2 grid by fitting a parabola to the three
+        points around its lowest local minimum.
+
+        Returns the index of the minimum, the best-fitting value of `xparam`
+        and its inverse variance, and the minimum chi2. If the fit fails, the
+        inverse variance and chi2 are zero and `xparam[0]` is returned.
+
+        """
+        from fastspecfit.util import find_minima, minfit
+
+        try:
+            imin = find_minima(chi2grid)[0]
+            xbest, xerr, chi2min, warn = minfit(xparam[imin-1:imin+2], chi2grid[imin-1:imin+2])
+        except:
+            errmsg = 'A problem was encountered minimizing chi2.'
+            self.log.warning(errmsg)
+            imin, xbest, xerr, chi2min, warn = 0, 0.0, 0.0, 0.0, 1
+
+        if warn == 0:
+            xivar = 1.0 / xerr**2
+        else:
+            chi2min = 0.0
+            xivar = 0.0
+            xbest = xparam[0]
+
+        return imin, xbest, xivar, chi2min
+
+    def _nnls_gram(self, modelflux, flux, ivar, passive=None):
+        """Wrapper on :func:`fastspecfit.fnnls.nnls_gram` which does not raise.
+
+        If the solver fails, log the error and return zero coefficients (and
+        the chi2 of a zero model) instead, so that a single object cannot abort
+        a whole run, and set `self.nnls_failed` (see the NNLS_FAILED bit of
+        FITFLAG).
+
+        """
+        from fastspecfit.fnnls import nnls_gram
+
+        try:
+            return nnls_gram(modelflux, flux, ivar, passive=passive)
+        except Exception as err:
+            self.log.warning('NNLS fit failed ({}: {}); setting the coefficients to zero.'.format(
+                type(err).__name__, err))
+            self.nnls_failed = True
+            return np.zeros(modelflux.shape[1]), np.sum(ivar * flux**2)
+
+    def _solve_vdisp_coarse(self, data, redshift, Ivdisp, specflux, specivar):
+        """Solve for the velocity dispersion with a coarse-to-fine search of
+        the velocity dispersion grid.
+
+        Rather than projecting and fitting every point of the (precomputed)
+        velocity dispersion grid, start with a coarse subset of the grid, find
+        its minimum chi2, and then only project and fit the grid points which
+        bracket it. The NNLS fit at each new grid point is warm-started from
+        the solution at the nearest grid point already fitted: the
+        least-squares problem is first re-solved on the positive set of that
+        solution, which is accepted if it satisfies the Karush-Kuhn-Tucker
+        conditions, and otherwise the active-set iterations continue from
+        there, with :func:`scipy.optimize.nnls` as the fallback (see
+        :func:`fastspecfit.fnnls.nnls_gram`). The minimum is then found
+        exactly as in `_call_nnls`, from the contiguous run of finely sampled
+        grid points around it.
+
+        Parameters
+        ----------
+        data : :class:`dict`
+            Data dictionary (see :func:`fastspecfit.io.DESISpectra.read_and_unpack`).
+        redshift : :class:`float`
+            Object redshift.
+        Ivdisp : :class:`numpy.ndarray`
+            Indices of the (stacked) spectral pixels to use in the fit.
+        specflux : :class:`numpy.ndarray`
+            Stacked spectrum.
+        specivar : :class:`numpy.ndarray`
+            Stacked inverse variance spectrum.
+
+        Returns
+        -------
+        chi2min, vdispbest, vdispivar : :class:`float`
+            Minimum chi2, best-fitting velocity dispersion, and its inverse
+            variance (see `_call_nnls`).
+        nfit : :class:`int`
+            Number of velocity dispersion grid points fitted.
+
+        """
+        from fastspecfit.util import find_minima
+
+        nvdisp = self.nvdisp
+        coarse_step = max(2, int(np.round(np.sqrt(nvdisp))))
+
+        flux, ivar = specflux[Ivdisp], specivar[Ivdisp]
+
+        coeff, chi2grid = {}, {}
+
+        def _fit(indx):
+            indx = [ii for ii in indx if ii not in chi2grid]
+            if len(indx) == 0:
+                return
+            ztemplateflux, _ = self.templates2data(
+                self.vdispflux[:, :, indx], self.vdispwave, # [npix,vdispnsed,len(indx)]
+                redshift=redshift, specwave=data['wave'], specres=data['res'],
+                cameras=data['cameras'], synthphot=False, stack_cameras=True)
+            ztemplateflux = ztemplateflux[Ivdisp, :, :]
+            # only time the NNLS fits; the projection is timed by templates2data
+            t0 = time.time()
+            for jj, ii in enumerate(indx):
+                # warm-start from the nearest grid point already fitted
+                done = np.array(list(chi2grid.keys()), int)
+                passive = coeff[done[np.argmin(np.abs(done - ii))]] > 0 if len(done) > 0 else None
+                coeff[ii], chi2grid[ii] = self._nnls_gram(ztemplateflux[:, :, jj], flux, ivar, passive=passive)
+            self.timer.add('NNLS', time.time()-t0)
+
+        # coarse pass, always including both ends of the grid
+        icoarse = np.unique(np.hstack((np.arange(0, nvdisp, coarse_step), nvdisp-1)))
+        _fit(icoarse)
+        imin = icoarse[find_minima([chi2grid[ii] for ii in icoarse])[0]]
+
+        # fine pass; widen the bracket until the minimum is in its interior (or
+        # at the edge of the grid)
+        lo, hi = max(imin - coarse_step, 0), min(imin + coarse_step, nvdisp-1)
+        while True:
+            _fit(np.arange(lo, hi+1))
+            ifine = np.arange(lo, hi+1)
+            imin = ifine[find_minima([chi2grid[ii] for ii in ifine])[0]]
+            if (imin == lo and lo > 0) or (imin == hi and hi < nvdisp-1):
+                lo, hi = max(lo - coarse_step, 0), min(hi + coarse_step, nvdisp-1)
+            else:
+                break
+
+        _, vdispbest, vdispivar, chi2min = self._minfit_chi2grid(
+            self.vdisp[ifine], np.array([chi2grid[ii] for ii in ifine]))
+
+        return chi2min, vdispbest, vdispivar, len(chi2grid)
+
     def _call_nnls(self, modelflux, flux, ivar, xparam=None, debug=False,
                    interpolate_coeff=False, xlabel=None):
-        """Wrapper on nnls.
+        """Wrapper on the (Gram-matrix) NNLS solver, :func:`fastspecfit.fnnls.nnls_gram`
+        (see `_nnls_gram`).
 
         Works with both spectroscopic and photometric input and with both 2D and
         3D model spectra.
@@ -448,52 +1231,32 @@ class FastFit(ContinuumTools):
           an array or grid of xparam
 
         """
-        from scipy.optimize import nnls
-        from fastspecfit.util import find_minima, minfit
+        t0 = time.time()
         
-        if xparam is not None:
-            nn = len(xparam)
-
-        inverr = np.sqrt(ivar)
-        bvector = flux * inverr
-
         # If xparam is None (equivalent to modelflux having just two
         # dimensions, [npix,nage]), assume we are just finding the
         # coefficients at some best-fitting value...
         if xparam is None:
-            Amatrix = modelflux * inverr[:, np.newaxis]
-            try:
-                coeff, rnorm = nnls(A=Amatrix, b=bvector)
-            except RuntimeError:
-                coeff, _ = nnls(A=Amatrix, b=bvector, maxiter=Amatrix.shape[1] * 100)                
-            chi2 = np.sum(ivar * (flux - modelflux.dot(coeff))**2)
+            coeff, chi2 = self._nnls_gram(modelflux, flux, ivar)
+            self.timer.add('NNLS', time.time()-t0)
             return coeff, chi2
 
-        # ...otherwise iterate over the xparam (e.g., AV or vdisp) dimension.
-        Amatrix = modelflux * inverr[:, np.newaxis, np.newaxis] # reshape into [npix/nband,nage,nAV/nvdisp]
+        # ...otherwise iterate over the xparam (e.g., AV or vdisp) dimension,
+        # warm-starting each fit from (the positive set of) the solution at
+        # the previous grid point, which is accepted as is if it satisfies the
+        # KKT conditions (see `_solve_vdisp_coarse`).
+        nn = len(xparam)
         coeff, chi2grid = [], []
+        passive = None
         for ii in np.arange(nn):
-            _coeff, _ = nnls(A=Amatrix[:, :, ii], b=bvector)
-            chi2 = np.sum(ivar * (flux - modelflux[:, :, ii].dot(_coeff))**2)
+            _coeff, chi2 = self._nnls_gram(modelflux[:, :, ii], flux, ivar, passive=passive)
+            passive = _coeff > 0
             coeff.append(_coeff)
             chi2grid.append(chi2)
         coeff = np.array(coeff)
         chi2grid = np.array(chi2grid)
         
-        try:
-            imin = find_minima(chi2grid)[0]
-            xbest, xerr, chi2min, warn = minfit(xparam[imin-1:imin+2], chi2grid[imin-1:imin+2])
-        except:
-            errmsg = 'A problem was encountered minimizing chi2.'
-            self.log.warning(errmsg)
-            imin, xbest, xerr, chi2min, warn = 0, 0.0, 0.0, 0.0, 1
-
-        if warn == 0:
-            xivar = 1.0 / xerr**2
-        else:
-            chi2min = 0.0
-            xivar = 0.0
-            xbest = xparam[0]
+        imin, xbest, xivar, chi2min = self._minfit_chi2grid(xparam, chi2grid)
 
         # optionally interpolate the coefficients
         if interpolate_coeff:
@@ -510,6 +1273,8 @@ class FastFit(ContinuumTools):
             # interpolate the coefficients
             #np.interp(xbest, xparam, np.arange(len(xparam)))            
 
+        self.timer.add('NNLS', time.time()-t0)
+
         if debug:
             if xivar > 0:
                 leg = r'${:.3f}\pm{:.3f}\ (\chi^2_{{min}}={:.2f})$'.format(xbest, 1/np.sqrt(xivar), chi2min)
@@ -560,7 +1325,11 @@ class FastFit(ContinuumTools):
             SNR_R>3) and REDSHIFT<1).
 
         """
+        from fastspecfit.util import FitFlagMask
+
         tall = time.time()
+        self._tstart = tall # start the per-object clock
+        self.nnls_failed = False
 
         redshift = result['Z']
 
@@ -593,16 +1362,29 @@ class FastFit(ContinuumTools):
 
             if np.all(objflamivar == 0):
                 self.log.info('All photometry is masked.')
-                coeff = np.zeros(self.nsed, 'f4')
+                coeff = np.zeros(nage, 'f4')
                 rchi2_cont, rchi2_phot = 0.0, 0.0
                 sedmodel = np.zeros(len(self.templatewave))
+                dn4000_model = 0.0
             else:
-               # Get the coefficients and chi2 at the nominal velocity dispersion. 
+               # Get the coefficients and chi2 at the nominal velocity
+               # dispersion, optionally using the photometry lookup table.
                t0 = time.time()
-               sedtemplates, sedphot = self.templates2data(
-                   self.templateflux_nomvdisp[:, agekeep], self.templatewave, 
-                   redshift=redshift, vdisp=None, synthphot=True, 
-                   south=data['photsys'] == 'S')
+               use_lut = (self.phot_lut is not None and redshift > 0 and
+                          self.phot_lut['zgrid'][0] <= redshift <= self.phot_lut['zgrid'][-1])
+               if use_lut:
+                   if data['photsys'] == 'S':
+                       filters = self.decamwise
+                   else:
+                       filters = self.bassmzlswise
+                   sedmaggies = self.phot_lut_maggies(redshift, south=data['photsys'] == 'S')[:, agekeep]
+                   sedphot = self.parse_photometry(self.bands, sedmaggies, filters.effective_wavelengths.value,
+                                                   nanomaggies=False)
+               else:
+                   sedtemplates, sedphot = self.templates2data(
+                       self.templateflux_nomvdisp[:, agekeep], self.templatewave, 
+                       redshift=redshift, vdisp=None, synthphot=True, 
+                       south=data['photsys'] == 'S')
                sedflam = sedphot['flam'].data * self.massnorm * self.fluxnorm
    
                coeff, rchi2_phot = self._call_nnls(sedflam, objflam, objflamivar)
@@ -616,13 +1398,19 @@ class FastFit(ContinuumTools):
                    sedmodel = np.zeros(len(self.templatewave))
                    dn4000_model = 0.0
                else:
-                   sedmodel = sedtemplates.dot(coeff)
-
-                   # Measure Dn(4000) from the line-free model.
-                   sedtemplates_nolines, _ = self.templates2data(
-                       self.templateflux_nolines_nomvdisp[:, agekeep], self.templatewave, 
-                       redshift=redshift, vdisp=None, synthphot=False)
-                   sedmodel_nolines = sedtemplates_nolines.dot(coeff)
+                   if use_lut:
+                       # Only redshift the best-fitting model(s).
+                       _, T = self.redshift_templatewave(self.templatewave, redshift)
+                       sedmodel = T * self.templateflux_nomvdisp[:, agekeep].dot(coeff)
+                       sedmodel_nolines = T * self.templateflux_nolines_nomvdisp[:, agekeep].dot(coeff)
+                   else:
+                       sedmodel = sedtemplates.dot(coeff)
+
+                       # Measure Dn(4000) from the line-free model.
+                       sedtemplates_nolines, _ = self.templates2data(
+                           self.templateflux_nolines_nomvdisp[:, agekeep], self.templatewave, 
+                           redshift=redshift, vdisp=None, synthphot=False)
+                       sedmodel_nolines = sedtemplates_nolines.dot(coeff)
 
                    dn4000_model, _ = self.get_dn4000(self.templatewave, sedmodel_nolines, rest=True)
                    self.log.info('Model Dn(4000)={:.3f}.'.format(dn4000_model))
@@ -665,31 +1453,38 @@ class FastFit(ContinuumTools):
     
             if self.solve_vdisp or compute_vdisp:
                 t0 = time.time()
-                ztemplateflux_vdisp, _ = self.templates2data(
-                    self.vdispflux, self.vdispwave, # [npix,vdispnsed,nvdisp]
-                    redshift=redshift, specwave=data['wave'], specres=data['res'],
-                    cameras=data['cameras'], synthphot=False, stack_cameras=True)
-
-                #ztemplateflux_vdisp = np.concatenate(ztemplateflux_vdisp, axis=0)  # [npix,vdispnsed*nvdisp]
-                #ztemplateflux_vdisp = ztemplateflux_vdisp.reshape(npix, self.vdispnsed, self.nvdisp) # [vdispnpix,vdispnsed,nvdisp]
-
-                # normalize to the median
-                #ztemplateflux_vdisp /= np.median(ztemplateflux_vdisp, axis=0)[np.newaxis, :, :]
-
-                #import matplotlib.pyplot as plt
-                #plt.clf()
-                #plt.plot(specwave[Ivdisp], specflux[Ivdisp] / specsmooth[Ivdisp])
-                #for ii in np.arange(11):
-                #    plt.plot(specwave[Ivdisp], ztemplateflux_vdisp[Ivdisp, 20, ii])
-                #plt.savefig('junk.png')
+                if self.vdisp_search == 'coarse':
+                    vdispchi2min, vdispbest, vdispivar, nfit = self._solve_vdisp_coarse(
+                        data, redshift, Ivdisp, specflux, specivar)
+                    self.log.info('Fitting for the velocity dispersion with {}/{} grid points took {:.2f} seconds.'.format(
+                        nfit, self.nvdisp, time.time()-t0))
+                else:
+                    ztemplateflux_vdisp, _ = self.templates2data(
+                        self.vdispflux, self.vdispwave, # [npix,vdispnsed,nvdisp]
+                        redshift=redshift, specwave=data['wave'], specres=data['res'],
+                        cameras=data['cameras'], synthphot=False, stack_cameras=True)
+
+                    #ztemplateflux_vdisp = np.concatenate(ztemplateflux_vdisp, axis=0)  # [npix,vdispnsed*nvdisp]
+                    #ztemplateflux_vdisp = ztemplateflux_vdisp.reshape(npix, self.vdispnsed, self.nvdisp) # [vdispnpix,vdispnsed,nvdisp]
+
+                    # normalize to the median
+                    #ztemplateflux_vdisp /= np.median(ztemplateflux_vdisp, axis=0)[np.newaxis, :, :]
+
+                    #import matplotlib.pyplot as plt
+                    #plt.clf()
+                    #plt.plot(specwave[Ivdisp], specflux[Ivdisp] / specsmooth[Ivdisp])
+                    #for ii in np.arange(11):
+                    #    plt.plot(specwave[Ivdisp], ztemplateflux_vdisp[Ivdisp, 20, ii])
+                    #plt.savefig('junk.png')
     
-                vdispchi2min, vdispbest, vdispivar, _ = self._call_nnls(
-                    ztemplateflux_vdisp[Ivdisp, :, :], 
-                    specflux[Ivdisp], specivar[Ivdisp],
-                    #specflux[Ivdisp]/specsmooth[Ivdisp], specivar[Ivdisp]*specsmooth[Ivdisp]**2,
-                    xparam=self.vdisp, xlabel=r'$\sigma$ (km/s)', debug=False)
-                self.log.info('Fitting for the velocity dispersion with {} models took {:.2f} seconds.'.format(
-                    self.vdispnsed, time.time()-t0))
+                    vdispchi2min, vdispbest, vdispivar, _ = self._call_nnls(
+                        ztemplateflux_vdisp[Ivdisp, :, :], 
+                        specflux[Ivdisp], specivar[Ivdisp],
+                        #specflux[Ivdisp]/specsmooth[Ivdisp], specivar[Ivdisp]*specsmooth[Ivdisp]**2,
+                        xparam=self.vdisp, xlabel=r'$\sigma$ (km/s)', debug=False)
+                    self.log.info('Fitting for the velocity dispersion with {} models took {:.2f} seconds.'.format(
+                        self.vdispnsed, time.time()-t0))
+                self.timer.add('VDISP', time.time()-t0)
 
                 if vdispivar > 0:
                     # Require vdisp to be measured with S/N>1, which protects
@@ -728,18 +1523,30 @@ class FastFit(ContinuumTools):
                 input_templateflux = self.templateflux[:, agekeep]
                 input_templateflux_nolines = self.templateflux_nolines[:, agekeep]
 
-            desitemplates, desitemplatephot = self.templates2data(
+            # Project the templates with and without line-emission together
+            # (broadening them just once), both onto the data and onto the
+            # full-wavelength (SED) grid, and then split them.
+            input_templateflux = np.hstack((input_templateflux, input_templateflux_nolines))
+            if use_vdisp is not None:
+                input_templateflux = self.broaden_templates(input_templateflux, self.templatewave, use_vdisp)
+
+            desitemplates, _ = self.templates2data(
                 input_templateflux, self.templatewave, redshift=redshift, 
                 specwave=data['wave'], specres=data['res'], specmask=data['mask'], 
-                vdisp=use_vdisp, cameras=data['cameras'], stack_cameras=True, 
-                synthphot=True, south=data['photsys'] == 'S')
+                cameras=data['cameras'], stack_cameras=True, synthphot=False)
+            desitemplates, desitemplates_nolines = desitemplates[:, :nage], desitemplates[:, nage:]
+
+            sedtemplates, _ = self.templates2data(input_templateflux, self.templatewave, 
+                                                  redshift=redshift, synthphot=False)
+            sedtemplates, sedtemplates_nolines = sedtemplates[:, :nage], sedtemplates[:, nage:]
+
+            # The SED-space templates are the redshifted templates, so we can
+            # synthesize the photometry directly from them.
+            desitemplatephot = self.synthesize_photometry(sedtemplates, ztemplatewave, south=data['photsys'] == 'S')
             desitemplateflam = desitemplatephot['flam'].data * self.massnorm * self.fluxnorm
 
             apercorrs, apercorr = np.zeros(len(self.synth_bands), 'f4'), 0.0
 
-            sedtemplates, _ = self.templates2data(input_templateflux, self.templatewave, 
-                                                  vdisp=use_vdisp, redshift=redshift,
-                                                  synthphot=False)
             if self.nophoto:
                 self.log.info('Skipping aperture correction since --nophoto was set.')
                 apercorrs, apercorr = np.ones(len(self.synth_bands), 'f4'), 1.0
@@ -753,7 +1560,7 @@ class FastFit(ContinuumTools):
                     # sure we get the z-band correct.
                     quicksedflux = sedtemplates.dot(quickcoeff)
                     
-                    quickmaggies = np.array(filters_in.get_ab_maggies(quicksedflux / self.fluxnorm, ztemplatewave).as_array().tolist()[0])
+                    quickmaggies = self.filter_weights(filters_in, ztemplatewave).dot(quicksedflux / self.fluxnorm)
                     quickphot = self.parse_photometry(self.synth_bands, quickmaggies, filters_in.effective_wavelengths.value, nanomaggies=False)
     
                     numer = np.hstack([data['phot']['nanomaggies'][data['phot']['band'] == band]
@@ -780,12 +1587,6 @@ class FastFit(ContinuumTools):
             # Performing the final fit using the line-free templates in the
             # spectrum (since we mask those pixels) but the photometry
             # synthesized from the templates with lines.
-            desitemplates_nolines, _ = self.templates2data(
-                input_templateflux_nolines, self.templatewave, redshift=redshift, 
-                specwave=data['wave'], specres=data['res'], specmask=data['mask'], 
-                vdisp=use_vdisp, cameras=data['cameras'], stack_cameras=True, 
-                synthphot=False)
-
             coeff, rchi2_cont = self._call_nnls(np.vstack((desitemplateflam, desitemplates_nolines)),
                                                 np.hstack((objflam, specflux * apercorr)),
                                                 np.hstack((objflamivar, specivar / apercorr**2)))
@@ -813,10 +1614,6 @@ class FastFit(ContinuumTools):
                 desimodel_nolines = desitemplates_nolines.dot(coeff)
 
                 # Measure Dn(4000) from the line-free model.
-                sedtemplates_nolines, _ = self.templates2data(
-                    input_templateflux_nolines, self.templatewave, 
-                    vdisp=use_vdisp, redshift=redshift,
-                    synthphot=False)
                 sedmodel_nolines = sedtemplates_nolines.dot(coeff)
                
                 dn4000_model, _ = self.get_dn4000(self.templatewave, sedmodel_nolines, rest=True)
@@ -846,9 +1643,10 @@ class FastFit(ContinuumTools):
                 I = (specflux == 0.0) * (specivar == 0.0)
                 if np.any(I):
                     residuals[I] = 0.0
-                _smooth_continuum, _ = self.smooth_continuum(
-                    specwave, residuals, specivar / apercorr**2,
-                    redshift, linemask=linemask, png=png)
+                with self.timer('SMOOTHCONTINUUM'):
+                    _smooth_continuum, _ = self.smooth_continuum(
+                        specwave, residuals, specivar / apercorr**2,
+                        redshift, linemask=linemask, png=png)
 
             # Unpack the continuum into individual cameras.
             continuummodel, smooth_continuum = [], []
@@ -891,6 +1689,8 @@ class FastFit(ContinuumTools):
         #    logmstar, absmag[np.isin(self.absmag_bands, 'sdss_r')][0], AV, age, sfr, zzsun, fagn))
 
         # Pack it in and return.
+        if self.nnls_failed:
+            result['FITFLAG'] |= FitFlagMask.NNLS_FAILED
         result['COEFF'][agekeep] = coeff
         result['RCHI2_CONT'] = rchi2_cont
         result['RCHI2_PHOT'] = rchi2_phot
@@ -926,6 +1726,7 @@ class FastFit(ContinuumTools):
             result['DN4000_IVAR'] = dn4000_ivar
 
         log.info('Continuum-fitting took {:.2f} seconds.'.format(time.time()-tall))
+        self.timer.add('CONTINUUM', time.time()-tall)
 
         if fastphot:
             return sedmodel, None
@@ -935,6 +1736,197 @@ class FastFit(ContinuumTools):
             smooth_continuum = [_smooth_continuum / apercorr for _smooth_continuum in smooth_continuum]
             return continuummodel, smooth_continuum
 
+    def fastphot_batch(self, redshift, nanomaggies, ivarnanomaggies, photsys,
+                       chunksize=5000):
+        """Fit the broadband photometry of many objects at once.
+
+        Array version of `continuum_specfit` with `fastphot=True`. The template
+        photometry is interpolated from the lookup table (see
+        :meth:`fastspecfit.continuum.ContinuumTools.init_phot_lut`, which is
+        built if necessary), all the NNLS problems are solved in a single
+        compiled loop (see :func:`fastspecfit.fnnls.nnls_batch`), and the
+        K-corrections, absolute magnitudes, physical properties, and
+        luminosities are computed with array operations.
+
+        Parameters
+        ----------
+        redshift : :class:`numpy.ndarray` [nobj]
+            Redshifts (all greater than zero).
+        nanomaggies : :class:`numpy.ndarray` [nobj, nband]
+            Photometry in `self.bands`, corrected for Galactic extinction (see
+            :func:`fastspecfit.io.DESISpectra.unpack_photometry`).
+        ivarnanomaggies : :class:`numpy.ndarray` [nobj, nband]
+            Inverse variance of `nanomaggies`.
+        photsys : :class:`numpy.ndarray` [nobj]
+            Photometric system of each object (`S` for DECaLS; otherwise
+            BASS/MzLS).
+        chunksize : :class:`int`, optional, defaults to 5000
+            Maximum number of objects to process at a time, which sets the
+            peak memory usage.
+
+        Returns
+        -------
+        :class:`astropy.table.Table`
+            Table with all the continuum-fitting results with columns
+            documented in :func:`self.init_output` (with `fastphot=True`).
+
+        Notes
+        -----
+        The synthesized model photometry (and therefore the K-corrections)
+        is interpolated from the lookup table, so it may differ very slightly
+        from the values computed by `continuum_specfit` without the table.
+
+        """
+        from fastspecfit.fnnls import nnls_batch
+        from fastspecfit.util import FitFlagMask
+
+        tall = time.time()
+
+        redshift = np.atleast_1d(np.asarray(redshift, dtype='f8'))
+        nanomaggies = np.atleast_2d(np.asarray(nanomaggies, dtype='f8'))
+        ivarnanomaggies = np.atleast_2d(np.asarray(ivarnanomaggies, dtype='f8'))
+        photsys = np.atleast_1d(np.asarray(photsys)).astype(str)
+        nobj = len(redshift)
+
+        if np.any(redshift <= 0):
+            errmsg = 'All redshifts must be greater than zero.'
+            self.log.critical(errmsg)
+            raise ValueError(errmsg)
+
+        if not np.all(ivarnanomaggies >= 0):
+            errmsg = 'Some ivarmaggies are negative!'
+            self.log.critical(errmsg)
+            raise ValueError(errmsg)
+
+        if self.phot_lut is None:
+            self.init_phot_lut()
+        zgrid = self.phot_lut['zgrid']
+
+        nband = len(self.bands)
+        grz = np.isin(self.bands, ['g', 'r', 'z'])
+
+        result = self.init_output(nobj, fastphot=True)
+        result['Z'] = redshift
+        result['VDISP'] = self.vdisp_nominal
+
+        for ichunk in np.arange(0, nobj, chunksize):
+            I = np.arange(ichunk, min(ichunk+chunksize, nobj))
+            zobj = redshift[I]
+            south = photsys[I] == 'S'
+
+            # Convert to flam and add the minimum uncertainty in quadrature
+            # (see `parse_photometry`).
+            lambda_eff = np.where(south[:, np.newaxis], self.decamwise.effective_wavelengths.value,
+                                  self.bassmzlswise.effective_wavelengths.value)
+            factor = 10**(-0.4 * 48.6) * C_LIGHT * 1e13 / lambda_eff**2 # [maggies-->erg/s/cm2/A]
+
+            maggies = nanomaggies[I, :]
+            ivarmaggies = ivarnanomaggies[I, :].copy()
+            good = (maggies != 0) * (ivarmaggies > 0)
+            if np.any(good):
+                magfactor = 2.5 / np.log(10.)
+                magerr = magfactor / (np.sqrt(ivarmaggies[good]) * maggies[good])
+                magerr2 = magerr**2 + np.broadcast_to(self.min_uncertainty, maggies.shape)[good]**2
+                ivarmaggies[good] = magfactor**2 / (maggies[good]**2 * magerr2)
+
+            objflam = 1e-9 * maggies * factor * self.fluxnorm
+            objflamivar = (ivarmaggies / (1e-9 * factor)**2 / self.fluxnorm**2) * self.bands_to_fit
+
+            # Require at least one photometric optical band.
+            if not self.nophoto:
+                objflamivar[np.all(objflamivar[:, grz] == 0.0, axis=1), :] = 0.0
+
+            # Optionally ignore templates which are older than the age of the
+            # universe at the redshift of the object.
+            if self.constrain_age:
+                agekeep = self.younger_than_universe_mask(zobj)
+            else:
+                agekeep = np.ones((len(I), self.nsed), bool)
+
+            # Template photometry, from the lookup table where possible.
+            sedmaggies = np.zeros((len(I), nband, self.nsed))
+            inlut = (zobj >= zgrid[0]) * (zobj <= zgrid[-1])
+            for photsouth in [True, False]:
+                J = np.where(inlut * (south == photsouth))[0]
+                if len(J) > 0:
+                    sedmaggies[J, :, :] = self.phot_lut_maggies(zobj[J], south=photsouth)
+            for iobj in np.where(~inlut)[0]:
+                if south[iobj]:
+                    filters = self.decamwise
+                else:
+                    filters = self.bassmzlswise
+                ztemplatewave, T = self.redshift_templatewave(self.templatewave, zobj[iobj])
+                sedmaggies[iobj, :, :] = self.filter_weights(filters, ztemplatewave).dot(
+                    self.templateflux_nomvdisp * T[:, np.newaxis]) / (self.fluxnorm * self.massnorm)
+            sedflam = sedmaggies * factor[:, :, np.newaxis] * self.massnorm * self.fluxnorm
+
+            try:
+                coeff, chi2 = nnls_batch(sedflam, objflam, objflamivar, keep=agekeep)
+            except Exception as err:
+                # fall back to fitting the objects one at a time, so only the
+                # objects which actually fail are flagged
+                self.log.warning('Batch NNLS fit failed ({}: {}); refitting the objects one at a time.'.format(
+                    type(err).__name__, err))
+                coeff, chi2 = np.zeros((len(I), self.nsed)), np.zeros(len(I))
+                for iobj in range(len(I)):
+                    self.nnls_failed = False
+                    K = agekeep[iobj, :]
+                    coeff[iobj, K], chi2[iobj] = self._nnls_gram(sedflam[iobj, :, :][:, K], objflam[iobj, :],
+                                                                 objflamivar[iobj, :])
+                    if self.nnls_failed:
+                        result['FITFLAG'][I[iobj]] |= FitFlagMask.NNLS_FAILED
+            nfit = np.sum(objflamivar > 0, axis=1)
+            rchi2_phot = np.zeros(len(I))
+            rchi2_phot[nfit > 0] = chi2[nfit > 0] / nfit[nfit > 0] # dof???
+
+            result['COEFF'][I] = coeff
+            result['RCHI2_PHOT'][I] = rchi2_phot
+            result['RCHI2_CONT'][I] = rchi2_phot # equivalent
+            self.log.info('Fitted {}/{} objects.'.format(I[-1]+1, nobj))
+
+            fitted = np.any(coeff != 0, axis=1)
+            if not np.any(fitted):
+                continue
+            F = I[fitted]
+            coeff = coeff[fitted, :]
+
+            bestmaggies = self.massnorm * np.einsum('ibj,ij->ib', sedmaggies[fitted, :, :], coeff)
+            for iband, band in enumerate(self.bands):
+                result['FLUX_SYNTH_PHOTMODEL_{}'.format(band.upper())][F] = 1e9 * bestmaggies[:, iband]
+
+            result['DN4000_MODEL'][F] = self.get_dn4000_batch(self.templateflux_nolines_nomvdisp, coeff)
+
+            kcorr, absmag, ivarabsmag, lums, cfluxes = self.kcorr_and_absmag_batch(
+                zobj[fitted], nanomaggies[F, :], ivarnanomaggies[F, :], south[fitted],
+                coeff, bestmaggies)
+            for iband, band in enumerate(self.absmag_bands):
+                result['KCORR_{}'.format(band.upper())][F] = kcorr[:, iband]
+                result['ABSMAG_{}'.format(band.upper())][F] = absmag[:, iband]
+                result['ABSMAG_IVAR_{}'.format(band.upper())][F] = ivarabsmag[:, iband]
+            for key in lums.keys():
+                result[key][F] = lums[key]
+            for key in cfluxes.keys():
+                result[key][F] = cfluxes[key]
+
+            # mean physical properties (see `get_mean_property`)
+            for prop, col, normalization, log10 in zip(
+                    ['av', 'age', 'zzsun', 'mstar', 'sfr'], ['AV', 'AGE', 'ZZSUN', 'LOGMSTAR', 'SFR'],
+                    [None, 1e9, None, 1/self.massnorm, 1/self.massnorm], [False, False, False, True, False]):
+                meanvalue = coeff.dot(self.templateinfo[prop])
+                # the coefficients include the stellar mass normalization
+                if prop != 'mstar' and prop != 'sfr':
+                    meanvalue /= np.sum(coeff, axis=1)
+                if normalization:
+                    meanvalue /= normalization
+                if log10:
+                    meanvalue[meanvalue > 0] = np.log10(meanvalue[meanvalue > 0])
+                result[col][F] = meanvalue
+
+        self.log.info('Fitting the photometry of {} objects took {:.2f} seconds.'.format(
+            nobj, time.time()-tall))
+
+        return result
+
     def build_linemodels(self, redshift, wavelims=[3000, 10000], verbose=False, strict_finalmodel=True):
         """Build all the multi-parameter emission-line models we will use.
     
@@ -1512,27 +2504,90 @@ class FastFit(ContinuumTools):
 
         linemodel['value'] = linemodel['initial'] # copy
 
+    def _over_budget(self):
+        """Return `True` if the current object has exceeded its (soft) time
+        budget.
+
+        """
+        if self.time_budget is None:
+            return False
+        return (time.time() - self._tstart) > self.time_budget
+
+    def _budget_maxiter(self, result):
+        """Maximum number of function evaluations for the next emission-line
+        fit, capped (and flagged in `result`) if the time budget has been
+        exceeded.
+
+        """
+        from fastspecfit.util import FitFlagMask
+
+        if self._over_budget():
+            if not result['FITFLAG'] & FitFlagMask.NFEV_CAPPED:
+                self.log.warning('Time budget of {:.1f} seconds exceeded; capping the number of function evaluations at {}.'.format(
+                    self.time_budget, self.maxiter_overbudget))
+            result['FITFLAG'] |= FitFlagMask.NFEV_CAPPED
+            return min(self.maxiter, self.maxiter_overbudget)
+        return self.maxiter
+
     def _optimize(self, linemodel, emlinewave, emlineflux, weights, 
-                  redshift, resolution_matrix, camerapix, debug=False):
+                  redshift, resolution_matrix, camerapix, maxiter=None,
+                  debug=False):
         """Wrapper to call the least-squares minimization given a linemodel.
 
         """
         from scipy.optimize import least_squares
-        from fastspecfit.emlines import _objective_function
+        from fastspecfit.emlines import (_objective_function, EMLineJacobian, EMLineVarPro,
+                                         emline_jac_sparsity)
 
         parameters, (Ifree, Itied, tiedtoparam, tiedfactor, bounds, doubletindx, doubletpair, \
                      linewaves) = self._linemodel_to_parameters(linemodel)
         self.log.debug('Optimizing {} free parameters'.format(len(Ifree)))
 
+        if maxiter is None:
+            maxiter = self.maxiter
+
         farg = (emlinewave, emlineflux, weights, redshift, self.log10wave, 
                 resolution_matrix, camerapix, parameters, ) + \
                 (Ifree, Itied, tiedtoparam, tiedfactor, doubletindx, 
-                 doubletpair, linewaves)
-
-        fit_info = least_squares(_objective_function, parameters[Ifree], args=farg, max_nfev=self.maxiter, 
-                                 xtol=self.accuracy, tr_solver='lsmr', tr_options={'regularize': True},
-                                 method='trf', bounds=tuple(zip(*bounds)))#, verbose=2)
-        parameters[Ifree] = fit_info.x
+                 doubletpair, linewaves, self.emline_profile)
+
+        if self.emline_varpro:
+            # variable projection: only optimize the kinematic parameters (and
+            # doublet ratios) and solve for the amplitudes linearly
+            if self.emline_jac == 'analytic':
+                varpro = EMLineVarPro(bounds, *farg, jacobian=EMLineJacobian(
+                    self.log10wave, emlinewave, camerapix, profile=self.emline_profile))
+                jac = varpro.jac
+            else:
+                varpro = EMLineVarPro(bounds, *farg)
+                jac = self.emline_jac
+
+            # with no free nonlinear parameters the amplitudes are just solved for
+            x, nfev = varpro.x0, 0
+            if len(x) > 0:
+                fit_info = least_squares(varpro.objective, x, jac=jac, max_nfev=maxiter,
+                                         xtol=self.accuracy, tr_solver='lsmr', tr_options={'regularize': True},
+                                         method='trf', bounds=varpro.bounds)
+                x, nfev = fit_info.x, fit_info.nfev
+            parameters[Ifree] = varpro.free_parameters(x)
+        else:
+            if self.emline_jac == 'analytic':
+                jac = EMLineJacobian(self.log10wave, emlinewave, camerapix, profile=self.emline_profile)
+                jac_sparsity = None
+            else:
+                # finite differences, perturbing the parameters which affect
+                # disjoint sets of pixels together
+                jac = self.emline_jac
+                jac_sparsity = emline_jac_sparsity(redshift, emlinewave, camerapix, parameters, Ifree,
+                                                   Itied, tiedtoparam, tiedfactor, bounds, doubletindx,
+                                                   doubletpair, linewaves)
+
+            fit_info = least_squares(_objective_function, parameters[Ifree], jac=jac, jac_sparsity=jac_sparsity,
+                                     args=farg, max_nfev=maxiter, 
+                                     xtol=self.accuracy, tr_solver='lsmr', tr_options={'regularize': True},
+                                     method='trf', bounds=tuple(zip(*bounds)))#, verbose=2)
+            parameters[Ifree] = fit_info.x
+            nfev = fit_info.nfev
 
         # Conditions for dropping a parameter (all parameters, not just those
         # being fitted):
@@ -1591,7 +2646,7 @@ class FastFit(ContinuumTools):
         
         out_linemodel = linemodel.copy()
         out_linemodel['value'] = parameters
-        out_linemodel.meta['nfev'] = fit_info['nfev']
+        out_linemodel.meta['nfev'] = nfev
 
         if False:
             bestfit = self.bestfit(out_linemodel, redshift, emlinewave, resolution_matrix, camerapix)
@@ -1644,7 +2699,7 @@ class FastFit(ContinuumTools):
         emlinemodel = build_emline_model(self.log10wave, redshift, lineamps, 
                                          linevshifts, linesigmas, linewaves, 
                                          emlinewave, resolution_matrix,
-                                         camerapix)
+                                         camerapix, profile=self.emline_profile)
 
         return emlinemodel
 
@@ -1670,7 +2725,8 @@ class FastFit(ContinuumTools):
 
         emlinemodel = build_emline_model(self.log10wave, redshift, lineamps, 
                                          linevshifts, linesigmas, linewaves, 
-                                         specwave, specres, None)
+                                         specwave, specres, None,
+                                         profile=self.emline_profile)
 
         return emlinemodel
 
@@ -1694,7 +2750,7 @@ class FastFit(ContinuumTools):
         modelflux
      
         """
-        from fastspecfit.util import ivar2var
+        from fastspecfit.util import ivar2var, FitFlagMask
 
         tall = time.time()
 
@@ -1740,12 +2796,14 @@ class FastFit(ContinuumTools):
         t0 = time.time()
         initfit = self._optimize(initial_linemodel_nobroad, emlinewave, emlineflux, 
                                  weights, redshift, resolution_matrix, camerapix, 
-                                 debug=False)
+                                 maxiter=self._budget_maxiter(result), debug=False)
         initmodel = self.bestfit(initfit, redshift, emlinewave, resolution_matrix, camerapix)
         initchi2 = self.chi2(initfit, emlinewave, emlineflux, emlineivar, initmodel)
         nfree = np.sum((initfit['fixed'] == False) * (initfit['tiedtoparam'] == -1))
         self.log.info('Initial line-fitting with {} free parameters took {:.2f} seconds [niter={}, rchi2={:.4f}].'.format(
             nfree, time.time()-t0, initfit.meta['nfev'], initchi2))
+        self.timer.add('OPTIMIZE_INIT', time.time()-t0)
+        self.timer.count('NFEV_INIT', initfit.meta['nfev'])
 
         # Now try adding bround Balmer and helium lines and see if we improve
         # the chi2.
@@ -1771,6 +2829,12 @@ class FastFit(ContinuumTools):
         #else:
         #    candidate_broadline = True
             
+        # Skip the broad-line fitting if we are already over our time budget.
+        if broadlinefit and self._over_budget():
+            self.log.warning('Time budget of {:.1f} seconds exceeded; skipping broad-line fitting.'.format(self.time_budget))
+            result['FITFLAG'] |= FitFlagMask.BROADFIT_SKIPPED
+            broadlinefit = False
+
         # Require minimum XX pixels and a minimum 
         if broadlinefit:# and candidate_broadline:
         #if broadlinefit:# and len(broadlinepix) > 0 and len(np.hstack(broadlinepix)) > 10:
@@ -1784,12 +2848,15 @@ class FastFit(ContinuumTools):
 
             t0 = time.time()
             broadfit = self._optimize(initial_linemodel, emlinewave, emlineflux, weights, 
-                                      redshift, resolution_matrix, camerapix, debug=False)
+                                      redshift, resolution_matrix, camerapix, 
+                                      maxiter=self._budget_maxiter(result), debug=False)
             broadmodel = self.bestfit(broadfit, redshift, emlinewave, resolution_matrix, camerapix)
             broadchi2 = self.chi2(broadfit, emlinewave, emlineflux, emlineivar, broadmodel)
             nfree = np.sum((broadfit['fixed'] == False) * (broadfit['tiedtoparam'] == -1))
             self.log.info('Second (broad) line-fitting with {} free parameters took {:.2f} seconds [niter={}, rchi2={:.4f}].'.format(
                 nfree, time.time()-t0, broadfit.meta['nfev'], broadchi2))
+            self.timer.add('OPTIMIZE_BROAD', time.time()-t0)
+            self.timer.count('NFEV_BROAD', broadfit.meta['nfev'])
 
             ## Compare chi2 just in and around the broad lines.
             #broadlinepix = np.hstack(broadlinepix)
@@ -1938,12 +3005,14 @@ class FastFit(ContinuumTools):
         t0 = time.time()
         finalfit = self._optimize(linemodel, emlinewave, emlineflux, weights, 
                                   redshift, resolution_matrix, camerapix, 
-                                  debug=True)
+                                  maxiter=self._budget_maxiter(result), debug=True)
         finalmodel = self.bestfit(finalfit, redshift, emlinewave, resolution_matrix, camerapix)
         finalchi2 = self.chi2(finalfit, emlinewave, emlineflux, emlineivar, finalmodel)
         nfree = np.sum((finalfit['fixed'] == False) * (finalfit['tiedtoparam'] == -1))
         self.log.info('Final line-fitting with {} free parameters took {:.2f} seconds [niter={}, rchi2={:.4f}].'.format(
             nfree, time.time()-t0, finalfit.meta['nfev'], finalchi2))
+        self.timer.add('OPTIMIZE_FINAL', time.time()-t0)
+        self.timer.count('NFEV_FINAL', finalfit.meta['nfev'])
 
         # Residual spectrum with no emission lines.
         specflux_nolines = specflux - finalmodel
@@ -1958,9 +3027,10 @@ class FastFit(ContinuumTools):
         #plt.savefig('desi-users/ioannis/tmp/junk2.png')
 
         # Now fill the output table.
-        self._populate_emtable(result, finalfit, finalmodel, emlinewave, emlineflux,
-                               emlineivar, oemlineivar, specflux_nolines, redshift,
-                               resolution_matrix, camerapix)
+        with self.timer('POPULATE_EMTABLE'):
+            self._populate_emtable(result, finalfit, finalmodel, emlinewave, emlineflux,
+                                   emlineivar, oemlineivar, specflux_nolines, redshift,
+                                   resolution_matrix, camerapix)
 
         # Build the model spectra.
         emmodel = np.hstack(self.emlinemodel_bestfit(data['wave'], data['res'], result, redshift=redshift))
@@ -1990,38 +3060,18 @@ class FastFit(ContinuumTools):
         # interpolation. However, because of round-off, etc., it's probably
         # easiest to use np.interp.
 
-        # package together the final output models for writing; assume constant
-        # dispersion in wavelength!
-        minwave, maxwave, dwave = np.min(data['coadd_wave']), np.max(data['coadd_wave']), np.diff(data['coadd_wave'][:2])[0]
-        minwave = float(int(minwave * 1000) / 1000)
-        maxwave = float(int(maxwave * 1000) / 1000)
-        dwave = float(int(dwave * 1000) / 1000)
-        npix = int((maxwave-minwave)/dwave)+1
-        modelwave = minwave + dwave * np.arange(npix)
-
-        modelspectra = Table()
-        # all these header cards need to be 2-element tuples (value, comment),
-        # otherwise io.write_fastspecfit will crash
-        modelspectra.meta['NAXIS1'] = (npix, 'number of pixels')
-        modelspectra.meta['NAXIS2'] = (npix, 'number of models')
-        modelspectra.meta['NAXIS3'] = (npix, 'number of objects')
-        modelspectra.meta['BUNIT'] = ('10**-17 erg/(s cm2 Angstrom)', 'flux unit')
-        modelspectra.meta['CUNIT1'] = ('Angstrom', 'wavelength unit')
-        modelspectra.meta['CTYPE1'] = ('WAVE', 'type of axis')
-        modelspectra.meta['CRVAL1'] = (minwave, 'wavelength of pixel CRPIX1 (Angstrom)')
-        modelspectra.meta['CRPIX1'] = (0, '0-indexed pixel number corresponding to CRVAL1')
-        modelspectra.meta['CDELT1'] = (dwave, 'pixel size (Angstrom)')
-        modelspectra.meta['DC-FLAG'] = (0, '0 = linear wavelength vector')
-        modelspectra.meta['AIRORVAC'] = ('vac', 'wavelengths in vacuum (vac)')
+        # package together the final output models for writing
+        modelwave, modelspectra = self._init_modelspectra(data['coadd_wave'])
+        npix = len(modelwave)
 
         wavesrt = np.argsort(emlinewave)
         modelcontinuum = np.interp(modelwave, emlinewave[wavesrt], continuummodelflux[wavesrt]).reshape(1, npix)
         modelsmoothcontinuum = np.interp(modelwave, emlinewave[wavesrt], smoothcontinuummodelflux[wavesrt]).reshape(1, npix)
         modelemspectrum = np.interp(modelwave, emlinewave[wavesrt], emmodel[wavesrt]).reshape(1, npix)
         
-        modelspectra.add_column(Column(name='CONTINUUM', dtype='f4', data=modelcontinuum))
-        modelspectra.add_column(Column(name='SMOOTHCONTINUUM', dtype='f4', data=modelsmoothcontinuum))
-        modelspectra.add_column(Column(name='EMLINEMODEL', dtype='f4', data=modelemspectrum))
+        modelspectra['CONTINUUM'][:] = modelcontinuum
+        modelspectra['SMOOTHCONTINUUM'][:] = modelsmoothcontinuum
+        modelspectra['EMLINEMODEL'][:] = modelemspectrum
 
         # Finally, optionally synthesize photometry (excluding the
         # smoothcontinuum!) and measure Dn(4000) from the line-free spectrum.
@@ -2075,6 +3125,7 @@ class FastFit(ContinuumTools):
                 fig.savefig('desi-users/ioannis/tmp/qa-dn4000.png')
 
         log.info('Emission-line fitting took {:.2f} seconds.'.format(time.time()-tall))
+        self.timer.add('EMLINES', time.time()-tall)
 
         if percamera_models:
             errmsg = 'percamera-models option not yet implemented.'
@@ -2083,6 +3134,48 @@ class FastFit(ContinuumTools):
 
         return modelspectra
 
+    @staticmethod
+    def _init_modelspectra(coadd_wave):
+        """Initialize the (zero-valued) output model spectra of a single object
+        on the wavelength grid of the coadded spectrum, assuming constant
+        dispersion in wavelength.
+
+        Returns
+        -------
+        modelwave : :class:`numpy.ndarray`
+            Output wavelength vector [Angstrom].
+        modelspectra : :class:`astropy.table.Table`
+            Single-row table with the CONTINUUM, SMOOTHCONTINUUM, and
+            EMLINEMODEL spectra and the corresponding header cards.
+
+        """
+        minwave, maxwave, dwave = np.min(coadd_wave), np.max(coadd_wave), np.diff(coadd_wave[:2])[0]
+        minwave = float(int(minwave * 1000) / 1000)
+        maxwave = float(int(maxwave * 1000) / 1000)
+        dwave = float(int(dwave * 1000) / 1000)
+        npix = int((maxwave-minwave)/dwave)+1
+        modelwave = minwave + dwave * np.arange(npix)
+
+        modelspectra = Table()
+        # all these header cards need to be 2-element tuples (value, comment),
+        # otherwise io.write_fastspecfit will crash
+        modelspectra.meta['NAXIS1'] = (npix, 'number of pixels')
+        modelspectra.meta['NAXIS2'] = (npix, 'number of models')
+        modelspectra.meta['NAXIS3'] = (npix, 'number of objects')
+        modelspectra.meta['BUNIT'] = ('10**-17 erg/(s cm2 Angstrom)', 'flux unit')
+        modelspectra.meta['CUNIT1'] = ('Angstrom', 'wavelength unit')
+        modelspectra.meta['CTYPE1'] = ('WAVE', 'type of axis')
+        modelspectra.meta['CRVAL1'] = (minwave, 'wavelength of pixel CRPIX1 (Angstrom)')
+        modelspectra.meta['CRPIX1'] = (0, '0-indexed pixel number corresponding to CRVAL1')
+        modelspectra.meta['CDELT1'] = (dwave, 'pixel size (Angstrom)')
+        modelspectra.meta['DC-FLAG'] = (0, '0 = linear wavelength vector')
+        modelspectra.meta['AIRORVAC'] = ('vac', 'wavelengths in vacuum (vac)')
+
+        for col in ['CONTINUUM', 'SMOOTHCONTINUUM', 'EMLINEMODEL']:
+            modelspectra.add_column(Column(name=col, dtype='f4', length=1, shape=(npix,)))
+
+        return modelwave, modelspectra
+
     def _populate_emtable(self, result, finalfit, finalmodel, emlinewave, emlineflux,
                           emlineivar, oemlineivar, specflux_nolines, redshift,
                           resolution_matrix, camerapix):
@@ -2209,7 +3302,8 @@ class FastFit(ContinuumTools):
                         # weight by the per-pixel inverse variance line-profile
                         lineprofile = build_emline_model(self.log10wave, redshift, np.array([result['{}_AMP'.format(linename)]]),
                                                          np.array([result['{}_VSHIFT'.format(linename)]]), np.array([result['{}_SIGMA'.format(linename)]]),
-                                                         np.array([oneline['restwave']]), emlinewave, resolution_matrix, camerapix)
+                                                         np.array([oneline['restwave']]), emlinewave, resolution_matrix, camerapix,
+                                                         profile=self.emline_profile)
                         
                         weight = np.sum(lineprofile[lineindx])
                         if weight == 0.0:
@@ -2400,9 +3494,7 @@ class FastFit(ContinuumTools):
             filters = self.bassmzls
 
         # Pad (simply) in wavelength...
-        padflux, padwave = filters.pad_spectrum(modelflux, modelwave, method='edge')
-        synthmaggies = filters.get_ab_maggies(padflux / self.fluxnorm, padwave)
-        synthmaggies = synthmaggies.as_array().view('f8')
+        synthmaggies = self.filter_weights(filters, modelwave, pad=True).dot(modelflux / self.fluxnorm)
         model_synthphot = self.parse_photometry(self.synth_bands, maggies=synthmaggies,
                                                 nanomaggies=False,
                                                 lambda_eff=filters.effective_wavelengths.value)
@@ -2758,7 +3850,8 @@ class FastFit(ContinuumTools):
                     self.log10wave, redshift, np.array([amp]),
                     np.array([fastspec['{}_VSHIFT'.format(linename)]]),
                     np.array([fastspec['{}_SIGMA'.format(linename)]]),
-                    np.array([oneline['restwave']]), data['wave'], data['res'])
+                    np.array([oneline['restwave']]), data['wave'], data['res'],
+                    profile=self.emline_profile)
                 desiemlines_oneline.append(desiemlines_oneline1)
 
         # Grab the viewer cutout.
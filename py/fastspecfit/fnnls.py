@@ -2,136 +2,469 @@
 fastspecfit.fnnls
 =================
 
-https://github.com/mikeiovine/fast-nnls.git
-
-  This is a Python implementation of the algorithm described in the paper
-  "A Fast Non-Negativity-Constrained Least Squares Algorithm" by
-  Rasmus Bro and Sumen De Jong.
-  
-  Give a matrix `A` and a vector `y`, this algorithm solves `argmin_x ||Ax - y||`.
-  
-  At the time of writing this, there are no readily available Python bindings
-  for this algorithm that I know of.
-  `scipy.optimize.nnls` implements the slower Lawson-Hanson version.
-  
-  ## Usage
-  
+Non-negative least squares (NNLS) on precomputed Gram matrices.
+
+This is a (numba-compiled) implementation of the algorithm described in the
+paper "A Fast Non-Negativity-Constrained Least Squares Algorithm" by Rasmus Bro
+and Sijmen De Jong (J. Chemometrics, 11, 393, 1997), originally adapted from
+https://github.com/mikeiovine/fast-nnls.git.
+
+Given a matrix `A` and a vector `y`, the algorithm solves `argmin_x ||Ax - y||`
+subject to `x >= 0`, but works entirely with `A^T A` and `A^T y`, which are
+small ([n, n] and [n], for n templates) and cheap to compute with a single
+matrix product. `scipy.optimize.nnls` implements the slower Lawson-Hanson
+version on `A` itself.
+
+The solver also accepts an initial passive set (e.g., the non-zero
+coefficients of the solution to a closely related problem, such as the
+neighboring point of a velocity dispersion grid), which usually reduces the
+number of iterations to zero or one.
+
+Solutions which do not satisfy the Karush-Kuhn-Tucker conditions (e.g.,
+nearly degenerate problems, or too many iterations) are re-solved with
+`scipy.optimize.nnls`, so the compiled solver is never less accurate than
+scipy, only faster.
+
+Usage::
+
   A = np.array([[1, 2], [3, 4], [5, 6]])
   y = np.array([1, 2, 3])
-  AtA = A.T.dot(A)
-  Aty = A.T.dot(y)
-  x = fnnls(AtA, Aty)
+  x = fnnls(A.T.dot(A), A.T.dot(y))
+
+  # or, with inverse-variance weights and a warm start
+  x, chi2 = nnls_gram(A, y, ivar, passive=xprevious > 0)
+
+  # or, for a batch of small problems (A is [nobj, m, n])
+  x, chi2 = nnls_batch(A, y, ivar)
 
 """
 import numpy as np
+import numba
+
+@numba.jit(nopython=True)
+def _cholesky_solve(M, b):
+    '''
+    Solve M s = b for a symmetric positive semi-definite matrix M with a
+    Cholesky decomposition. Degenerate (linearly dependent) variables, whose
+    pivots vanish, are set to zero.
+
+    Hand-written rather than np.linalg to avoid the (large) numba compilation
+    overhead of the LAPACK bindings.
+    '''
+    k = len(b)
+    L = np.zeros((k, k))
+    skip = np.zeros(k, dtype=np.bool_)
+
+    tol = 0.0
+    for j in range(k):
+        tol = max(tol, M[j, j])
+    tol *= 10 * k * np.finfo(np.float64).eps
+
+    for j in range(k):
+        d = M[j, j]
+        for p in range(j):
+            d -= L[j, p]**2
+        if d <= tol:
+            skip[j] = True
+            continue
+        L[j, j] = np.sqrt(d)
+        for i in range(j+1, k):
+            v = M[i, j]
+            for p in range(j):
+                v -= L[i, p] * L[j, p]
+            L[i, j] = v / L[j, j]
+
+    z = np.zeros(k)
+    for j in range(k):
+        if skip[j]:
+            continue
+        v = b[j]
+        for p in range(j):
+            v -= L[j, p] * z[p]
+        z[j] = v / L[j, j]
+
+    s = np.zeros(k)
+    for j in range(k-1, -1, -1):
+        if skip[j]:
+            continue
+        v = z[j]
+        for p in range(j+1, k):
+            v -= L[p, j] * s[p]
+        s[j] = v / L[j, j]
+
+    return s
+
+@numba.jit(nopython=True)
+def _solve_passive(AtA, Aty, P):
+    '''
+    Solve the unconstrained normal equations restricted to the passive set P
+    and return the full-length solution vector (zero outside P).
+    '''
+    n = len(Aty)
+    idx = np.where(P)[0]
+    npass = len(idx)
+    s = np.zeros(n)
+    if npass == 0:
+        return s
+
+    AtA_in_p = np.empty((npass, npass))
+    Aty_in_p = np.empty(npass)
+    for ii in range(npass):
+        Aty_in_p[ii] = Aty[idx[ii]]
+        for jj in range(npass):
+            AtA_in_p[ii, jj] = AtA[idx[ii], idx[jj]]
+
+    s_in_p = _cholesky_solve(AtA_in_p, Aty_in_p)
+    for ii in range(npass):
+        s[idx[ii]] = s_in_p[ii]
+
+    return s
+
+@numba.jit(nopython=True)
+def _gradient(AtA, Aty, x):
+    '''
+    Return A^T (y - A x) = Aty - AtA x (as a loop, to avoid BLAS in numba).
+    '''
+    n = len(Aty)
+    w = Aty.copy()
+    for ii in range(n):
+        for jj in range(n):
+            w[ii] -= AtA[ii, jj] * x[jj]
+    return w
+
+@numba.jit(nopython=True)
+def _fnnls(AtA, Aty, P, epsilon, iter_max, kkt_tol=1e-8):
+    '''
+    Numba-friendly Bro & De Jong fast NNLS.
+
+    `P` is the (boolean) initial passive set, which is modified in place and
+    holds the final passive set on output. Returns the solution vector, the
+    number of iterations, and whether the solution satisfies the
+    Karush-Kuhn-Tucker (KKT) conditions to a tolerance `kkt_tol` (relative to
+    the largest gradient at x=0) within `iter_max` iterations.
+
+    The problem is solved with the columns of A scaled to unit norm (which
+    leaves the non-negativity constraints unchanged), so that the pivot
+    tolerance of the Cholesky solver is independent of the (wildly different)
+    normalizations of the templates.
+    '''
+    n = len(Aty)
+
+    scale = np.zeros(n)
+    for jj in range(n):
+        if AtA[jj, jj] > 0.0:
+            scale[jj] = 1.0 / np.sqrt(AtA[jj, jj])
+    AtA = AtA * np.outer(scale, scale)
+    Aty = Aty * scale
+    thresh = epsilon * scale
+    P &= (scale > 0.0)
+
+    x = np.zeros(n)
+    niter = 0
+
+    # Warm start: solve on the initial passive set, dropping the variables
+    # which come out non-positive until the solution is feasible.
+    if np.any(P):
+        s = _solve_passive(AtA, Aty, P)
+        while np.any(P & (s <= 0.0)):
+            P &= (s > 0.0)
+            s = _solve_passive(AtA, Aty, P)
+        x = s
+
+    w = _gradient(AtA, Aty, x)
+
+    # Variables which cannot enter the passive set (until it changes), because
+    # they are degenerate with it (e.g., collinear columns).
+    reject = np.zeros(n, dtype=np.bool_)
+
+    # While R not empty and max_(n \in R) w_n > epsilon
+    while niter < iter_max:
+        m = -1
+        wmax = 0.0
+        for jj in range(n):
+            if not P[jj] and not reject[jj] and scale[jj] > 0.0 and w[jj] > thresh[jj] and w[jj] > wmax:
+                wmax = w[jj]
+                m = jj
+        if m == -1:
+            break
+
+        # Move index from active set to passive set.
+        P[m] = True
+        s = _solve_passive(AtA, Aty, P)
+        niter += 1
+
+        if s[m] <= 0.0:
+            # zero (degenerate) pivot, or no descent
+            P[m] = False
+            reject[m] = True
+            continue
+        reject[:] = False
+
+        while np.any(P & (s <= 0.0)) and niter < iter_max:
+            niter += 1
+
+            # Step from x towards s until the first passive variable hits zero...
+            alpha = np.inf
+            kmin = -1
+            for jj in range(n):
+                if P[jj] and s[jj] <= 0.0:
+                    d = x[jj] - s[jj]
+                    a = x[jj] / d if d > 0.0 else 0.0
+                    if a < alpha:
+                        alpha = a
+                        kmin = jj
+            x += alpha * (s - x)
+            x[kmin] = 0.0
+
+            # ...and move all those variables to the active set.
+            for jj in range(n):
+                if P[jj] and x[jj] <= 0.0:
+                    P[jj] = False
+                    x[jj] = 0.0
+
+            s = _solve_passive(AtA, Aty, P)
+
+        x = s
+        for jj in range(n):
+            if x[jj] < 0.0:
+                x[jj] = 0.0
+        w = _gradient(AtA, Aty, x)
+
+    # KKT conditions: x >= 0, w <= 0 for the active variables, and w = 0 for
+    # the passive ones.
+    tol = kkt_tol * max(np.max(np.abs(Aty)), 1e-300)
+    converged = niter < iter_max
+    for jj in range(n):
+        if scale[jj] == 0.0:
+            continue
+        if x[jj] > 0.0:
+            if abs(w[jj]) > tol:
+                converged = False
+        elif w[jj] > tol:
+            converged = False
+
+    return x * scale, niter, converged
+
+def _nnls_fallback(A, y):
+    """Lawson-Hanson NNLS (:func:`scipy.optimize.nnls`) of A x = y, used when
+    the compiled solver fails to converge.
 
-def fnnls(AtA, Aty, epsilon=None, iter_max=None):
+    """
+    from scipy.optimize import nnls
+    try:
+        x, _ = nnls(A, y)
+    except RuntimeError:
+        x, _ = nnls(A, y, maxiter=A.shape[1] * 100)
+    return x
+
+def fnnls(AtA, Aty, epsilon=None, iter_max=None, P_initial=None):
     """
     Given a matrix A and vector y, find x which minimizes the objective function
-    f(x) = ||Ax - y||^2.
-    This algorithm is similar to the widespread Lawson-Hanson method, but
-    implements the optimizations described in the paper
-    "A Fast Non-Negativity-Constrained Least Squares Algorithm" by
-    Rasmus Bro and Sumen De Jong.
-
-    Note that the inputs are not A and y, but are
-    A^T * A and A^T * y
-
-    This is to avoid incurring the overhead of computing these products
-    many times in cases where we need to call this routine many times.
-
-    :param AtA:       A^T * A. See above for definitions. If A is an (m x n)
-                      matrix, this should be an (n x n) matrix.
-    :type AtA:        numpy.ndarray
-    :param Aty:       A^T * y. See above for definitions. If A is an (m x n)
-                      matrix and y is an m dimensional vector, this should be an
-                      n dimensional vector.
-    :type Aty:        numpy.ndarray
-    :param epsilon:   Anything less than this value is consider 0 in the code.
-                      Use this to prevent issues with floating point precision.
-                      Defaults to the machine precision for doubles.
-    :type epsilon:    float
-    :param iter_max:  Maximum number of inner loop iterations. Defaults to
-                      30 * [number of cols in A] (the same value that is used
-                      in the publication this algorithm comes from).
-    :type iter_max:   int, optional
+    f(x) = ||Ax - y||^2 subject to x >= 0.
+
+    Note that the inputs are not A and y, but are A^T * A and A^T * y, which
+    avoids incurring the overhead of computing these products many times in
+    cases where we need to call this routine many times.
+
+    If the solution does not satisfy the Karush-Kuhn-Tucker conditions within
+    `iter_max` iterations, the problem is re-solved with
+    :func:`scipy.optimize.nnls` on a square root of `AtA`.
+
+    Parameters
+    ----------
+    AtA : :class:`numpy.ndarray` [n, n]
+        A^T * A, where A is an [m, n] matrix.
+    Aty : :class:`numpy.ndarray` [n]
+        A^T * y, where y is an m-dimensional vector.
+    epsilon : :class:`float`, optional
+        Convergence tolerance on the gradient A^T (y - A x) of the active
+        variables. Defaults to a small multiple of the machine precision
+        scaled by `Aty`.
+    iter_max : :class:`int`, optional
+        Maximum number of iterations. Defaults to 30 * n (the same value that
+        is used in the publication this algorithm comes from).
+    P_initial : :class:`numpy.ndarray` [n], optional
+        Boolean initial passive set (warm start), e.g., `xprevious > 0`.
+
+    Returns
+    -------
+    :class:`numpy.ndarray` [n]
+        Solution vector.
 
     """
-    if epsilon is None:
-        epsilon = np.finfo(np.float64).eps
+    AtA = np.ascontiguousarray(AtA, dtype=np.float64)
+    Aty = np.ascontiguousarray(Aty, dtype=np.float64)
 
     n = AtA.shape[0]
 
-    if iter_max is None:
-        iter_max = 30 * n
-
     if Aty.ndim != 1 or Aty.shape[0] != n:
         raise ValueError('Invalid dimension; got Aty vector of size {}, ' \
                          'expected {}'.format(Aty.shape, n))
 
-    # Represents passive and active sets.
-    # If sets[j] is 0, then index j is in the active set (R in literature).
-    # Else, it is in the passive set (P).
-    sets = np.zeros(n, dtype=bool)
-    # The set of all possible indices. Construct P, R by using `sets` as a mask
-    ind = np.arange(n, dtype=int)
-    P = ind[sets]
-    R = ind[~sets]
+    if epsilon is None:
+        epsilon = 10 * n * np.finfo(np.float64).eps * np.max(np.abs(Aty), initial=0.0)
+
+    if iter_max is None:
+        iter_max = 30 * n
 
-    x = np.zeros(n, dtype=np.float64)
-    w = Aty
-    s = np.zeros(n, dtype=np.float64)
+    if P_initial is None:
+        P = np.zeros(n, dtype=np.bool_)
+    else:
+        P = np.array(P_initial, dtype=np.bool_)
 
-    i = 0
-    # While R not empty and max_(n \in R) w_n > epsilon
-    while not np.all(sets) and np.max(w[R]) > epsilon and i < iter_max:
-        # Find index of maximum element of w which is in active set.
-        j = np.argmax(w[R])
-        # We have the index in MASKED w.
-        # The real index is stored in the j-th position of R.
-        m = R[j]
+    x, _, converged = _fnnls(AtA, Aty, P, epsilon, iter_max)
 
-        # Move index from active set to passive set.
-        sets[m] = True
-        P = ind[sets]
-        R = ind[~sets]
+    if not converged:
+        # ||Ax - y||^2 = ||Bx - B^+T Aty||^2 + const for AtA = B^T B
+        evals, evecs = np.linalg.eigh(AtA)
+        I = evals > evals.max() * n * np.finfo(np.float64).eps
+        B = np.sqrt(evals[I])[:, np.newaxis] * evecs[:, I].T
+        x = _nnls_fallback(B, evecs[:, I].T.dot(Aty) / np.sqrt(evals[I]))
 
-        # Get the rows, cols in AtA corresponding to P
-        AtA_in_p = AtA[P][:, P]
-        # Do the same for Aty
-        Aty_in_p = Aty[P]
+    return x
 
-        # Update s. Solve (AtA)^p * s^p = (Aty)^p
-        s[P] = np.linalg.lstsq(AtA_in_p, Aty_in_p, rcond=None)[0]
-        s[R] = 0.
+def nnls_gram(A, y, ivar=None, passive=None):
+    """Weighted non-negative least squares of a (design) matrix and data vector
+    via their Gram matrices.
 
-        while np.any(s[P] <= epsilon):
-            i += 1
+    Parameters
+    ----------
+    A : :class:`numpy.ndarray` [m, n]
+        Design matrix, e.g., the [npix, ntemplate] template fluxes.
+    y : :class:`numpy.ndarray` [m]
+        Data vector.
+    ivar : :class:`numpy.ndarray` [m], optional
+        Inverse variance of `y`. Defaults to uniform weights.
+    passive : :class:`numpy.ndarray` [n], optional
+        Boolean initial passive set (warm start); see :func:`fnnls`.
 
-            mask = (s[P] <= epsilon)
-            alpha = np.min(x[P][mask] / (x[P][mask] - s[P][mask]))
-            x += alpha * (s - x)
+    Returns
+    -------
+    x : :class:`numpy.ndarray` [n]
+        Non-negative solution vector (from :func:`scipy.optimize.nnls` if the
+        Gram-matrix solver does not converge; see :func:`fnnls`).
+    chi2 : :class:`float`
+        Chi-squared of the solution, sum(ivar * (y - A x)**2).
 
-            # Move all indices j in P such that x[j] = 0 to R
-            # First get all indices where x == 0 in the MASKED x
-            zero_mask = (x[P] < epsilon)
-            # These correspond to indices in P
-            zeros = P[zero_mask]
-            # Finally, update the passive/active sets.
-            sets[zeros] = False
-            P = ind[sets]
-            R = ind[~sets]
+    """
+    if ivar is None:
+        ivar = np.ones_like(y)
 
-            # Get the rows, cols in AtA corresponding to P
-            AtA_in_p = AtA[P][:, P]
-            # Do the same for Aty
-            Aty_in_p = Aty[P]
+    A = np.ascontiguousarray(A, dtype=np.float64) # e.g., a slice of a model grid
+    Aw = A * ivar[:, np.newaxis]
+    AtA, Aty = Aw.T.dot(A), Aw.T.dot(y)
 
-            # Update s. Solve (AtA)^p * s^p = (Aty)^p
-            s[P] = np.linalg.lstsq(AtA_in_p, Aty_in_p, rcond=None)[0]
-            s[R] = 0.
+    n = A.shape[1]
+    epsilon = 10 * n * np.finfo(np.float64).eps * np.max(np.abs(Aty), initial=0.0)
+    if passive is None:
+        P = np.zeros(n, dtype=np.bool_)
+    else:
+        P = np.array(passive, dtype=np.bool_)
 
-        x = s.copy()
-        w = Aty - AtA.dot(x)
+    x, _, converged = _fnnls(AtA, Aty, P, epsilon, 30 * n)
+    if not converged:
+        inverr = np.sqrt(ivar)
+        x = _nnls_fallback(A * inverr[:, np.newaxis], y * inverr)
 
-    return x
+    chi2 = np.sum(ivar * (y - A.dot(x))**2)
+
+    return x, chi2
+
+@numba.jit(nopython=True)
+def _nnls_batch(A, y, ivar, keep):
+    '''
+    Solve many small, independent weighted NNLS problems in a single compiled
+    loop; see :func:`nnls_batch`.
+    '''
+    nobj, m, n = A.shape
+    x = np.zeros((nobj, n))
+    chi2 = np.zeros(nobj)
+    converged = np.ones(nobj, dtype=np.bool_)
+    eps = np.finfo(np.float64).eps
+
+    for ii in range(nobj):
+        AtA = np.zeros((n, n))
+        Aty = np.zeros(n)
+        nkeep = 0
+        for jj in range(n):
+            if not keep[ii, jj]:
+                continue
+            nkeep += 1
+            for kk in range(m):
+                Aty[jj] += A[ii, kk, jj] * ivar[ii, kk] * y[ii, kk]
+            for ll in range(jj, n):
+                if not keep[ii, ll]:
+                    continue
+                v = 0.0
+                for kk in range(m):
+                    v += A[ii, kk, jj] * ivar[ii, kk] * A[ii, kk, ll]
+                AtA[jj, ll] = v
+                AtA[ll, jj] = v
+
+        if nkeep == 0:
+            continue
+
+        epsilon = 10 * nkeep * eps * np.max(np.abs(Aty))
+        P = np.zeros(n, dtype=np.bool_)
+        x[ii, :], _, converged[ii] = _fnnls(AtA, Aty, P, epsilon, 30 * nkeep)
+
+        for kk in range(m):
+            model = 0.0
+            for jj in range(n):
+                model += A[ii, kk, jj] * x[ii, jj]
+            chi2[ii] += ivar[ii, kk] * (y[ii, kk] - model)**2
+
+    return x, chi2, converged
+
+def nnls_batch(A, y, ivar, keep=None):
+    """Weighted non-negative least squares for a batch of small, independent
+    problems (e.g., the photometric fits of a whole catalog).
+
+    Parameters
+    ----------
+    A : :class:`numpy.ndarray` [nobj, m, n]
+        Design matrices, one per problem.
+    y : :class:`numpy.ndarray` [nobj, m]
+        Data vectors.
+    ivar : :class:`numpy.ndarray` [nobj, m]
+        Inverse variances of `y`.
+    keep : :class:`numpy.ndarray` [nobj, n], optional
+        Boolean mask of the columns of `A` to use in each problem; the
+        coefficients of the other columns are zero. Defaults to all columns.
+
+    Returns
+    -------
+    x : :class:`numpy.ndarray` [nobj, n]
+        Non-negative solution vectors.
+    chi2 : :class:`numpy.ndarray` [nobj]
+        Chi-squared of each solution, sum(ivar * (y - A x)**2).
+
+    Notes
+    -----
+    Problems whose solution does not satisfy the Karush-Kuhn-Tucker conditions
+    are re-solved (one at a time) with :func:`scipy.optimize.nnls`.
+
+    """
+    A = np.ascontiguousarray(A, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    ivar = np.ascontiguousarray(ivar, dtype=np.float64)
+
+    if A.ndim != 3 or y.shape != A.shape[:2] or ivar.shape != y.shape:
+        raise ValueError('Invalid dimensions; got A {}, y {}, and ivar {}'.format(
+            A.shape, y.shape, ivar.shape))
+
+    if keep is None:
+        keep = np.ones((A.shape[0], A.shape[2]), dtype=np.bool_)
+    else:
+        keep = np.ascontiguousarray(keep, dtype=np.bool_)
+
+    x, chi2, converged = _nnls_batch(A, y, ivar, keep)
+
+    # re-solve the problems which did not converge with scipy
+    for ii in np.where(np.logical_not(converged))[0]:
+        inverr = np.sqrt(ivar[ii, :])
+        I = np.where(keep[ii, :])[0]
+        x[ii, I] = _nnls_fallback(A[ii, :, :][:, I] * inverr[:, np.newaxis], y[ii, :] * inverr)
+        chi2[ii] = np.sum(ivar[ii, :] * (y[ii, :] - A[ii, :, :].dot(x[ii, :]))**2)
+
+    return x, chi2
@@ -49,6 +49,11 @@ EXPFMCOLS = {
     'custom': ['TARGETID', 'TILEID'], # tileid will be an array
     }
 
+# metadata columns which, together, uniquely identify each fitted spectrum
+# (e.g., the same TARGETID appears in more than one exposure with
+# coadd_type=perexp, or on more than one tile)
+UNIQUEIDCOLS = ['TARGETID', 'SURVEY', 'PROGRAM', 'HEALPIX', 'TILEID', 'NIGHT', 'FIBER', 'EXPID']
+
 # redshift columns to read
 REDSHIFTCOLS = ['TARGETID', 'Z', 'ZWARN', 'SPECTYPE', 'DELTACHI2']
 
@@ -95,8 +100,20 @@ def unpack_one_spectrum(spec, coadd_spec, igal, meta, ebv, FFit, fastphot, synth
     """Unpack the data for a single object and correct for Galactic extinction. Also
     flag pixels which may be affected by emission lines.
 
+    `meta` is a single-object :class:`numpy.void` record. If `FFit` is `None`,
+    use the :class:`fastspecfit.fastspecfit.FastFit` instance attached to this
+    worker process by :func:`fastspecfit.fastspecfit._init_worker`.
+
     """
-    from desiutil.dust import mwdust_transmission, dust_transmission
+    from desiutil.dust import mwdust_transmission, dust_transmission, ext_odonnell
+
+    if FFit is None:
+        from fastspecfit.fastspecfit import _FFit as FFit
+
+    # Records which arrive through a pipe are read-only, so work on a copy.
+    meta = np.array(meta)[()]
+
+    tall = time.time()
 
     data = {'targetid': meta['TARGETID'], 'zredrock': meta['Z'],
             'photsys': meta['PHOTSYS']}
@@ -282,9 +299,8 @@ def unpack_one_spectrum(spec, coadd_spec, igal, meta, ebv, FFit, fastphot, synth
     
         # Optionally synthesize photometry from the coadded spectrum.
         if synthphot:
-            padflux, padwave = filters.pad_spectrum(coadd_flux, coadd_wave, method='edge')
-            synthmaggies = filters.get_ab_maggies(padflux / FFit.fluxnorm, padwave)
-            synthmaggies = synthmaggies.as_array().view('f8')
+            # pad (simply) in wavelength
+            synthmaggies = FFit.filter_weights(filters, coadd_wave, pad=True).dot(coadd_flux / FFit.fluxnorm)
     
             # code to synthesize uncertainties from the variance spectrum
             #var, mask = _ivar2var(data['coadd_ivar'])
@@ -300,6 +316,8 @@ def unpack_one_spectrum(spec, coadd_spec, igal, meta, ebv, FFit, fastphot, synth
                 maggies=synthmaggies, nanomaggies=False,
                 lambda_eff=filters.effective_wavelengths.value)
 
+    data['tunpack'] = time.time() - tall
+
     return data, meta
 
 class DESISpectra(object):
@@ -896,11 +914,70 @@ class DESISpectra(object):
                 of the data blueward and redward to accommodate the g-band and
                 z-band filter curves, respectively.
 
+        """
+        alldata = []
+        for data, _ in self.iter_read_and_unpack(FFit, fastphot=fastphot, synthphot=synthphot, mp=mp):
+            alldata.append(data)
+        alldata = np.concatenate(alldata)
+
+        return alldata
+
+    def iter_read_and_unpack(self, FFit, fastphot=False, synthphot=True, mp=1,
+                             chunksize=None, pool=None):
+        """Read and unpack selected spectra or broadband photometry in chunks.
+
+        Generator version of :func:`read_and_unpack` which reads and unpacks
+        (at most) `chunksize` objects at a time, so that the caller can fit and
+        discard each chunk before the next one is read and peak memory usage is
+        set by the chunk size rather than by the size of the input file(s).
+
+        Parameters
+        ----------
+        FFit : :class:`fastspecfit.continuum.ContinuumFit` class
+            Continuum-fitting class which contains filter curves and some additional
+            photometric convenience functions.
+        fastphot : bool
+            Read and unpack the broadband photometry; otherwise, handle the DESI
+            three-camera spectroscopy. Optional; defaults to `False`.
+        synthphot : bool
+            Synthesize photometry from the coadded optical spectrum. Optional;
+            defaults to `True`.
+        mp : int
+            Number of multiprocessing processes to use when unpacking. Ignored
+            if `pool` is given. Optional; defaults to `1`.
+        chunksize : int or `None`
+            Maximum number of objects to read and unpack at a time. If `None`,
+            each input file is read and unpacked as a single chunk. Optional;
+            defaults to `None`.
+        pool : :class:`multiprocessing.pool.Pool` or `None`
+            Existing pool (initialized with
+            :func:`fastspecfit.fastspecfit._init_worker`) to use for the
+            unpacking. Optional; defaults to `None`.
+
+        Yields
+        ------
+        data : :class:`list`
+            List of dictionaries, one per object in this chunk; see
+            :func:`read_and_unpack` for the keys.
+        meta : :class:`astropy.table.Table`
+            Metadata table row-aligned to `data` (with the Galactic extinction
+            columns filled in).
+
+        Notes
+        -----
+        Once the generator is exhausted, `self.meta` is stacked into a single
+        table and `self.ntargets` is set, exactly as in
+        :func:`read_and_unpack`.
+
         """
         from desispec.coaddition import coadd_cameras
         from desispec.io import read_spectra
 
-        alldata = []
+        if chunksize is not None and chunksize < 1:
+            errmsg = 'chunksize must be a positive integer.'
+            log.critical(errmsg)
+            raise ValueError(errmsg)
+
         for ispec, (specfile, meta) in enumerate(zip(self.specfiles, self.meta)):
             nobj = len(meta)
             if nobj == 1:
@@ -908,39 +985,185 @@ class DESISpectra(object):
             else:
                 log.info('Reading {} spectra from {}'.format(nobj, specfile))
 
+            if chunksize is None or chunksize >= nobj:
+                chunks = [np.arange(nobj)]
+            else:
+                chunks = [np.arange(ii, min(ii+chunksize, nobj)) for ii in np.arange(0, nobj, chunksize)]
+                log.info('Unpacking {} objects in {} chunks of up to {} objects.'.format(
+                    nobj, len(chunks), chunksize))
+
             ebv = FFit.SFDMap.ebv(meta['RA'], meta['DEC'])
 
-            if fastphot:
-                spec, coadd_spec = None, None
-            else:
-                spec = read_spectra(specfile).select(targets=meta['TARGETID'])
-                assert(np.all(spec.fibermap['TARGETID'] == meta['TARGETID']))
+            chunkmetas = []
+            for chunk in chunks:
+                chunkmeta = meta[chunk]
+                if fastphot:
+                    spec, coadd_spec = None, None
+                else:
+                    if len(chunks) == 1:
+                        spec = read_spectra(specfile)
+                    else:
+                        # only read the targets in this chunk
+                        spec = read_spectra(specfile, targetids=chunkmeta['TARGETID'].data)
+                    spec = spec.select(targets=chunkmeta['TARGETID'])
+                    assert(np.all(spec.fibermap['TARGETID'] == chunkmeta['TARGETID']))
 
-                # Coadd across cameras.
-                coadd_spec = coadd_cameras(spec)
+                    # Coadd across cameras.
+                    coadd_spec = coadd_cameras(spec)
+
+                data, chunkmeta = self._unpack_spectra(spec, coadd_spec, chunkmeta, ebv[chunk], FFit,
+                                                       fastphot, synthphot, mp=mp, pool=pool)
+                del spec, coadd_spec
+                chunkmetas.append(chunkmeta)
+
+                yield data, chunkmeta
+
+            self.meta[ispec] = vstack(chunkmetas)
 
-            unpackargs = [(spec, coadd_spec, igal, meta[igal], ebv[igal], FFit, 
-                           fastphot, synthphot) for igal in np.arange(len(meta))]
-    
-            if mp > 1:
-                import multiprocessing
-                with multiprocessing.Pool(mp) as P:
-                    out = P.map(_unpack_one_spectrum, unpackargs)
-            else:
-                out = [unpack_one_spectrum(*_unpackargs) for _unpackargs in unpackargs]
-    
-            out = list(zip(*out))
-            self.meta[ispec] = Table(np.hstack(out[1]))
-    
-            alldata.append(out[0])
-    
-        alldata = np.concatenate(alldata)
         self.meta = vstack(self.meta)
         self.ntargets = len(self.meta)
 
-        return alldata
+    @staticmethod
+    def _unpack_spectra(spec, coadd_spec, meta, ebv, FFit, fastphot, synthphot, mp=1, pool=None):
+        """Unpack the objects in `meta`, optionally in parallel.
+
+        Returns a list of data dictionaries and the updated metadata table.
+
+        """
+        # Pass compact numpy records (not astropy Rows, which carry their
+        # parent Table) and, when farming out to other processes,
+        # single-object slices of the spectra.
+        metarec = meta.as_array()
+        if pool is not None or mp > 1:
+            if fastphot:
+                unpackargs = [(None, None, 0, metarec[igal], ebv[igal], None,
+                               fastphot, synthphot) for igal in np.arange(len(meta))]
+            else:
+                unpackargs = [(spec[igal:igal+1], coadd_spec[igal:igal+1], 0, metarec[igal],
+                               ebv[igal], None, fastphot, synthphot) for igal in np.arange(len(meta))]
+            if pool is not None:
+                out = pool.map(_unpack_one_spectrum, unpackargs)
+            else:
+                import multiprocessing
+                from fastspecfit.fastspecfit import _init_worker
+                with multiprocessing.Pool(mp, initializer=_init_worker, initargs=(FFit,)) as P:
+                    out = P.map(_unpack_one_spectrum, unpackargs)
+        else:
+            unpackargs = [(spec, coadd_spec, igal, metarec[igal], ebv[igal], FFit, 
+                           fastphot, synthphot) for igal in np.arange(len(meta))]
+            out = [unpack_one_spectrum(*_unpackargs) for _unpackargs in unpackargs]
+
+        out = list(zip(*out))
+
+        return list(out[0]), Table(np.hstack(out[1]))
+
+    def unpack_photometry(self, FFit):
+        """Unpack the broadband photometry of all the selected targets at once.
+
+        Array version of :func:`unpack_one_spectrum` with `fastphot=True`, for
+        :meth:`fastspecfit.fastspecfit.FastFit.fastphot_batch`. The photometry
+        is corrected for Galactic extinction and the EBV, MW_TRANSMISSION_*,
+        FLUX_*, FLUX_IVAR_*, and FIBERTOTFLUX_* columns of the metadata table
+        are filled in just as :func:`init_output` does for the per-object fits.
+
+        Parameters
+        ----------
+        FFit : :class:`fastspecfit.continuum.ContinuumFit` class
+            Continuum-fitting class which contains filter curves and some additional
+            photometric convenience functions.
+
+        Returns
+        -------
+        meta : :class:`astropy.table.Table`
+            Metadata table of all the selected targets (which is also stored
+            in `self.meta`).
+        nanomaggies, ivarnanomaggies : :class:`numpy.ndarray` [nobj, nband]
+            Extinction-corrected photometry and inverse variance in
+            `FFit.bands`.
+
+        """
+        from desiutil.dust import mwdust_transmission, ext_odonnell
+
+        if isinstance(self.meta, (list, tuple)):
+            self.meta = vstack(self.meta)
+        meta = self.meta
+        self.ntargets = len(meta)
+
+        nobj = len(meta)
+        photsys = np.asarray(meta['PHOTSYS']).astype(str)
+        ebv = FFit.SFDMap.ebv(meta['RA'], meta['DEC'])
+        meta['EBV'][:] = ebv
+
+        # Do not match the Legacy Surveys here; see unpack_one_spectrum.
+        mw_transmission_flux = np.zeros((nobj, len(FFit.bands)))
+        mw_transmission_fiberflux = np.zeros((nobj, len(FFit.fiber_bands)))
+        I = photsys != ''
+        if np.any(I):
+            for iband, band in enumerate(FFit.bands):
+                mw_transmission_flux[I, iband] = mwdust_transmission(ebv[I], band, photsys[I], match_legacy_surveys=False)
+                meta['MW_TRANSMISSION_{}'.format(band.upper())][I] = mw_transmission_flux[I, iband]
+            for iband, band in enumerate(FFit.fiber_bands):
+                mw_transmission_fiberflux[I, iband] = mwdust_transmission(ebv[I], band, photsys[I])
+        if np.any(~I):
+            mw_transmission_flux[~I, :] = 10**(-0.4 * ebv[~I, np.newaxis] * FFit.RV * ext_odonnell(
+                FFit.bassmzlswise.effective_wavelengths.value, Rv=FFit.RV))
+            mw_transmission_fiberflux[~I, :] = 10**(-0.4 * ebv[~I, np.newaxis] * FFit.RV * ext_odonnell(
+                FFit.bassmzls.effective_wavelengths.value, Rv=FFit.RV))
+
+        nanomaggies = np.zeros((nobj, len(FFit.bands)))
+        ivarnanomaggies = np.zeros((nobj, len(FFit.bands)))
+        for iband, band in enumerate(FFit.bands):
+            nanomaggies[:, iband] = meta['FLUX_{}'.format(band.upper())] / mw_transmission_flux[:, iband]
+            ivarnanomaggies[:, iband] = meta['FLUX_IVAR_{}'.format(band.upper())] * mw_transmission_flux[:, iband]**2
+
+        if not np.all(ivarnanomaggies >= 0):
+            errmsg = 'Some ivarmaggies are negative!'
+            log.critical(errmsg)
+            raise ValueError(errmsg)
+
+        for iband, band in enumerate(FFit.bands):
+            meta['FLUX_{}'.format(band.upper())][:] = nanomaggies[:, iband]
+            meta['FLUX_IVAR_{}'.format(band.upper())][:] = ivarnanomaggies[:, iband]
+        for iband, band in enumerate(FFit.fiber_bands):
+            meta['FIBERTOTFLUX_{}'.format(band.upper())][:] = meta['FIBERFLUX_{}'.format(band.upper())] / \
+                mw_transmission_fiberflux[:, iband]
+
+        return meta, nanomaggies, ivarnanomaggies
 
-    def init_output(self, data=None, FFit=None, fastphot=False):
+    def remove_targets(self, ids):
+        """Remove targets from the selected sample, e.g., ones which were
+        already fitted in a previous (checkpointed) run. Input files with no
+        remaining targets are dropped.
+
+        Parameters
+        ----------
+        ids : :class:`list`
+            Unique identifiers (see :func:`unique_ids`) of the objects to
+            remove. Only the matching objects are removed, not every object
+            with the same TARGETID.
+
+        Returns
+        -------
+        ntargets : int
+            Number of targets which were removed.
+
+        """
+        ids = set(ids)
+
+        ntargets = 0
+        redrockfiles, specfiles, metas = [], [], []
+        for redrockfile, specfile, meta in zip(self.redrockfiles, self.specfiles, self.meta):
+            keep = np.array([key not in ids for key in unique_ids(meta)], bool)
+            ntargets += np.sum(~keep)
+            if np.any(keep):
+                redrockfiles.append(redrockfile)
+                specfiles.append(specfile)
+                metas.append(meta[keep])
+        self.redrockfiles, self.specfiles, self.meta = redrockfiles, specfiles, metas
+
+        return ntargets
+
+    def init_output(self, data=None, FFit=None, fastphot=False, metadata=None):
         """Initialize the fastspecfit output data table.
 
         Parameters
@@ -955,6 +1178,9 @@ class DESISpectra(object):
             Fiber map (row-aligned to `redrock`).
         FFit : :class:`fastspecfit.continuum.ContinuumFit`
             Continuum-fitting class.
+        metadata : :class:`astropy.table.Table` or `None`
+            Metadata table row-aligned to `data` (e.g., one chunk yielded by
+            :func:`iter_read_and_unpack`). Defaults to `self.meta`.
 
         Returns
         -------
@@ -967,7 +1193,10 @@ class DESISpectra(object):
         import astropy.units as u
         from astropy.table import hstack, Column
 
-        nobj = len(self.meta)
+        if metadata is None:
+            metadata = self.meta
+
+        nobj = len(metadata)
 
         # The information stored in the metadata table depends on which spectra
         # were fitted (exposures, nightly coadds, deep coadds).
@@ -998,14 +1227,14 @@ class DESISpectra(object):
                        'TSNR2_LRG', 'TSNR2_ELG', 'TSNR2_QSO', 'TSNR2_LYA']
         
         meta = Table()
-        metacols = self.meta.colnames
+        metacols = metadata.colnames
 
         # All of this business is so we can get the columns in the order we want
         # (i.e., the order that matches the data model).
         for metacol in ['TARGETID', 'SURVEY', 'PROGRAM', 'HEALPIX', 'TILEID', 'NIGHT', 'FIBER',
                         'EXPID', 'TILEID_LIST', 'RA', 'DEC', 'COADD_FIBERSTATUS']:
             if metacol in metacols:
-                meta[metacol] = self.meta[metacol]
+                meta[metacol] = metadata[metacol]
                 if metacol in colunit.keys():
                     meta[metacol].unit = colunit[metacol]
 
@@ -1018,31 +1247,31 @@ class DESISpectra(object):
             if metacol in skipcols or metacol in TARGETINGCOLS or metacol in meta.colnames or metacol in redrockcols:
                 continue
             else:
-                meta[metacol] = self.meta[metacol]
+                meta[metacol] = metadata[metacol]
                 if metacol in colunit.keys():
                     meta[metacol].unit = colunit[metacol]
 
         for bitcol in TARGETINGCOLS:
             if bitcol in metacols:
-                meta[bitcol] = self.meta[bitcol]
+                meta[bitcol] = metadata[bitcol]
             else:
                 meta[bitcol] = np.zeros(shape=(1,), dtype=np.int64)
 
         for redrockcol in redrockcols:
             if redrockcol in metacols: # the Z_RR from quasarnet may not be present
-                meta[redrockcol] = self.meta[redrockcol]
+                meta[redrockcol] = metadata[redrockcol]
             if redrockcol in colunit.keys():
                 meta[redrockcol].unit = colunit[redrockcol]
 
         for fluxcol in fluxcols:
-            meta[fluxcol] = self.meta[fluxcol]
+            meta[fluxcol] = metadata[fluxcol]
             if fluxcol in colunit.keys():
                 meta[fluxcol].unit = colunit[fluxcol]
 
         out = Table()
-        for col in ['TARGETID', 'SURVEY', 'PROGRAM', 'HEALPIX', 'TILEID', 'NIGHT', 'FIBER', 'EXPID']:
+        for col in UNIQUEIDCOLS:
             if col in metacols:
-                out[col] = self.meta[col]
+                out[col] = metadata[col]
         out = hstack((out, FFit.init_output(nobj, fastphot=fastphot)))
 
         # Optionally copy over some quantities of interest from the data
@@ -1063,6 +1292,114 @@ class DESISpectra(object):
 
         return out, meta
 
+TEMPLATE_CACHE_VERSION = 1
+
+def template_cache_key(templates, mintemplatewave=None, maxtemplatewave=None, vdisp_nominal=None):
+    """Unique key for a template cache.
+
+    The key is a SHA-1 hash of the checksums (DATASUM and CHECKSUM) of every HDU
+    in the templates file (falling back to its size and modification time if
+    the file has no checksums), the wavelength trimming, the nominal velocity
+    dispersion, and the version of the cache format.
+
+    """
+    import hashlib
+
+    sha = hashlib.sha1()
+    sha.update('v{}'.format(TEMPLATE_CACHE_VERSION).encode())
+
+    nchecksum = 0
+    with fitsio.FITS(templates) as F:
+        for hdu in F:
+            hdr = hdu.read_header()
+            for key in ['EXTNAME', 'DATASUM', 'CHECKSUM']:
+                if key in hdr:
+                    sha.update('{}={}'.format(key, hdr[key]).encode())
+                    if key != 'EXTNAME':
+                        nchecksum += 1
+    if nchecksum == 0:
+        stat = os.stat(templates)
+        sha.update('{}:{}:{}'.format(os.path.abspath(templates), stat.st_size, stat.st_mtime_ns).encode())
+
+    sha.update(repr((mintemplatewave, maxtemplatewave, vdisp_nominal)).encode())
+
+    return sha.hexdigest()
+
+def read_template_cache(cachedir, key):
+    """Read a template cache written by :func:`write_template_cache`.
+
+    Arrays are memory-mapped read-only, so that all the processes on a node
+    share the same pages through the operating-system cache.
+
+    Returns
+    -------
+    :class:`dict` or `None`
+        Dictionary of arrays plus a `meta` dictionary of scalars, or `None` if
+        no cache exists for this key.
+
+    """
+    import json
+
+    keydir = os.path.join(cachedir, key)
+    metafile = os.path.join(keydir, 'meta.json')
+    if not os.path.isfile(metafile):
+        return None
+
+    with open(metafile, 'r') as F:
+        meta = json.load(F)
+    if meta.get('version') != TEMPLATE_CACHE_VERSION:
+        return None
+
+    cache = {'meta': meta}
+    for name in meta['arrays']:
+        cache[name] = np.load(os.path.join(keydir, '{}.npy'.format(name)), mmap_mode='r')
+    log.info('Read cached templates from {}'.format(keydir))
+
+    return cache
+
+def write_template_cache(cachedir, key, arrays, meta):
+    """Write a template cache.
+
+    Each array is written to its own `.npy` file (and `meta` to a JSON file) in
+    a temporary directory which is then renamed into place, so concurrent
+    writers never expose a partially written cache.
+
+    Parameters
+    ----------
+    cachedir : :class:`str`
+        Top-level cache directory.
+    key : :class:`str`
+        Cache key (see :func:`template_cache_key`).
+    arrays : :class:`dict`
+        Dictionary of :class:`numpy.ndarray` (including structured) arrays.
+    meta : :class:`dict`
+        JSON-serializable dictionary of scalars.
+
+    """
+    import json, shutil, tempfile
+
+    keydir = os.path.join(cachedir, key)
+    if os.path.isdir(keydir):
+        return
+    os.makedirs(cachedir, exist_ok=True)
+
+    tmpdir = tempfile.mkdtemp(dir=cachedir, prefix='{}.tmp-'.format(key))
+    try:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmpdir, '{}.npy'.format(name)), np.ascontiguousarray(arr), allow_pickle=False)
+        meta = dict(meta, version=TEMPLATE_CACHE_VERSION, arrays=list(arrays.keys()))
+        with open(os.path.join(tmpdir, 'meta.json'), 'w') as F:
+            json.dump(meta, F)
+        os.rename(tmpdir, keydir)
+        log.info('Wrote cached templates to {}'.format(keydir))
+    except OSError:
+        # most likely another process won the race
+        if not os.path.isdir(keydir):
+            raise
+    finally:
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+
 def read_fastspecfit(fastfitfile, rows=None, columns=None, read_models=False):
     """Read the fitting results.
 
@@ -1110,9 +1447,12 @@ def read_fastspecfit(fastfitfile, rows=None, columns=None, read_models=False):
             return [None]*4
 
 def write_fastspecfit(out, meta, modelspectra=None, outfile=None, specprod=None,
-                      coadd_type=None, fastphot=False):
+                      coadd_type=None, fastphot=False, timing=None):
     """Write out.
 
+    If `timing` is not `None`, also write the table of per-object stage timings
+    (see :func:`fastspecfit.fastspecfit.init_timing`) to a TIMING extension.
+
     """
     import gzip, shutil
     from astropy.io import fits
@@ -1169,6 +1509,10 @@ def write_fastspecfit(out, meta, modelspectra=None, outfile=None, specprod=None,
             hdu.header[key] = (modelspectra.meta[key][0], modelspectra.meta[key][1]) # all the spectra are identical, right??
                 
         hdus.append(hdu)
+
+    if timing is not None:
+        timing.meta['EXTNAME'] = 'TIMING'
+        hdus.append(fits.convenience.table_to_hdu(timing))
         
     hdus.writeto(tmpfile, overwrite=True, checksum=True)
 
@@ -1185,6 +1529,181 @@ def write_fastspecfit(out, meta, modelspectra=None, outfile=None, specprod=None,
 
     log.info('Writing out took {:.2f} seconds.'.format(time.time()-t0))
 
+class Checkpoint(object):
+    def __init__(self, outfile, fastphot=False, resume=False, interval=60.0):
+        """Incrementally save fitting results so that an interrupted run can be
+        resumed.
+
+        Results are buffered as they finish and periodically flushed to a
+        sidecar directory (`outfile` with a `.ckpt` suffix), one small file
+        per flush, each written atomically with :func:`write_fastspecfit`
+        (i.e., with the usual FASTSPEC/FASTPHOT, METADATA, and MODELS
+        extensions).
+
+        Parameters
+        ----------
+        outfile : str
+            Full path to the final output file.
+        fastphot : bool
+            Checkpoint `fastphot` (rather than `fastspec`) results. Defaults to
+            `False`.
+        resume : bool
+            Keep (and pick up from) any existing checkpoint files; otherwise,
+            start afresh. Defaults to `False`.
+        interval : float
+            Minimum time, in seconds, between flushes. Defaults to 60.
+
+        """
+        import glob, re
+
+        if outfile.endswith('.gz'):
+            outfile = outfile[:-3]
+        self.ckptdir = outfile+'.ckpt'
+        self.fastphot = fastphot
+        self.interval = interval
+
+        partfiles = sorted(glob.glob(os.path.join(self.ckptdir, 'part-*.fits')))
+        if len(partfiles) > 0 and not resume:
+            log.warning('Removing {} existing checkpoint file(s) from {}'.format(len(partfiles), self.ckptdir))
+            for partfile in partfiles:
+                os.remove(partfile)
+            partfiles = []
+        os.makedirs(self.ckptdir, exist_ok=True)
+
+        self.partfiles = partfiles
+        if len(partfiles) > 0:
+            self.npart = max([int(re.findall(r'part-(\d+)\.fits', partfile)[0]) for partfile in partfiles]) + 1
+        else:
+            self.npart = 0
+
+        self._out, self._meta, self._models = [], [], []
+        self._tflush = time.time()
+
+    @property
+    def ids(self):
+        """Unique identifiers (see :func:`unique_ids`) of all the objects which
+        have been checkpointed.
+
+        """
+        ids = []
+        for partfile in self.partfiles:
+            with fitsio.FITS(partfile) as F:
+                columns = [col for col in UNIQUEIDCOLS if col in F['METADATA'].get_colnames()]
+                ids += unique_ids(F['METADATA'].read(columns=columns))
+        for meta in self._meta:
+            ids += unique_ids(meta)
+        return ids
+
+    def append(self, out, meta, modelspectra=None):
+        """Add the results of one object (or a table of objects) and flush to
+        disk if more than `interval` seconds have elapsed since the last flush.
+
+        """
+        self._out.append(np.atleast_1d(np.asarray(out)))
+        self._meta.append(np.atleast_1d(np.asarray(meta)))
+        if modelspectra is not None:
+            self._models.append(modelspectra)
+        if time.time() - self._tflush > self.interval:
+            self.flush()
+
+    def flush(self):
+        """Write any buffered results to a new checkpoint file."""
+        self._tflush = time.time()
+        if len(self._out) == 0:
+            return
+
+        if self.fastphot:
+            modelspectra = None
+        else:
+            modelspectra = vstack(self._models, metadata_conflicts='error')
+
+        partfile = os.path.join(self.ckptdir, 'part-{:06d}.fits'.format(self.npart))
+        write_fastspecfit(Table(np.hstack(self._out)), Table(np.hstack(self._meta)),
+                          modelspectra=modelspectra, outfile=partfile,
+                          fastphot=self.fastphot)
+        self.partfiles.append(partfile)
+        self.npart += 1
+        self._out, self._meta, self._models = [], [], []
+
+    def read(self):
+        """Read and stack all the checkpointed results.
+
+        Returns
+        -------
+        The `out` and `meta` tables and the model spectra (or `None` if
+        `fastphot=True`), in the format expected by :func:`write_fastspecfit`.
+
+        """
+        self.flush()
+
+        if self.fastphot:
+            extname = 'FASTPHOT'
+        else:
+            extname = 'FASTSPEC'
+
+        outs, metas, models, modelhdr = [], [], [], None
+        for partfile in self.partfiles:
+            outs.append(Table(fitsio.read(partfile, ext=extname)))
+            metas.append(Table(fitsio.read(partfile, ext='METADATA')))
+            if not self.fastphot:
+                models.append(fitsio.read(partfile, ext='MODELS'))
+                if modelhdr is None:
+                    modelhdr = fitsio.read_header(partfile, ext='MODELS')
+
+        if len(outs) == 0:
+            return None, None, None
+
+        out = vstack(outs)
+        meta = vstack(metas)
+        if self.fastphot:
+            modelspectra = None
+        else:
+            models = np.vstack(models) # [nobj, 3, nwave]
+            modelspectra = Table()
+            for record in modelhdr.records():
+                if record['name'] in ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT',
+                                      'EXTEND', 'EXTNAME', 'CHECKSUM', 'DATASUM']:
+                    continue
+                modelspectra.meta[record['name']] = (record['value'], record['comment'])
+            for imodel, col in enumerate(['CONTINUUM', 'SMOOTHCONTINUUM', 'EMLINEMODEL']):
+                modelspectra[col] = models[:, imodel, :].astype('f4')
+
+        return out, meta, modelspectra
+
+    def remove(self):
+        """Remove the checkpoint files (e.g., once the final output is written)."""
+        for partfile in self.partfiles:
+            if os.path.isfile(partfile):
+                os.remove(partfile)
+        self.partfiles = []
+        if os.path.isdir(self.ckptdir) and len(os.listdir(self.ckptdir)) == 0:
+            os.rmdir(self.ckptdir)
+
+def unique_ids(meta):
+    """Return identifiers which uniquely identify each object in a metadata
+    table, even if its TARGETID is repeated (e.g., with coadd_type=perexp or
+    when fitting more than one input file).
+
+    Parameters
+    ----------
+    meta : :class:`astropy.table.Table` or :class:`numpy.ndarray`
+        Metadata table with (a subset of) the `UNIQUEIDCOLS` columns.
+
+    Returns
+    -------
+    :class:`list`
+        One (hashable) tuple of the `UNIQUEIDCOLS` values per object.
+
+    """
+    values = []
+    for col in UNIQUEIDCOLS:
+        if col in meta.dtype.names:
+            value = np.atleast_1d(np.asarray(meta[col]))
+            if value.dtype.kind in 'SU': # padded in FITS files
+                value = np.char.strip(value.astype(str))
+            values.append(value.tolist())
+    return list(zip(*values))
+
 def select(fastfit, metadata, coadd_type, healpixels=None, tiles=None,
            nights=None, return_index=False):
     """Optionally trim to a particular healpix or tile and/or night."""
@@ -87,5 +87,723 @@ class TestFastspec(unittest.TestCase):
             if hdu.has_data(): # skip zeroth extension
                 self.assertTrue(hdu.get_extname() in ['METADATA', 'FASTSPEC', 'MODELS'])
 
+class _HangingFit(object):
+    """Stand-in for FastFit whose (photometric) fits succeed, take too long,
+    hang in a way the watchdog cannot interrupt, or crash the process.
+
+    """
+    def __init__(self, time_limit):
+        from fastspecfit.util import StageTimer
+        self.time_limit = time_limit
+        self.timer = StageTimer()
+
+    def continuum_specfit(self, data, out, fastphot=False):
+        import signal, time
+        if data['behavior'] == 'slow':
+            time.sleep(100.)
+        elif data['behavior'] == 'hang':
+            # like a hang in compiled code, which SIGALRM cannot interrupt
+            signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+            time.sleep(100.)
+        elif data['behavior'] == 'crash':
+            os._exit(1)
+        out['RCHI2'] = data['value']
+        return None, None
+
+class TestTimeLimit(unittest.TestCase):
+    """Test the per-object time limit in fastspecfit.fastspecfit"""
+    def test_time_limit(self):
+        """Test that hung, slow, and crashed fits are flagged without stalling."""
+        import time
+        from astropy.table import Table
+        from fastspecfit.fastspecfit import _fit_chunk
+        from fastspecfit.util import FitFlagMask
+
+        behaviors = ['ok', 'hang', 'ok', 'crash', 'slow', 'ok', 'hang', 'ok', 'ok', 'ok']
+        nobj = len(behaviors)
+        data = [{'behavior': behavior, 'value': float(iobj+1)} for iobj, behavior in enumerate(behaviors)]
+        out = Table()
+        out['TARGETID'] = np.arange(nobj)
+        out['RCHI2'] = np.zeros(nobj, 'f4')
+        out['FITFLAG'] = np.zeros(nobj, np.int32)
+        meta = Table()
+        meta['TARGETID'] = np.arange(nobj)
+        meta['Z'] = np.zeros(nobj)
+
+        FFit = _HangingFit(time_limit=0.5)
+        t0 = time.time()
+        with patch('fastspecfit.fastspecfit._TIME_LIMIT_GRACE', 0.5):
+            out, meta, _, _ = _fit_chunk(data, out, meta, FFit, fastphot=True, mp=3)
+        self.assertLess(time.time() - t0, 30.)
+
+        ok = np.array(behaviors) == 'ok'
+        timeout = (out['FITFLAG'] & FitFlagMask.TIMEOUT) != 0
+        self.assertTrue(np.all(timeout == np.logical_not(ok)))
+        self.assertTrue(np.all(out['RCHI2'][ok] == np.arange(nobj)[ok] + 1))
+        self.assertTrue(np.all(out['RCHI2'][~ok] == 0))
+        self.assertTrue(np.all(meta['TARGETID'] == np.arange(nobj)))
+
+    def test_profile_workers(self):
+        """Test that each worker writes its profile, even if the pool is terminated."""
+        import glob, pstats
+        from astropy.table import Table
+        from fastspecfit.fastspecfit import _fit_chunk
+
+        behaviors = ['ok', 'hang', 'ok', 'ok', 'ok', 'ok']
+        nobj = len(behaviors)
+        data = [{'behavior': behavior, 'value': float(iobj+1)} for iobj, behavior in enumerate(behaviors)]
+        out = Table()
+        out['TARGETID'] = np.arange(nobj)
+        out['RCHI2'] = np.zeros(nobj, 'f4')
+        out['FITFLAG'] = np.zeros(nobj, np.int32)
+        meta = Table()
+        meta['TARGETID'] = np.arange(nobj)
+        meta['Z'] = np.zeros(nobj)
+
+        outdir = tempfile.mkdtemp()
+        try:
+            proffile = os.path.join(outdir, 'fastphot')
+            with patch('fastspecfit.fastspecfit._TIME_LIMIT_GRACE', 0.5):
+                _fit_chunk(data, out, meta, _HangingFit(time_limit=0.5), fastphot=True,
+                           mp=2, proffile=proffile)
+            proffiles = glob.glob(proffile + '.*.prof')
+            self.assertGreater(len(proffiles), 0)
+            stats = pstats.Stats(*proffiles)
+            self.assertTrue(any([func[2] == 'continuum_specfit' for func in stats.stats]))
+        finally:
+            shutil.rmtree(outdir)
+
+class TestIO(unittest.TestCase):
+    """Test the chunked input and checkpointed output in fastspecfit.io"""
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def _results(self, targetids, nwave=10):
+        """Simulate fastspec output, metadata, and model spectra."""
+        from astropy.table import Table
+
+        out = Table()
+        out['TARGETID'] = np.array(targetids, np.int64)
+        out['Z'] = np.linspace(0.1, 0.5, len(out)).astype('f8')
+        meta = Table()
+        meta['TARGETID'] = out['TARGETID']
+        meta['RA'] = np.linspace(10., 20., len(out))
+        models = Table()
+        for col in ['CONTINUUM', 'SMOOTHCONTINUUM', 'EMLINEMODEL']:
+            models[col] = np.outer(targetids, np.ones(nwave)).astype('f4')
+        models.meta['CRVAL1'] = (3600.0, 'wavelength of first pixel [Angstrom]')
+        models.meta['CDELT1'] = (0.8, 'pixel size [Angstrom]')
+        return out.as_array(), meta.as_array(), models
+
+    def _iter_read_and_unpack(self, nobjs, chunksize, fastphot=True):
+        """Run DESISpectra.iter_read_and_unpack with the reading and unpacking
+        mocked out, returning the yielded chunks and the mocks.
+
+        """
+        from types import SimpleNamespace
+        from unittest.mock import MagicMock
+        from astropy.table import Table
+        from fastspecfit.io import DESISpectra
+
+        Spec = DESISpectra()
+        Spec.specfiles = ['coadd-{}.fits'.format(ifile) for ifile in range(len(nobjs))]
+        Spec.meta = []
+        for ifile, nobj in enumerate(nobjs):
+            meta = Table()
+            meta['TARGETID'] = 1000 * (ifile + 1) + np.arange(nobj)
+            meta['RA'] = np.linspace(10., 20., nobj)
+            meta['DEC'] = np.linspace(-5., 5., nobj)
+            Spec.meta.append(meta)
+
+        FFit = SimpleNamespace(SFDMap=SimpleNamespace(ebv=lambda ra, dec: 0.01 * ra))
+
+        def _unpack_spectra(spec, coadd_spec, meta, ebv, FFit, fastphot, synthphot, mp=1, pool=None):
+            meta['EBV'] = ebv
+            return [{'targetid': tid} for tid in meta['TARGETID']], meta
+
+        def _read_spectra(specfile, targetids=None):
+            spec = MagicMock()
+            spec.select.side_effect = lambda targets: SimpleNamespace(fibermap={'TARGETID': np.asarray(targets)})
+            return spec
+
+        with patch('fastspecfit.io.DESISpectra._unpack_spectra', side_effect=_unpack_spectra), \
+             patch('desispec.io.read_spectra', side_effect=_read_spectra) as read_spectra, \
+             patch('desispec.coaddition.coadd_cameras'):
+            chunks = list(Spec.iter_read_and_unpack(FFit, fastphot=fastphot, chunksize=chunksize))
+
+        return Spec, chunks, read_spectra
+
+    def test_iter_read_and_unpack(self):
+        """Test the chunking in DESISpectra.iter_read_and_unpack."""
+        nobjs = [7, 2, 3]
+        alltargetids = np.hstack([1000 * (ifile + 1) + np.arange(nobj) for ifile, nobj in enumerate(nobjs)])
+
+        for chunksize, nchunks in [(None, [7, 2, 3]), (1, [1] * 12), (3, [3, 3, 1, 2, 3]),
+                                   (7, [7, 2, 3]), (100, [7, 2, 3])]:
+            Spec, chunks, _ = self._iter_read_and_unpack(nobjs, chunksize)
+            self.assertEqual([len(data) for data, _ in chunks], nchunks)
+
+            # data and metadata are row-aligned, and no object is lost or repeated
+            for data, chunkmeta in chunks:
+                self.assertEqual([_data['targetid'] for _data in data], list(chunkmeta['TARGETID']))
+                self.assertTrue(np.allclose(chunkmeta['EBV'], 0.01 * chunkmeta['RA']))
+            self.assertTrue(np.all(np.hstack([chunkmeta['TARGETID'] for _, chunkmeta in chunks]) == alltargetids))
+
+            # and the metadata are stacked at the end
+            self.assertEqual(Spec.ntargets, len(alltargetids))
+            self.assertTrue(np.all(Spec.meta['TARGETID'] == alltargetids))
+            self.assertIn('EBV', Spec.meta.colnames)
+
+        with self.assertRaises(ValueError):
+            self._iter_read_and_unpack(nobjs, 0)
+
+    def test_iter_read_and_unpack_spectra(self):
+        """Test that iter_read_and_unpack only reads the spectra in each chunk."""
+        Spec, chunks, read_spectra = self._iter_read_and_unpack([5, 2], 2, fastphot=False)
+        self.assertEqual([len(data) for data, _ in chunks], [2, 2, 1, 2])
+
+        calls = read_spectra.call_args_list
+        self.assertEqual(len(calls), 4)
+        self.assertEqual([_call.args[0] for _call in calls], ['coadd-0.fits'] * 3 + ['coadd-1.fits'])
+        self.assertEqual([list(_call.kwargs['targetids']) for _call in calls[:3]],
+                         [[1000, 1001], [1002, 1003], [1004]])
+        self.assertNotIn('targetids', calls[3].kwargs) # whole file in one chunk
+
+    def test_Checkpoint(self):
+        """Test writing, resuming, and consolidating checkpoints."""
+        from fastspecfit.io import Checkpoint
+        from fastspecfit.fastspecfit import _sort_by_ids
+        from fastspecfit.io import unique_ids
+
+        outfile = os.path.join(self.outdir, 'fastspec.fits.gz')
+        out, meta, models = self._results([11, 12, 13, 14])
+
+        checkpoint = Checkpoint(outfile, interval=1e6)
+        self.assertEqual(checkpoint.ckptdir, os.path.join(self.outdir, 'fastspec.fits.ckpt'))
+        self.assertEqual(len(checkpoint.ids), 0)
+        self.assertEqual(checkpoint.read(), (None, None, None))
+
+        # results arrive out of order; only flushed results survive
+        for iobj in [2, 0]:
+            checkpoint.append(out[iobj], meta[iobj], models[iobj:iobj+1])
+        checkpoint.flush()
+        checkpoint.append(out[1], meta[1], models[1:2])
+        self.assertEqual(sorted(checkpoint.ids), [(11, ), (12, ), (13, )])
+        del checkpoint
+
+        checkpoint = Checkpoint(outfile, resume=True, interval=1e6)
+        self.assertEqual(sorted(checkpoint.ids), [(11, ), (13, )])
+        for iobj in [3, 1]:
+            checkpoint.append(out[iobj], meta[iobj], models[iobj:iobj+1])
+
+        ckout, ckmeta, ckmodels = checkpoint.read()
+        self.assertEqual(len(checkpoint.partfiles), 2)
+        self.assertEqual(list(ckout['TARGETID']), [13, 11, 14, 12])
+
+        srt = _sort_by_ids(unique_ids(ckmeta), unique_ids(meta))
+        ckout, ckmeta, ckmodels = ckout[srt], ckmeta[srt], ckmodels[srt]
+        self.assertTrue(np.all(ckout['TARGETID'] == out['TARGETID']))
+        self.assertTrue(np.allclose(ckout['Z'], out['Z']))
+        self.assertTrue(np.allclose(ckmeta['RA'], meta['RA']))
+        for col in ['CONTINUUM', 'SMOOTHCONTINUUM', 'EMLINEMODEL']:
+            self.assertTrue(np.all(ckmodels[col] == models[col]))
+        self.assertEqual(ckmodels.meta['CRVAL1'][0], 3600.0)
+
+        # starting afresh removes the previous checkpoints
+        checkpoint = Checkpoint(outfile, interval=1e6)
+        self.assertEqual(len(checkpoint.ids), 0)
+        checkpoint.append(out[0], meta[0], models[0:1])
+        checkpoint.flush()
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(checkpoint.ckptdir))
+
+    def test_Checkpoint_repeated_targetids(self):
+        """Test resuming and consolidating objects with repeated TARGETIDs."""
+        from astropy.table import Table
+        from fastspecfit.io import Checkpoint, DESISpectra, unique_ids
+        from fastspecfit.fastspecfit import _sort_by_ids
+
+        # the same targets in two exposures on each of two tiles, in two input files
+        metas = []
+        for tileid in [100, 200]:
+            meta = Table()
+            meta['TARGETID'] = np.array([7, 8, 7, 8], np.int64)
+            meta['TILEID'] = np.int32(tileid)
+            meta['FIBER'] = np.array([10, 11, 10, 11], np.int32)
+            meta['EXPID'] = np.array([1, 1, 2, 2], np.int32)
+            meta['SURVEY'] = 'main'
+            meta['RA'] = np.arange(4.) + tileid
+            metas.append(meta)
+        allids = [key for meta in metas for key in unique_ids(meta)]
+        self.assertEqual(len(set(allids)), 8)
+
+        # fit (and checkpoint) some of them, out of order
+        outfile = os.path.join(self.outdir, 'fastspec.fits')
+        checkpoint = Checkpoint(outfile, fastphot=True, interval=0.0)
+        for ifile, iobj in [(1, 3), (0, 0), (1, 0)]:
+            meta = metas[ifile][iobj:iobj+1].as_array()
+            out = Table(meta)[['TARGETID', 'TILEID', 'FIBER', 'EXPID', 'SURVEY']]
+            out['RA'] = meta['RA']
+            checkpoint.append(out.as_array(), meta)
+
+        # resuming only skips the objects which were fitted
+        checkpoint = Checkpoint(outfile, fastphot=True, resume=True)
+        Spec = DESISpectra()
+        Spec.redrockfiles = ['redrock-0.fits', 'redrock-1.fits']
+        Spec.specfiles = ['coadd-0.fits', 'coadd-1.fits']
+        Spec.meta = [meta.copy() for meta in metas]
+        self.assertEqual(Spec.remove_targets(checkpoint.ids), 3)
+        self.assertEqual([len(meta) for meta in Spec.meta], [3, 2])
+        self.assertTrue(np.all(Spec.meta[0]['RA'] == [101., 102., 103.]))
+        self.assertTrue(np.all(Spec.meta[1]['RA'] == [201., 202.]))
+
+        # fit the rest, and consolidate into the input order
+        for meta in Spec.meta:
+            for iobj in range(len(meta)):
+                _meta = meta[iobj:iobj+1].as_array()
+                out = Table(_meta)[['TARGETID', 'TILEID', 'FIBER', 'EXPID', 'SURVEY']]
+                out['RA'] = _meta['RA']
+                checkpoint.append(out.as_array(), _meta)
+        ckout, ckmeta, _ = checkpoint.read()
+        srt = _sort_by_ids(unique_ids(ckmeta), allids)
+        self.assertEqual(len(srt), 8)
+        self.assertTrue(np.all(ckmeta['RA'][srt] == np.hstack([meta['RA'] for meta in metas])))
+        self.assertTrue(np.all(ckout['RA'][srt] == np.hstack([meta['RA'] for meta in metas])))
+
+        # identical identifiers are matched in turn, and extras are dropped
+        srt = _sort_by_ids([(2, ), (1, ), (1, ), (3, ), (1, )], [(1, ), (2, ), (1, )])
+        self.assertEqual(list(srt), [1, 0, 2])
+
+    def test_Checkpoint_fastphot(self):
+        """Test checkpointing fastphot results."""
+        from fastspecfit.io import Checkpoint
+
+        outfile = os.path.join(self.outdir, 'fastphot.fits')
+        out, meta, _ = self._results([21, 22, 23])
+
+        checkpoint = Checkpoint(outfile, fastphot=True, interval=0.0)
+        for iobj in range(len(out)):
+            checkpoint.append(out[iobj], meta[iobj]) # flushed every time
+        self.assertEqual(len(checkpoint.partfiles), 3)
+
+        ckout, ckmeta, ckmodels = Checkpoint(outfile, fastphot=True, resume=True).read()
+        self.assertTrue(np.all(ckout['TARGETID'] == out['TARGETID']))
+        self.assertTrue(np.all(ckmeta['TARGETID'] == meta['TARGETID']))
+        self.assertIsNone(ckmodels)
+
+class TestUtil(unittest.TestCase):
+    """Test the numerical utilities in fastspecfit.util"""
+    def setUp(self):
+        self.rng = np.random.default_rng(seed=1)
+
+    def test_trapz_rebin_2d(self):
+        """Test trapz_rebin on a 2-D array of spectra."""
+        from fastspecfit.util import trapz_rebin
+
+        x = np.sort(self.rng.uniform(3000., 10000., 500))
+        y = self.rng.uniform(0, 1, (len(x), 4))
+        xnew = np.linspace(3600., 9800., 300)
+
+        result = trapz_rebin(x, y, xnew)
+        self.assertEqual(result.shape, (len(xnew), y.shape[1]))
+        for k in range(y.shape[1]):
+            self.assertTrue(np.allclose(result[:, k], trapz_rebin(x, y[:, k], xnew), rtol=1e-12, atol=0))
+
+    def test_trapz_rebin_weights(self):
+        """Test trapz_rebin_weights against trapz_rebin."""
+        from fastspecfit.util import trapz_rebin, trapz_rebin_weights
+
+        x = np.sort(self.rng.uniform(3000., 10000., 500))
+        y = self.rng.uniform(0, 1, (len(x), 3))
+
+        # both coarser and finer output grids (the latter with bins which
+        # fall between two input samples)
+        for xnew in [np.linspace(3600., 9800., 300), np.linspace(3600., 9800., 2000)]:
+            W = trapz_rebin_weights(x, xnew)
+            self.assertEqual(W.shape, (len(xnew), len(x)))
+            self.assertTrue(np.allclose(W.dot(y), trapz_rebin(x, y, xnew), rtol=1e-12, atol=1e-14))
+
+        edges = np.array([x[1], 0.5*(x[1]+x[2]), 5000., x[-1]])
+        W = trapz_rebin_weights(x, edges=edges)
+        self.assertTrue(np.allclose(W.dot(y[:, 0]), trapz_rebin(x, y[:, 0], edges=edges), rtol=1e-12, atol=1e-14))
+
+        with self.assertRaises(ValueError):
+            trapz_rebin_weights(x, edges=[x[0]-1., 5000.])
+
+    def test_filter_weights(self):
+        """Test filter_weights against speclite."""
+        from speclite import filters
+        from fastspecfit.util import filter_weights
+
+        decamwise = filters.load_filters('decam2014-g', 'decam2014-r', 'decam2014-z',
+                                         'wise2010-W1', 'wise2010-W2')
+        wave = np.arange(1000., 60000., 5.)
+        flux = 1e-17 * self.rng.uniform(0.5, 1.5, (3, len(wave))) # [nmodel, npix]
+
+        W = filter_weights(decamwise, wave)
+        maggies = decamwise.get_ab_maggies(flux, wave)
+        for ifilt, filt in enumerate(decamwise.names):
+            self.assertTrue(np.allclose(W[ifilt, :].dot(flux.T), maggies[filt], rtol=1e-10, atol=0))
+
+        # an optical spectrum which only partially covers the bandpasses
+        decam = filters.load_filters('decam2014-g', 'decam2014-r', 'decam2014-z')
+        wave = np.arange(3600., 9800., 0.8)
+        flux = 1e-17 * self.rng.uniform(0.5, 1.5, (3, len(wave)))
+
+        W = filter_weights(decam, wave, pad=True)
+        padflux, padwave = decam.pad_spectrum(flux, wave, method='edge')
+        maggies = decam.get_ab_maggies(padflux, padwave)
+        for ifilt, filt in enumerate(decam.names):
+            self.assertTrue(np.allclose(W[ifilt, :].dot(flux.T), maggies[filt], rtol=1e-10, atol=0))
+
+        with self.assertRaises(ValueError):
+            filter_weights(decam, wave, pad=False)
+
+    def test_prefetch(self):
+        """Test prefetch."""
+        from fastspecfit.util import prefetch
+
+        def _produce(nitem, fail=False):
+            for ii in range(nitem):
+                yield ii
+            if fail:
+                raise IOError('Problem reading item {}'.format(nitem))
+
+        for depth in [0, 1, 3]:
+            self.assertEqual(list(prefetch(_produce(10), depth=depth)), list(range(10)))
+
+            # exceptions raised in the background thread reach the caller,
+            # after all the preceding items
+            items = []
+            with self.assertRaises(IOError) as cm:
+                for item in prefetch(_produce(5, fail=True), depth=depth):
+                    items.append(item)
+            self.assertEqual(items, list(range(5)))
+            self.assertIn('Problem reading item 5', str(cm.exception))
+
+        # stopping early shuts down the background thread
+        for item in prefetch(_produce(1000), depth=2):
+            if item == 3:
+                break
+        self.assertEqual(item, 3)
+
+    def test_universe_age(self):
+        """Test the tabulated age of the universe."""
+        from scipy.integrate import quad
+        from fastspecfit.util import TabulatedDESI
+
+        cosmo = TabulatedDESI()
+        efunc = lambda z: 1.0 / cosmo.efunc(z) / (1.0 + z)
+
+        redshift = np.array([0.0, 0.1, 0.5, 1.0, 3.0])
+        age = cosmo.universe_age(redshift)
+        for zz, aa in zip(redshift, age):
+            ref = quad(efunc, zz, cosmo._z[-1], limit=200)[0] * cosmo.hubble_time
+            self.assertTrue(np.isclose(aa, ref, rtol=1e-5))
+        self.assertTrue(np.all(np.diff(age) < 0))
+        self.assertTrue(np.isclose(cosmo.universe_age(0.5), age[2]))
+
+        with self.assertRaises(ValueError):
+            cosmo.universe_age(-1.0)
+
+class TestNNLS(unittest.TestCase):
+    """Test the Gram-matrix NNLS solvers in fastspecfit.fnnls"""
+    def setUp(self):
+        self.rng = np.random.default_rng(seed=1)
+
+    def _problem(self, m, n, collinear=False):
+        """Simulate a smooth, badly scaled design matrix and noisy data."""
+        wave = np.linspace(0.3, 1.0, m)[:, np.newaxis]
+        A = np.exp(-self.rng.uniform(0.1, 3.0, n) * wave) * 10**self.rng.uniform(-3, 3, n)
+        if collinear:
+            A[:, 1::2] = A[:, 0:-1:2]
+        coeff = self.rng.uniform(0, 1, n) * (self.rng.uniform(0, 1, n) < 0.5) / np.median(A)
+        model = A.dot(coeff)
+        sigma = 0.05 * np.abs(model) + 1e-3 * np.max(model)
+        y = model + self.rng.normal(size=m) * sigma
+        return A, y, 1 / sigma**2
+
+    def _scipy_nnls(self, A, y, ivar):
+        """Reference solution from scipy.optimize.nnls."""
+        from scipy.optimize import nnls
+        inverr = np.sqrt(ivar)
+        x, _ = nnls(A * inverr[:, np.newaxis], y * inverr, maxiter=100 * A.shape[1])
+        return x, np.sum(ivar * (y - A.dot(x))**2)
+
+    def test_nnls_gram(self):
+        """Test nnls_gram against scipy.optimize.nnls."""
+        from fastspecfit.fnnls import nnls_gram
+
+        for m, n, collinear in [(200, 10, False), (7, 40, False), (7, 40, True), (200, 10, True)]:
+            for _ in range(25):
+                A, y, ivar = self._problem(m, n, collinear=collinear)
+                x, chi2 = nnls_gram(A, y, ivar)
+                xref, chi2ref = self._scipy_nnls(A, y, ivar)
+
+                self.assertTrue(np.all(x >= 0))
+                self.assertTrue(np.isclose(chi2, np.sum(ivar * (y - A.dot(x))**2)))
+                self.assertTrue(np.isclose(chi2, chi2ref, rtol=1e-6, atol=1e-10))
+                if m > n and not collinear: # unique solution
+                    self.assertTrue(np.allclose(x, xref, rtol=1e-5, atol=1e-8 * np.max(xref)))
+
+    def test_nnls_batch(self):
+        """Test nnls_batch against scipy.optimize.nnls."""
+        from fastspecfit.fnnls import nnls_batch
+
+        for m, n, collinear in [(7, 40, False), (7, 40, True)]:
+            nobj = 25
+            A, y, ivar = zip(*[self._problem(m, n, collinear=collinear) for _ in range(nobj)])
+            A, y, ivar = np.array(A), np.array(y), np.array(ivar)
+            keep = self.rng.uniform(0, 1, (nobj, n)) < 0.8
+
+            x, chi2 = nnls_batch(A, y, ivar, keep=keep)
+            self.assertEqual(x.shape, (nobj, n))
+            self.assertTrue(np.all(x >= 0))
+            self.assertTrue(np.all(x[np.logical_not(keep)] == 0))
+            for ii in range(nobj):
+                _, chi2ref = self._scipy_nnls(A[ii][:, keep[ii, :]], y[ii, :], ivar[ii, :])
+                self.assertTrue(np.isclose(chi2[ii], chi2ref, rtol=1e-6, atol=1e-10))
+
+class TestEMLines(unittest.TestCase):
+    """Test the emission-line model and its derivatives in fastspecfit.emlines"""
+    @classmethod
+    def setUpClass(cls):
+        from fastspecfit.util import C_LIGHT
+
+        # fine wavelength grid as in FastFit
+        cls.log10wave = np.arange(np.log10(3500.), np.log10(9900.), 5.0 / C_LIGHT / np.log(10))
+
+        # three overlapping cameras
+        waves = [np.arange(3600., 5800., 0.8), np.arange(5760., 7620., 0.8), np.arange(7520., 9824., 0.8)]
+        cls.emlinewave = np.hstack(waves)
+        npix = np.cumsum([0] + [len(wave) for wave in waves])
+        cls.camerapix = np.vstack((npix[:-1], npix[1:])).T
+        cls.resolution_matrix = [None] * len(waves)
+        cls.redshift = 0.1
+
+        # [OIII] doublet (tied amplitudes, velocity shifts, and line-widths),
+        # [OII] doublet (amplitude ratio), and H-alpha
+        cls.linewaves = np.array([4960.295, 5008.239, 3727.092, 3729.875, 6564.613])
+        cls.parameters = np.array([0.0, 10.0, 0.7, 8.0, 20.0,       # amplitudes
+                                   0.0, 30.0, 0.0, -20.0, 10.0,     # velocity shifts
+                                   0.0, 80.0, 0.0, 60.0, 120.0])    # line-widths
+        cls.Itied = np.array([0, 5, 10, 7, 12])
+        cls.tiedtoparam = np.array([1, 6, 11, 8, 13])
+        cls.tiedfactor = np.array([1.0 / 2.98, 1.0, 1.0, 1.0, 1.0])
+        cls.Ifree = np.array([1, 2, 3, 4, 6, 8, 9, 11, 13, 14])
+        cls.doubletindx = np.array([2])
+        cls.doubletpair = np.array([3])
+        cls.bounds = np.array([[0.0, 1e3], [0.5, 1.5], [0.0, 1e3], [0.0, 1e3],
+                               [-500., 500.], [-500., 500.], [-500., 500.],
+                               [1.0, 750.], [1.0, 750.], [1.0, 750.]])
+
+        rng = np.random.default_rng(seed=1)
+        cls.emlineflux, cls.weights = np.zeros_like(cls.emlinewave), None
+        model = cls._model(cls.parameters[cls.Ifree])
+        cls.emlinesigma = 0.1
+        cls.emlineflux = model + rng.normal(size=len(model)) * cls.emlinesigma
+        cls.weights = np.ones_like(model) / cls.emlinesigma
+
+    @classmethod
+    def _farg(cls, profile='sampled', parameters=None):
+        """Arguments of _objective_function after the free parameters."""
+        if parameters is None:
+            parameters = cls.parameters
+        return (cls.emlinewave, cls.emlineflux, cls.weights, cls.redshift, cls.log10wave,
+                cls.resolution_matrix, cls.camerapix, parameters.copy(), cls.Ifree,
+                cls.Itied, cls.tiedtoparam, cls.tiedfactor, cls.doubletindx,
+                cls.doubletpair, cls.linewaves, profile)
+
+    @classmethod
+    def _model(cls, free_parameters, profile='sampled'):
+        """Noiseless emission-line model."""
+        from fastspecfit.emlines import _objective_function
+        farg = list(cls._farg(profile))
+        farg[1], farg[2] = np.zeros(len(cls.emlinewave)), None # flux and weights
+        return _objective_function(free_parameters, *farg)
+
+    def test_build_emline_model_sampled(self):
+        """Test the sampled build_emline_model against the full-grid model."""
+        from fastspecfit.util import C_LIGHT, trapz_rebin
+        from fastspecfit.emlines import build_emline_model
+
+        parameters = self.parameters.copy()
+        for I, indx, factor in zip(self.Itied, self.tiedtoparam, self.tiedfactor):
+            parameters[I] = parameters[indx] * factor
+        lineamps, linevshifts, linesigmas = np.array_split(parameters, 3)
+        lineamps[0] = 0.0     # lines which are skipped
+        linesigmas[4] = 0.0
+        lineamps[2] = 5.0
+
+        # sum of the lines on the full log10wave grid, rebinned onto each camera
+        log10model = np.zeros_like(self.log10wave)
+        for lineamp, linevshift, linesigma, linewave in zip(lineamps, linevshifts, linesigmas, self.linewaves):
+            if lineamp <= 0:
+                continue
+            log10sigma = linesigma / C_LIGHT / np.log(10)
+            linezwave = np.log10(linewave * (1.0 + self.redshift + linevshift / C_LIGHT))
+            J = np.abs(self.log10wave - linezwave) < (8 * log10sigma)
+            log10model[J] += lineamp * np.exp(-0.5 * (self.log10wave[J]-linezwave)**2 / log10sigma**2)
+        specwaves = [self.emlinewave[campix[0]:campix[1]] for campix in self.camerapix]
+        ref = [trapz_rebin(10**self.log10wave, log10model, specwave) for specwave in specwaves]
+
+        model = build_emline_model(self.log10wave, self.redshift, lineamps, linevshifts, linesigmas,
+                                   self.linewaves, self.emlinewave, self.resolution_matrix,
+                                   self.camerapix)
+        self.assertTrue(np.allclose(model, np.hstack(ref), rtol=1e-10, atol=1e-10 * np.max(model)))
+
+        # per-camera wavelength arrays
+        model = build_emline_model(self.log10wave, self.redshift, lineamps, linevshifts, linesigmas,
+                                   self.linewaves, specwaves, self.resolution_matrix)
+        self.assertEqual(len(model), len(specwaves))
+        for _model, _ref in zip(model, ref):
+            self.assertTrue(np.allclose(_model, _ref, rtol=1e-10, atol=1e-10 * np.max(model[0])))
+
+        # no lines
+        model = build_emline_model(self.log10wave, self.redshift, np.zeros_like(lineamps), linevshifts,
+                                   linesigmas, self.linewaves, self.emlinewave, self.resolution_matrix,
+                                   self.camerapix)
+        self.assertTrue(np.all(model == 0))
+
+        with self.assertRaises(ValueError):
+            build_emline_model(self.log10wave, self.redshift, lineamps, linevshifts, linesigmas,
+                               self.linewaves, self.emlinewave, self.resolution_matrix,
+                               self.camerapix, profile='gaussian')
+
+    def test_build_emline_model_integrated(self):
+        """Test the pixel-integrated build_emline_model against quadrature."""
+        from fastspecfit.util import C_LIGHT, centers2edges
+        from fastspecfit.emlines import build_emline_model
+
+        parameters = self.parameters.copy()
+        for I, indx, factor in zip(self.Itied, self.tiedtoparam, self.tiedfactor):
+            parameters[I] = parameters[indx] * factor
+        lineamps, linevshifts, linesigmas = np.array_split(parameters, 3)
+        lineamps[2] = 5.0
+        linesigmas[3] = 20.0 # narrower than a pixel
+
+        # Gauss-Legendre quadrature over each pixel
+        nodes, quadweights = np.polynomial.legendre.leggauss(20)
+        ref = []
+        for campix in self.camerapix:
+            edges = centers2edges(self.emlinewave[campix[0]:campix[1]])
+            wave = edges[:-1, np.newaxis] + np.diff(edges)[:, np.newaxis] * 0.5 * (nodes + 1)
+            flux = np.zeros_like(wave)
+            for lineamp, linevshift, linesigma, linewave in zip(lineamps, linevshifts, linesigmas, self.linewaves):
+                log10sigma = linesigma / C_LIGHT / np.log(10)
+                linezwave = np.log10(linewave * (1.0 + self.redshift + linevshift / C_LIGHT))
+                flux += lineamp * np.exp(-0.5 * (np.log10(wave)-linezwave)**2 / log10sigma**2)
+            ref.append(0.5 * flux.dot(quadweights))
+
+        model = build_emline_model(None, self.redshift, lineamps, linevshifts, linesigmas,
+                                   self.linewaves, self.emlinewave, self.resolution_matrix,
+                                   self.camerapix, profile='integrated')
+        self.assertTrue(np.allclose(model, np.hstack(ref), rtol=1e-8, atol=1e-10 * np.max(model)))
+
+        # and consistent with the sampled profile for well-resolved lines
+        linesigmas[3] = 60.0
+        model = build_emline_model(None, self.redshift, lineamps, linevshifts, linesigmas,
+                                   self.linewaves, self.emlinewave, self.resolution_matrix,
+                                   self.camerapix, profile='integrated')
+        sampled = build_emline_model(self.log10wave, self.redshift, lineamps, linevshifts, linesigmas,
+                                     self.linewaves, self.emlinewave, self.resolution_matrix,
+                                     self.camerapix, profile='sampled')
+        self.assertTrue(np.allclose(model, sampled, rtol=0, atol=5e-4 * np.max(model)))
+
+    def test_EMLineJacobian(self):
+        """Test EMLineJacobian against finite differences."""
+        from fastspecfit.emlines import _objective_function, EMLineJacobian
+
+        x0 = self.parameters[self.Ifree] * 1.02
+        for profile in ['sampled', 'integrated']:
+            jacobian = EMLineJacobian(self.log10wave, self.emlinewave, self.camerapix, profile=profile)
+            jac = jacobian(x0, *self._farg(profile))
+            self.assertEqual(jac.shape, (len(self.emlinewave), len(self.Ifree)))
+
+            # central finite differences
+            fdjac = np.zeros_like(jac)
+            for ii in range(len(x0)):
+                step = np.zeros_like(x0)
+                step[ii] = 1e-5 * max(1.0, np.abs(x0[ii]))
+                fdjac[:, ii] = (_objective_function(x0 + step, *self._farg(profile)) -
+                                _objective_function(x0 - step, *self._farg(profile))) / (2 * step[ii])
+
+            relerr = np.max(np.abs(jac - fdjac), axis=0) / np.max(np.abs(fdjac), axis=0)
+            self.assertTrue(np.all(relerr < 2e-6), 'profile={}, relerr={}'.format(profile, relerr))
+
+    def test_emline_jac_sparsity(self):
+        """Test that emline_jac_sparsity covers the non-zero Jacobian elements."""
+        from fastspecfit.emlines import EMLineJacobian, emline_jac_sparsity
+
+        sparsity = emline_jac_sparsity(self.redshift, self.emlinewave, self.camerapix,
+                                       self.parameters, self.Ifree, self.Itied,
+                                       self.tiedtoparam, self.tiedfactor, self.bounds,
+                                       self.doubletindx, self.doubletpair, self.linewaves)
+        self.assertEqual(sparsity.shape, (len(self.emlinewave), len(self.Ifree)))
+        self.assertLess(sparsity.nnz, 0.1 * np.prod(sparsity.shape))
+        pattern = sparsity.toarray() > 0
+
+        # anywhere within the bounds, including at the extremes
+        rng = np.random.default_rng(seed=1)
+        lo, hi = self.bounds[:, 0], self.bounds[:, 1]
+        allx = [self.parameters[self.Ifree], lo, hi] + [rng.uniform(lo, hi) for _ in range(5)]
+        for profile in ['sampled', 'integrated']:
+            jacobian = EMLineJacobian(self.log10wave, self.emlinewave, self.camerapix, profile=profile)
+            for x0 in allx:
+                jac = jacobian(x0, *self._farg(profile))
+                self.assertTrue(np.all(pattern[jac != 0]))
+
+    def test_EMLineVarPro(self):
+        """Test the variable-projection form of the emission-line fit."""
+        from scipy.optimize import least_squares
+        from fastspecfit.emlines import _objective_function, EMLineJacobian, EMLineVarPro
+
+        jacobian = EMLineJacobian(self.log10wave, self.emlinewave, self.camerapix)
+        varpro = EMLineVarPro(self.bounds, *self._farg(), jacobian=jacobian)
+
+        # amplitudes are linear, everything else (including the doublet ratio) is not
+        self.assertTrue(np.all(self.Ifree[varpro.linear] == [1, 3, 4]))
+        self.assertEqual(len(varpro.x0), len(self.Ifree) - 3)
+        self.assertEqual(len(varpro.bounds), 2)
+
+        x0 = varpro.x0 * 1.05
+        free_parameters = varpro.free_parameters(x0)
+        self.assertTrue(np.all(free_parameters[varpro.nonlinear] == x0))
+        self.assertTrue(np.allclose(varpro.objective(x0), _objective_function(free_parameters, *self._farg())))
+        self.assertEqual(varpro.jac(x0).shape, (len(self.emlinewave), len(x0)))
+
+        # the reduced problem converges to the same minimum as the full one
+        fit = least_squares(varpro.objective, x0, jac=varpro.jac, bounds=varpro.bounds, method='trf')
+        varpro_chi2 = np.sum(fit.fun**2)
+
+        free_parameters = self.parameters[self.Ifree].copy()
+        free_parameters[varpro.nonlinear] = x0
+        fullfit = least_squares(_objective_function, free_parameters, jac=jacobian, args=self._farg(),
+                                bounds=tuple(zip(*self.bounds)), method='trf')
+        full_chi2 = np.sum(fullfit.fun**2)
+
+        self.assertTrue(np.isclose(varpro_chi2, full_chi2, rtol=1e-6))
+        self.assertTrue(np.allclose(varpro.free_parameters(fit.x), fullfit.x, rtol=1e-3, atol=1e-3))
+
+    def test_EMLineVarPro_linear(self):
+        """Test EMLineVarPro when all the free parameters are amplitudes."""
+        from fastspecfit.emlines import EMLineJacobian, EMLineVarPro
+
+        Ifree = np.array([1, 3, 4])
+        farg = list(self._farg())
+        farg[1], farg[8] = self._model(self.parameters[self.Ifree]), Ifree # noiseless
+
+        jacobian = EMLineJacobian(self.log10wave, self.emlinewave, self.camerapix)
+        varpro = EMLineVarPro(self.bounds[[0, 2, 3], :], *farg, jacobian=jacobian)
+        self.assertEqual(len(varpro.x0), 0)
+
+        x0 = varpro.x0
+        self.assertTrue(np.allclose(varpro.free_parameters(x0), self.parameters[Ifree], rtol=1e-8))
+        self.assertTrue(np.allclose(varpro.objective(x0), 0.0, atol=1e-6))
+        self.assertEqual(varpro.jac(x0).shape, (len(self.emlinewave), 0))
+
 if __name__ == '__main__':
     unittest.main()
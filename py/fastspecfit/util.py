@@ -134,6 +134,66 @@ def _trapz_rebin(x, y, edges, results):
 
     return
 
+@numba.jit(nopython=True)
+def _trapz_rebin_2d(x, y, edges, results):
+    '''
+    Like _trapz_rebin but for a 2-D [len(x), nmodel] block of input spectra,
+    all of which are rebinned in a single pass over the wavelength array.
+
+    `results` is a pre-allocated [len(edges)-1, nmodel] array.
+    '''
+    nbin = len(edges) - 1
+    nmodel = y.shape[1]
+    i = 0  #- index counter for output
+    j = 0  #- index counter for inputs
+
+    while i < nbin:
+        #- Seek next sample beyond bin edge
+        while x[j] <= edges[i]:
+            j += 1
+
+        #- Is this sample inside this bin?
+        if x[j] < edges[i+1]:
+            #- Interpolated value where the interpolation crossed the lower edge
+            wlo = (edges[i]-x[j-1]) / (x[j]-x[j-1])
+            dx = x[j] - edges[i]
+            for k in range(nmodel):
+                yedge = y[j-1, k] + wlo * (y[j, k]-y[j-1, k])
+                results[i, k] += 0.5 * (y[j, k] + yedge) * dx
+
+            #- Continue with interior bins
+            while x[j+1] < edges[i+1]:
+                j += 1
+                dx = x[j] - x[j-1]
+                for k in range(nmodel):
+                    results[i, k] += 0.5 * (y[j, k] + y[j-1, k]) * dx
+
+            #- Next sample will be outside this bin; handle upper edge
+            whi = (edges[i+1]-x[j]) / (x[j+1]-x[j])
+            dx = edges[i+1] - x[j]
+            for k in range(nmodel):
+                yedge = y[j, k] + whi * (y[j+1, k]-y[j, k])
+                results[i, k] += 0.5 * (yedge + y[j, k]) * dx
+
+        #- Otherwise the samples span over this bin
+        else:
+            wlo = (edges[i]-x[j]) / (x[j] - x[j-1])
+            whi = (edges[i+1]-x[j]) / (x[j] - x[j-1])
+            dx = edges[i+1] - edges[i]
+            for k in range(nmodel):
+                ylo = y[j, k] + wlo * (y[j, k] - y[j-1, k])
+                yhi = y[j, k] + whi * (y[j, k] - y[j-1, k])
+                results[i, k] += 0.5 * (ylo+yhi) * dx
+
+        i += 1
+
+    for i in range(nbin):
+        dx = edges[i+1] - edges[i]
+        for k in range(nmodel):
+            results[i, k] /= dx
+
+    return
+
 def trapz_rebin(x, y, xnew=None, edges=None):
     """Rebin y(x) flux density using trapezoidal integration between bin edges
 
@@ -147,11 +207,13 @@ def trapz_rebin(x, y, xnew=None, edges=None):
 
     Args:
         x (array): input x values.
-        y (array): input y values.
+        y (array): input y values; may also be a 2-D [len(x), nmodel] array,
+            in which case all the columns are rebinned at once.
         edges (array): (optional) new bin edges.
 
     Returns:
-        array: integrated results with len(results) = len(edges)-1
+        array: integrated results with len(results) = len(edges)-1 (and shape
+        [len(edges)-1, nmodel] if y is 2-D)
 
     Raises:
         ValueError: if edges are outside the range of x or if len(x) != len(y)
@@ -165,12 +227,187 @@ def trapz_rebin(x, y, xnew=None, edges=None):
     if edges[0] < x[0] or x[-1] < edges[-1]:
         raise ValueError('edges must be within input x range')
 
-    result = np.zeros(len(edges)-1, dtype=np.float64)
-
-    _trapz_rebin(x, y, edges, result)
+    if np.ndim(y) == 2:
+        result = np.zeros((len(edges)-1, y.shape[1]), dtype=np.float64)
+        _trapz_rebin_2d(x, np.ascontiguousarray(y), edges, result)
+    else:
+        result = np.zeros(len(edges)-1, dtype=np.float64)
+        _trapz_rebin(x, y, edges, result)
 
     return result
 
+@numba.jit(nopython=True)
+def _trapz_rebin_weights(x, edges, rows, cols, vals):
+    '''
+    Sparse weights of the (linear) trapezoidal rebinning in _trapz_rebin, such
+    that results[i] = sum(vals[k]*y[cols[k]] for rows[k] == i).
+
+    `rows`, `cols`, and `vals` are pre-allocated arrays which must be at least
+    2*len(x)+4*(len(edges)-1) long; returns the number of elements filled.
+    '''
+    nbin = len(edges) - 1
+    i = 0  #- index counter for output
+    j = 0  #- index counter for inputs
+    n = 0  #- index counter for weights
+
+    while i < nbin:
+        #- Seek next sample beyond bin edge
+        while x[j] <= edges[i]:
+            j += 1
+
+        norm = 1.0 / (edges[i+1] - edges[i])
+
+        #- Is this sample inside this bin?
+        if x[j] < edges[i+1]:
+            #- Lower edge; y[j-1] + wlo * (y[j]-y[j-1]) is the edge value
+            wlo = (edges[i]-x[j-1]) / (x[j]-x[j-1])
+            dx = 0.5 * (x[j] - edges[i]) * norm
+            rows[n], cols[n], vals[n] = i, j-1, dx * (1.0 - wlo)
+            rows[n+1], cols[n+1], vals[n+1] = i, j, dx * (1.0 + wlo)
+            n += 2
+
+            #- Continue with interior bins
+            while x[j+1] < edges[i+1]:
+                j += 1
+                dx = 0.5 * (x[j] - x[j-1]) * norm
+                rows[n], cols[n], vals[n] = i, j-1, dx
+                rows[n+1], cols[n+1], vals[n+1] = i, j, dx
+                n += 2
+
+            #- Upper edge; y[j] + whi * (y[j+1]-y[j]) is the edge value
+            whi = (edges[i+1]-x[j]) / (x[j+1]-x[j])
+            dx = 0.5 * (edges[i+1] - x[j]) * norm
+            rows[n], cols[n], vals[n] = i, j, dx * (2.0 - whi)
+            rows[n+1], cols[n+1], vals[n+1] = i, j+1, dx * whi
+            n += 2
+
+        #- Otherwise the samples span over this bin
+        else:
+            wlo = (edges[i]-x[j]) / (x[j] - x[j-1])
+            whi = (edges[i+1]-x[j]) / (x[j] - x[j-1])
+            dx = 0.5 * (edges[i+1] - edges[i]) * norm
+            rows[n], cols[n], vals[n] = i, j, dx * (2.0 + wlo + whi)
+            rows[n+1], cols[n+1], vals[n+1] = i, j-1, -dx * (wlo + whi)
+            n += 2
+
+        i += 1
+
+    return n
+
+def trapz_rebin_weights(x, xnew=None, edges=None):
+    """Sparse matrix representation of :func:`trapz_rebin`.
+
+    Because trapezoidal rebinning is linear in the input flux, it can be
+    written as a [len(edges)-1, len(x)] matrix W such that
+    trapz_rebin(x, y, edges=edges) == W.dot(y) (to rounding), which can then be
+    combined with other linear operators (e.g., the resolution matrix) and
+    applied to any number of spectra on the same input wavelength grid.
+
+    Args:
+        x (array): input x values.
+        edges (array): (optional) new bin edges.
+
+    Returns:
+        :class:`scipy.sparse.csr_matrix`: [len(edges)-1, len(x)] rebinning
+        matrix.
+
+    Raises:
+        ValueError: if edges are outside the range of x
+
+    """
+    from scipy.sparse import csr_matrix
+
+    if edges is None:
+        edges = centers2edges(xnew)
+    else:
+        edges = np.asarray(edges)
+
+    if edges[0] < x[0] or x[-1] < edges[-1]:
+        raise ValueError('edges must be within input x range')
+
+    nbin = len(edges) - 1
+    nmax = 2 * len(x) + 4 * nbin
+    rows = np.zeros(nmax, dtype=np.int64)
+    cols = np.zeros(nmax, dtype=np.int64)
+    vals = np.zeros(nmax, dtype=np.float64)
+    n = _trapz_rebin_weights(x, edges, rows, cols, vals)
+
+    # duplicate (row, col) entries are summed
+    return csr_matrix((vals[:n], (rows[:n], cols[:n])), shape=(nbin, len(x)))
+
+def filter_weights(filters, wave, pad=False):
+    """Linear weights of the synthetic (AB) photometry of spectra tabulated on a
+    fixed wavelength grid.
+
+    For a given wavelength grid, :meth:`speclite.filters.FilterSequence.get_ab_maggies`
+    is a linear functional of the input spectrum, so it can be written as a
+    matrix W such that the maggies of any number of spectra follow from a
+    single matrix product. The weights reproduce speclite's integration
+    scheme exactly (including its interpolation of undersampled filter
+    curves), to rounding.
+
+    Args:
+        filters (:class:`speclite.filters.FilterSequence`): bandpasses.
+        wave (array): [npix] wavelength array [Angstrom].
+        pad (bool): (optional) as if the spectra were first padded to cover all
+            the bandpasses with `filters.pad_spectrum(..., method='edge')`.
+
+    Returns:
+        array: [len(filters), npix] weights; the maggies of an [npix, nmodel]
+        array of spectra in erg/s/cm2/A are W.dot(flux).
+
+    Raises:
+        ValueError: if the (padded) wavelength array does not cover a bandpass.
+
+    """
+    from speclite.filters import FilterConvolution, default_flux_unit
+
+    wave = np.asarray(wave, dtype=np.float64)
+    npix = len(wave)
+
+    if pad:
+        _, padwave = filters.pad_spectrum(np.zeros(npix), wave, method='edge')
+        padwave = np.asarray(padwave)
+        nbefore = np.searchsorted(padwave, wave[0])
+        padW = filter_weights(filters, padwave, pad=False)
+        W = padW[:, nbefore:nbefore+npix].copy()
+        W[:, 0] += np.sum(padW[:, :nbefore], axis=1)
+        W[:, -1] += np.sum(padW[:, nbefore+npix:], axis=1)
+        return W
+
+    W = np.zeros((len(filters), npix))
+    for ifilt, response in enumerate(filters):
+        conv = FilterConvolution(response, wave, photon_weighted=True,
+                                 interpolate=True, units=default_flux_unit)
+
+        # trapezoidal-rule weights of the photon-weighted integrand on the
+        # quadrature grid
+        xquad = conv.quad_wavelength
+        dx = np.diff(xquad)
+        cquad = np.zeros(len(xquad))
+        cquad[:-1] += 0.5 * dx
+        cquad[1:] += 0.5 * dx
+        cquad *= conv.quad_weight
+
+        # map the quadrature points back onto the (trimmed) input grid
+        xgrid = conv._wavelength
+        ngrid = len(xgrid)
+        if conv.interpolate_wavelength is None:
+            wgrid = cquad * conv._response_grid
+        else:
+            ccat = np.zeros(len(xquad))
+            ccat[conv.interpolate_sort_order] = cquad # [grid points, interpolated points]
+            wgrid = ccat[:ngrid] * conv._response_grid
+            cinterp = ccat[ngrid:] * conv.interpolate_response
+            J = np.clip(np.searchsorted(xgrid, conv.interpolate_wavelength), 1, ngrid-1)
+            frac = (conv.interpolate_wavelength - xgrid[J-1]) / (xgrid[J] - xgrid[J-1])
+            np.add.at(wgrid, J-1, cinterp * (1 - frac))
+            np.add.at(wgrid, J, cinterp * frac)
+
+        W[ifilt, conv._response_slice] = wgrid / response.ab_zeropoint.value
+
+    return W
+
 class ZWarningMask(object):
     """
     Mask bit definitions for zwarning.
@@ -217,6 +454,136 @@ class ZWarningMask(object):
         flagmask = [flagmask[i] for i in isort]
         return flagmask
 
+class FitFlagMask(object):
+    """
+    Mask bit definitions for the FITFLAG output column.
+
+    """
+    BROADFIT_SKIPPED  = 2**0  #- time budget exceeded; broad-line fitting skipped
+    NFEV_CAPPED       = 2**1  #- time budget exceeded; emission-line optimizer iterations capped
+    TIMEOUT           = 2**2  #- hard time limit exceeded; fit aborted and default values returned
+    NNLS_FAILED       = 2**3  #- continuum NNLS solver failed; coefficients set to zero
+
+    @classmethod
+    def flags(cls):
+        flagmask = list()
+        for key, value in cls.__dict__.items():
+            if not key.startswith('_') and key.isupper():
+                flagmask.append((key, value))
+
+        import numpy as np
+        isort = np.argsort([x[1] for x in flagmask])
+        flagmask = [flagmask[i] for i in isort]
+        return flagmask
+
+class StageTimer(object):
+    def __init__(self):
+        """Accumulate the wall-clock time spent in (and counters associated
+        with) named stages of the fitting of a single object.
+
+        Repeated visits to the same stage (e.g., many calls to
+        templates2data) are summed. Typical usage::
+
+            timer = StageTimer()
+            with timer('NNLS'):
+                coeff, chi2 = ...
+            timer.count('NFEV_FINAL', fit_info.nfev)
+
+        """
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far (e.g., before the next object)."""
+        self.timings = {}
+        self.counts = {}
+
+    def add(self, stage, seconds):
+        """Add `seconds` to the time spent in `stage`."""
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def count(self, name, value=1):
+        """Add `value` to the counter `name`."""
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def __call__(self, stage):
+        """Context manager which times the enclosed block as `stage`."""
+        import time
+        from contextlib import contextmanager
+
+        @contextmanager
+        def _timed():
+            t0 = time.time()
+            try:
+                yield
+            finally:
+                self.add(stage, time.time()-t0)
+
+        return _timed()
+
+    def summary(self):
+        """Return a (picklable) dictionary of all the timings and counters."""
+        summary = self.timings.copy()
+        summary.update(self.counts)
+        return summary
+
+def prefetch(iterable, depth=1):
+    """Iterate over `iterable` in a background thread.
+
+    Up to `depth` items are produced ahead of the consumer, so that (for
+    example) the next file can be read and unpacked while the current one is
+    being fitted. Exceptions raised by the producer are re-raised in the
+    consumer. If `depth` is less than one, simply iterate over `iterable`.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Iterable (typically a generator) to consume in the background.
+    depth : :class:`int`
+        Maximum number of items to keep ready ahead of the consumer.
+
+    """
+    import threading, queue
+
+    if depth < 1:
+        yield from iterable
+        return
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def _put(item):
+        # Give up if the consumer has gone away.
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _producer():
+        try:
+            for item in iterable:
+                if not _put(('item', item)):
+                    return
+            _put(('done', None))
+        except BaseException as err:
+            _put(('error', err))
+
+    thread = threading.Thread(target=_producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, item = items.get()
+            if kind == 'done':
+                break
+            elif kind == 'error':
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
 def find_minima(x):
     """Return indices of local minima of x, including edges.
 
@@ -241,6 +608,63 @@ def find_minima(x):
     return ii[jj]
 
 
+def median_filter_rows(x, rows, size):
+    """Median-filter the columns of a 2D array, but only at the given rows.
+
+    Equivalent to `scipy.ndimage.median_filter(x, size=(size, 1))[rows, :]`
+    (including the default `reflect` boundary mode and, for even `size`, the
+    choice of the upper of the two middle values), which is much faster
+    when only a few rows of the filtered array are needed.
+
+    Args:
+        x (array): [n, ncol] input values.
+        rows (array): Indices of the rows at which to evaluate the filter.
+        size (int): Size of the median filter.
+
+    Returns:
+        (array): [len(rows), ncol] median-filtered values.
+
+    """
+    n = x.shape[0]
+    rows = np.atleast_1d(rows)
+    out = np.zeros((len(rows), x.shape[1]), dtype=x.dtype)
+    for irow, row in enumerate(rows):
+        indx = np.arange(row - size // 2, row - size // 2 + size)
+        indx = np.where(indx < 0, -indx - 1, indx)
+        indx = np.where(indx >= n, 2 * n - indx - 1, indx)
+        out[irow, :] = np.partition(x[indx, :], size // 2, axis=0)[size // 2, :]
+
+    return out
+
+
+def sigmaclip_median(x, low=1.5, high=3.0):
+    """Column-by-column median of the sigma-clipped values of a 2D array.
+
+    Equivalent to calling `np.median(scipy.stats.sigmaclip(x[:, j], low,
+    high)[0])` for every column j, but clips all the columns at once.
+
+    Args:
+        x (array): [n, ncol] input values.
+        low (float): Lower clipping bound, in units of the standard deviation.
+        high (float): Upper clipping bound, in units of the standard deviation.
+
+    Returns:
+        (array): [ncol] medians of the clipped values.
+
+    """
+    keep = np.ones(x.shape, bool)
+    while True:
+        clipped = np.where(keep, x, np.nan)
+        mean = np.nanmean(clipped, axis=0)
+        std = np.nanstd(clipped, axis=0)
+        newkeep = keep & (x >= mean - std * low) & (x <= mean + std * high)
+        if np.array_equal(newkeep, keep):
+            break
+        keep = newkeep
+
+    return np.nanmedian(np.where(keep, x, np.nan), axis=0)
+
+
 def minfit(x, y):
     """Fits y = y0 + ((x-x0)/xerr)**2
 
@@ -292,6 +716,7 @@ class TabulatedDESI(object):
     >>> cosmo = TabulatedDESI()
     >>> distance = cosmo.comoving_radial_distance([0.1, 0.2])
     >>> efunc = cosmo.efunc(0.3)
+    >>> age = cosmo.universe_age([0.1, 0.2])
 
     The cosmology is defined in https://github.com/abacusorg/AbacusSummit/blob/master/Cosmologies/abacus_cosm000/CLASS.ini
     and the tabulated file was obtained using https://github.com/adematti/cosmoprimo/blob/main/cosmoprimo/fiducial.py.
@@ -311,37 +736,41 @@ class TabulatedDESI(object):
         self.h = self.H0 / 100
         self.hubble_time = 3.08567758e19 / 3.15576e16 / self.H0 # Hubble time [Gyr]
 
-    def efunc(self, z):
-        r"""Return :math:`E(z)`, where the Hubble parameter is defined as :math:`H(z) = H_{0} E(z)`, unitless."""
+        # Tabulate the age of the universe (the integral of 1/[E(z)(1+z)] from
+        # z to the end of the grid) so universe_age is a simple interpolation.
+        agefunc = 1.0 / self._efunc / (1.0 + self._z)
+        dage = 0.5 * (agefunc[1:] + agefunc[:-1]) * np.diff(self._z)
+        self._universe_age = np.append(np.cumsum(dage[::-1])[::-1], 0.0) * self.hubble_time
+
+    def _check_range(self, z):
         z = np.asarray(z)
-        mask = (z < self._z[0]) | (z > self._z[-1])
-        if mask.any():
+        if np.min(z, initial=self._z[0]) < self._z[0] or np.max(z, initial=self._z[-1]) > self._z[-1]:
             raise ValueError('Input z outside of tabulated range.')
+        return z
+
+    def efunc(self, z):
+        r"""Return :math:`E(z)`, where the Hubble parameter is defined as :math:`H(z) = H_{0} E(z)`, unitless."""
+        z = self._check_range(z)
         return np.interp(z, self._z, self._efunc, left=None, right=None)
 
     def comoving_radial_distance(self, z):
         r"""Return comoving radial distance, in :math:`\mathrm{Mpc}/h`."""
-        z = np.asarray(z)
-        mask = (z < self._z[0]) | (z > self._z[-1])
-        if mask.any():
-            raise ValueError('Input z outside of tabulated range.')
+        z = self._check_range(z)
         return np.interp(z, self._z, self._comoving_radial_distance, left=None, right=None)
 
     def luminosity_distance(self, z):
         r"""Return luminosity distance, in :math:`\mathrm{Mpc}/h`."""
-        return self.comoving_radial_distance(z) * (1.0+z)
+        z = self._check_range(z)
+        return np.interp(z, self._z, self._comoving_radial_distance) * (1.0+z)
 
     def distance_modulus(self, z):
         """Return the distance modulus at the given redshift (Hogg Eq. 24)."""
         return 5. * np.log10(self.luminosity_distance(z)) + 25
 
     def universe_age(self, z):
-        """Return the age of the universe at the given redshift.
+        """Return the age of the universe at the given redshift(s) [Gyr],
+        interpolated from the tabulated values.
 
         """
-        from scipy.integrate import quad
-
-        def _agefunc(z):
-            return 1.0 / self.efunc(z) / (1.0 + z)
-        integ, _ =  quad(_agefunc, z, self._z[-1])
-        return integ * self.hubble_time
+        z = self._check_range(z)
+        return np.interp(z, self._z, self._universe_age)